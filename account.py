@@ -0,0 +1,132 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import asyncio
+
+
+ORDER_PAGE = 100        # Active orders per REST page, a reconcile pages through all of them
+
+
+class AccountState:
+    '''
+    In memory view of position, open orders and wallet balance, kept current from the private websocket channels.
+    Subscribe to topics() once and pass every message to on_message, risk checks and status printouts read from here
+    instead of calling the REST API. reconcile_loop re-syncs with REST in the background to recover any missed updates.'''
+
+    def __init__(self, trade, symbol, currency='USDT', reconcile_interval=30):
+        self.trade = trade
+        self.symbol = symbol
+        self.currency = currency
+        self.reconcile_interval = reconcile_interval
+
+        self.position = {'currentQty': 0, 'avgEntryPrice': 0, 'liquidationPrice': 0, 'unrealisedRoePcnt': 0}
+        self.orders = {}
+        self.balance = {}
+
+        # Websocket updates are numbered, so a REST snapshot knows which changes arrived while it was being fetched
+        self.updates = 0
+        self._position_at = 0
+        self._order_at = {}
+        self._done = {}
+
+    def topics(self):
+        return [f'/contract/position:{self.symbol}', '/contractMarket/tradeOrders', '/contractAccount/wallet']
+
+    def on_message(self, msg):
+        # Apply a private channel update, returns False if the message is not an account update
+        topic, data = msg.get('topic'), msg.get('data', {})
+
+        if topic == f'/contract/position:{self.symbol}':
+            self.updates += 1
+            self._position_at = self.updates
+            self.position.update(data)
+        elif topic == '/contractMarket/tradeOrders':
+            if data.get('symbol') == self.symbol:
+                self._order_change(data)
+        elif topic == '/contractAccount/wallet':
+            if data.get('currency', self.currency) == self.currency:
+                self.balance.update(data)
+        else:
+            return False
+
+        return True
+
+    def _order_change(self, data):
+        order_id = data['orderId']
+        self.updates += 1
+        if data.get('status') == 'done' or data.get('type') in ('filled', 'canceled'):
+            self.orders.pop(order_id, None)
+            self._order_at.pop(order_id, None)
+            self._done[order_id] = self.updates
+            return
+
+        self._order_at[order_id] = self.updates
+        order = self.orders.setdefault(order_id, {'id': order_id})
+        order.update(data)
+        if 'remainSize' in data:
+            order['size'] = data['remainSize']
+
+    def open_orders(self):
+        return list(self.orders.values())
+
+    def fetch(self):
+        # Blocking REST snapshot of position and active orders, with the number of websocket updates seen before it
+        since = self.updates
+        position = self.trade.get_position_details(self.symbol)
+        orders, page = [], 1
+        while True:
+            result = self.trade.get_order_list(status='active', symbol=self.symbol, currentPage=page, pageSize=ORDER_PAGE)
+            orders += [self._rest_order(order) for order in result['items'] if order.get('symbol') == self.symbol]
+            if page >= int(result.get('totalPage') or 1):
+                break
+            page += 1
+
+        return position, orders, since
+
+    @staticmethod
+    def _rest_order(order):
+        # REST reports the original size and how much of it filled, websocket updates the size left, the cache holds the latter
+        if 'filledSize' in order:
+            order = dict(order, size=int(order['size']) - int(order['filledSize']))
+        return order
+
+    def apply(self, position, orders, since=None):
+        # Replace the cache with a REST snapshot, keeping what websocket updates after since have changed since then
+        if since is None:
+            since = self.updates
+        if self._position_at <= since:
+            self.position.update(position)
+
+        fresh = {order_id: order for order_id, order in self.orders.items() if self._order_at.get(order_id, 0) > since}
+        self.orders = {order['id']: order for order in orders if self._done.get(order['id'], 0) <= since}
+        self.orders.update(fresh)
+        self._order_at = {order_id: at for order_id, at in self._order_at.items() if at > since}
+        self._done = {order_id: at for order_id, at in self._done.items() if at > since}
+
+    def reconcile(self):
+        self.apply(*self.fetch())
+
+    async def reconcile_loop(self):
+        # Periodic REST reconcile, the blocking calls run in the default executor so the event loop keeps reading messages
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                self.apply(*await loop.run_in_executor(None, self.fetch))
+            except Exception as e:
+                print(f'Account Reconcile Error!\n {e}')
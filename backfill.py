@@ -0,0 +1,201 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+import os
+import time
+import shutil
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from tape import COLUMNS, KIND_INDEX, KIND_TRADE, TickReader, TickWriter
+
+
+'''
+Historical index points and candles over any time range, paged through the REST market API.
+The range is cut into windows aligned to the window size, each window is paged forward on its own, several windows at a time,
+and every request takes a token from one shared bucket so the whole backfill stays inside the rate limit.
+Pages are normalised into tape rows, the same columnar ticks the recorder writes, so candles and replays read them unchanged.
+Klines become four synthetic trades per bar, open, high, low then close with the volume on the close, which rebuild the
+bar exactly in any candle timeframe that is a whole number of klines.
+Each finished window is cached on disk as a tape directory, cache/{symbol}/{source}/{start}-{end}, and never fetched again.
+Windows that are empty or reach into the last minute are not cached, they are fetched again next time.'''
+
+INDEX_PAGE = 100
+KLINE_PAGE = 200
+INDEX_WINDOW = 15 * 60_000          # Index window in ms, a few pages of index points
+_SETTLE = 60_000                    # A window is only cached once it ended this long ago, in ms
+_RETRIES = 3
+
+
+class RateLimit:
+    '''
+    Token bucket shared by the backfill threads. acquire blocks until the next request fits inside rate requests per second,
+    with up to burst requests allowed back to back.'''
+
+    def __init__(self, rate=10, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+
+        self._tokens = self.burst
+        self._at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._at) * self.rate) - 1
+            self._at = now
+            wait = -self._tokens / self.rate
+
+        # A negative balance reserves the token, so waiting threads leave in the order they arrived
+        if wait > 0:
+            time.sleep(wait)
+
+
+def index_rows(market, symbol, start, end, limit):
+    # Index points in [start, end) ms, paging forward from start
+    rows, at = [], start
+    while at < end:
+        limit.acquire()
+        page = market.get_index_list(symbol, startAt=at, endAt=end - 1, forward=True, maxCount=INDEX_PAGE)
+        points = sorted(int(d['timePoint']) for d in page['dataList'])
+        values = {int(d['timePoint']): float(d['value']) for d in page['dataList']}
+        rows += [(t * 1_000_000, KIND_INDEX, values[t], 0.0, 0) for t in points if start <= t < end]
+
+        if len(points) < INDEX_PAGE or not page.get('hasMore', True) or points[-1] < at:
+            break
+        at = points[-1] + 1
+
+    return rows
+
+
+def kline_rows(market, symbol, start, end, limit, granularity=1):
+    # Synthetic trades for the granularity minute klines that start and finish inside [start, end) ms
+    step = granularity * 60_000
+    rows, at = [], start
+    while at < end:
+        limit.acquire()
+        page = market.get_kline_data(symbol, granularity, at, end)
+        bars = sorted(bar for bar in page if at <= int(bar[0]) and int(bar[0]) + step <= end)
+        for t, o, h, l, c, v in bars:
+            ts = int(t) * 1_000_000
+            rows += [(ts, KIND_TRADE, float(o), 0.0, 0), (ts + 1, KIND_TRADE, float(h), 0.0, 0),
+                     (ts + 2, KIND_TRADE, float(l), 0.0, 0), (ts + 3, KIND_TRADE, float(c), float(v), 0)]
+
+        if len(page) < KLINE_PAGE or not bars:
+            break
+        at = int(bars[-1][0]) + step
+
+    return rows
+
+
+def _columns(rows):
+    if not rows:
+        return {column: np.empty(0, dtype=dtype) for column, dtype in COLUMNS.items()}
+    return {column: np.asarray(values, dtype=dtype) for (column, dtype), values in zip(COLUMNS.items(), zip(*rows))}
+
+
+def _store(path, columns):
+    # Write the window to a temporary tape and rename it into place, a concurrent run may have beaten us to it
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    writer = TickWriter(tmp)
+    writer.write_columns(columns)
+    writer.close()
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _fetch_window(fetch, path, start, end, stop, now):
+    # The window [start, end), fetched up to stop if that comes first, and only cached if fetched in full
+    if path is not None and os.path.isdir(path):
+        reader = TickReader(path)
+        return {column: np.array(reader[column]) for column in COLUMNS}
+
+    for attempt in range(_RETRIES):
+        try:
+            rows = fetch(start, min(end, stop))
+            break
+        except Exception as e:
+            if attempt == _RETRIES - 1:
+                raise
+            print(f'Backfill Error! Retrying {start}-{end}\n {e!r}')
+            time.sleep(2 ** attempt)
+
+    columns = _columns(rows)
+    if path is not None and rows and end <= stop and end + _SETTLE <= now:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _store(path, columns)
+    return columns
+
+
+def fetch(market, symbol, start, end, source='index', granularity=1, cache='cache', workers=4, limit=None):
+    '''
+    Tape columns for symbol over [start, end) in ms, sorted by time. source is 'index' for index points, symbol being an
+    index such as .PXBTUSDT, or 'kline' for the granularity minute candles of a contract. Set cache=None to skip the disk cache.
+    market is the polofutures market API, or anything with the same get_index_list and get_kline_data calls.'''
+    limit = limit or RateLimit()
+    if source == 'index':
+        size, name = INDEX_WINDOW, 'index'
+        fetch_rows = lambda w_start, w_end: index_rows(market, symbol, w_start, w_end, limit)
+    elif source == 'kline':
+        size, name = KLINE_PAGE * granularity * 60_000, f'kline{granularity}'
+        fetch_rows = lambda w_start, w_end: kline_rows(market, symbol, w_start, w_end, limit, granularity)
+    else:
+        raise ValueError(f'Unknown backfill source {source}, expected index or kline')
+
+    now = int(time.time() * 1000)
+    windows = [(w, w + size) for w in range(start - start % size, end, size)]
+    paths = [os.path.join(cache, symbol, name, f'{w_start}-{w_end}') if cache else None for w_start, w_end in windows]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(lambda w, path: _fetch_window(fetch_rows, path, w[0], w[1], end, now), windows, paths))
+
+    columns = {column: np.concatenate([part[column] for part in parts]) if parts else np.empty(0, dtype=dtype)
+               for column, dtype in COLUMNS.items()}
+    keep = (columns['ts'] >= start * 1_000_000) & (columns['ts'] < end * 1_000_000)
+    order = np.argsort(columns['ts'][keep], kind='stable')
+    return {column: values[keep][order] for column, values in columns.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Backfill index points or klines into a tape directory')
+    parser.add_argument('tape', help='tape directory to append to')
+    parser.add_argument('symbol', help='e.g. .PXBTUSDT for index points, BTCUSDTPERP for klines')
+    parser.add_argument('--source', choices=('index', 'kline'), default='index')
+    parser.add_argument('--granularity', type=int, default=1, help='kline minutes')
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--cache', default='cache')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=10, help='requests per second')
+    args = parser.parse_args()
+
+    from polofutures import RestClient
+
+    market = RestClient(os.environ['PF_API_KEY'], os.environ['PF_SECRET'], os.environ['PF_PASS']).market_api()
+    end = int(time.time() * 1000)
+    columns = fetch(market, args.symbol, end - int(args.hours * 3_600_000), end, args.source, args.granularity,
+                    args.cache, args.workers, RateLimit(args.rate))
+
+    writer = TickWriter(args.tape)
+    writer.write_columns(columns)
+    writer.close()
+    print(f'Backfilled {len(columns["ts"])} rows of {args.symbol} into {args.tape}')
@@ -0,0 +1,311 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import os
+import asyncio
+import argparse
+from contextlib import redirect_stdout
+from itertools import count
+
+import pandas as pd
+
+from metrics import Metrics
+from runner import Runner, load_script
+from tape import TickReader, to_message, KIND_MARK
+
+
+class SimTrade:
+    '''
+    Stand in for the polofutures trade API that fills limit orders against a recorded tape.
+    An order priced through the last tape price fills at once at that price, unless it is post only in which case it is rejected.
+    Resting orders fill in full at their own price once the tape trades at or through them.
+    Position, order and fill updates are queued as private channel messages, for the replay to feed to the strategy.'''
+
+    def __init__(self, symbol, multiplier=0.001):
+        self.symbol = symbol
+        self.multiplier = multiplier
+        self.ts = 0
+        self.last_price = None
+
+        self.orders = {}
+        self.fills = []
+        self.events = []
+        self.qty = 0
+        self.entry = 0.0
+        self.leverage = 1
+        self.realised = 0.0
+        self.peak = self.drawdown = 0.0
+        self._ids = count(1)
+
+    # polofutures trade API
+    def create_limit_order(self, symbol, side, leverage, size, price, postOnly=False, clientOid=None, **kwargs):
+        limit, size = float(price), int(size)
+        marketable = self.last_price is not None and (
+            limit >= self.last_price if side == 'buy' else limit <= self.last_price)
+        if marketable and postOnly:
+            raise ValueError(f'Post only order {side} {size} at {price} would cross {self.last_price}')
+
+        order = {'id': f'sim-{next(self._ids)}', 'symbol': symbol, 'side': side, 'leverage': str(leverage),
+                 'price': str(price), 'size': size, 'value': str(size * limit * self.multiplier),
+                 'clientOid': clientOid, 'status': 'open', 'createdAt': self.ts // 1_000_000}
+        self.leverage = float(leverage)
+        self.orders[order['id']] = order
+        self._order_event(order, 'open')
+
+        if marketable:
+            self._fill(order, self.last_price)
+        return {'orderId': order['id']}
+
+    def cancel_order(self, order_id):
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            raise ValueError(f'Order {order_id} not found')
+        self._order_event(order, 'canceled')
+        return {'cancelledOrderIds': [order_id]}
+
+    def cancel_all_limit_orders(self, symbol):
+        ids = [order_id for order_id, order in self.orders.items() if order['symbol'] == symbol]
+        for order_id in ids:
+            self.cancel_order(order_id)
+        return {'cancelledOrderIds': ids}
+
+    def get_order_list(self, status='active', **kwargs):
+        return {'items': [dict(order) for order in self.orders.values()] if status == 'active' else []}
+
+    def get_position_details(self, symbol):
+        return self.position()
+
+    # Simulation
+    def tick(self, ts, kind, price):
+        # Advance the clock and fill resting orders the price has traded through, mark prices only revalue
+        self.ts = ts
+        if kind == KIND_MARK:
+            return
+        self.last_price = price
+
+        for order in [o for o in self.orders.values() if
+                      (price <= float(o['price']) if o['side'] == 'buy' else price >= float(o['price']))]:
+            self._fill(order, float(order['price']))
+
+        equity = self.realised + self.unrealised()
+        self.peak = max(self.peak, equity)
+        self.drawdown = max(self.drawdown, self.peak - equity)
+
+    def unrealised(self):
+        if not self.qty or self.last_price is None:
+            return 0.0
+        return self.qty * (self.last_price - self.entry) * self.multiplier
+
+    def position(self):
+        margin = abs(self.qty) * self.entry * self.multiplier / self.leverage
+        return {'symbol': self.symbol, 'currentQty': self.qty, 'avgEntryPrice': self.entry,
+                'liquidationPrice': 0, 'realisedPnl': self.realised, 'unrealisedPnl': self.unrealised(),
+                'unrealisedRoePcnt': self.unrealised() / margin if margin else 0}
+
+    def _fill(self, order, price):
+        size = order['size']
+        signed = size if order['side'] == 'buy' else -size
+
+        if self.qty == 0 or (self.qty > 0) == (signed > 0):
+            self.entry = (self.entry * abs(self.qty) + price * size) / (abs(self.qty) + size)
+        else:
+            closing = min(abs(self.qty), size)
+            self.realised += closing * (price - self.entry) * self.multiplier * (1 if self.qty > 0 else -1)
+            if size > abs(self.qty):
+                self.entry = price
+        self.qty += signed
+        if self.qty == 0:
+            self.entry = 0.0
+
+        del self.orders[order['id']]
+        self.fills.append({'ts': self.ts, 'orderId': order['id'], 'clientOid': order['clientOid'],
+                           'side': order['side'], 'price': price, 'size': size,
+                           'position': self.qty, 'realisedPnl': self.realised})
+        self._order_event(order, 'filled')
+        self.events.append({'topic': f'/contract/position:{self.symbol}', 'subject': 'position.change',
+                            'data': self.position()})
+
+    def _order_event(self, order, kind):
+        status = 'open' if kind == 'open' else 'done'
+        self.events.append({'topic': '/contractMarket/tradeOrders', 'subject': 'orderChange',
+                            'data': dict(order, orderId=order['id'], type=kind, status=status,
+                                         remainSize=order['size'] if kind == 'open' else 0, ts=self.ts)})
+
+
+class SimMarket:
+    # Bootstrap REST endpoints the bots call when they are built, the replay starts from an empty history
+    def __init__(self, first_index):
+        self.first_index = first_index
+
+    def get_trade_history(self, symbol):
+        return []
+
+    def get_index_list(self, symbol, **kwargs):
+        return {'dataList': []}
+
+    def get_kline_data(self, symbol, granularity, begin_t=None, end_t=None):
+        return []
+
+    def get_ticker(self, symbol):
+        return {}
+
+    def get_contract_detail(self, symbol):
+        return {'symbol': symbol, 'tickSize': 1}
+
+    def get_current_mark_price(self, symbol):
+        return {'indexPrice': self.first_index}
+
+
+class SimGateway:
+    # Order gateway that calls the simulator inline, so replays are deterministic and need no threads
+    def __init__(self, trade):
+        self.trade = trade
+
+    async def place(self, key=None, **order):
+        return self.trade.create_limit_order(**order)
+
+    async def cancel(self, order_id, prefix=None):
+        return self.trade.cancel_order(order_id)
+
+    async def amend(self, order_id, key=None, **order):
+        self.trade.cancel_order(order_id)
+        return self.trade.create_limit_order(**order)
+
+    async def cancel_many(self, order_ids, prefix=None):
+        results = []
+        for order_id in order_ids:
+            try:
+                results.append(self.trade.cancel_order(order_id))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def cancel_all(self, symbol):
+        return self.trade.cancel_all_limit_orders(symbol)
+
+    def submit(self, coro, label='Order'):
+        try:
+            coro.send(None)
+        except StopIteration:
+            pass
+        except Exception as e:
+            print(f'{label} Error!\n {e!r}')
+
+    def latency_stats(self):
+        return {}
+
+    def shutdown(self):
+        pass
+
+
+def load_strategy(script, sim, first_index, params, symbol='BTCUSDTPERP'):
+    # Build the script's bot against the simulator, through the same runner that hosts it live
+    module = load_script(script)
+    if 'SNAPSHOT_FILE' in getattr(module, 'PARAMS', ()):
+        # Replays always start cold, and must not overwrite or pick up the live bot's snapshot
+        params = dict({'SNAPSHOT_FILE': ''}, **params)
+    runner = Runner(SimMarket(first_index), sim, SimGateway(sim), Metrics(enabled=False))
+    bot = runner.add(module.BOT, symbol, **params)
+    return runner, bot
+
+
+def replay(script, tape, params=None, symbol='BTCUSDTPERP', multiplier=0.001, quiet=True):
+    '''
+    Feed a recorded tape through the runner's websocket callback to a strategy script's bot.
+    Signal bots trade on closed candles, the market maker requotes when its trigger falls due in tape time.
+    Script output is discarded unless quiet is False.
+    Returns a dict of fills, per bar signals, the final position and PnL and the max drawdown.'''
+    reader = TickReader(tape) if isinstance(tape, str) else tape
+    sim = SimTrade(symbol, multiplier)
+    prices = reader['price'][reader['kind'] != KIND_MARK]
+    first_index = float(prices[0]) if len(prices) else 0.0
+    signals = []
+
+    def run():
+        runner, bot = load_strategy(script, sim, first_index, params or {}, symbol)
+        callback = runner.dispatch
+        trigger = getattr(bot, 'trigger', None)
+
+        if hasattr(bot, 'trade_signal'):
+            trade_signal = bot.trade_signal
+
+            def record_signal(bar):
+                bar = trade_signal(bar)
+                signals.append(bar)
+                return bar
+
+            bot.trade_signal = record_signal
+
+        loop = asyncio.new_event_loop()
+
+        for ts, kind, price, size, side in reader.rows():
+            sim.tick(ts, kind, price)
+            callback(to_message(symbol, ts, kind, price, size, side))
+            runner.evaluate(ts / 1_000_000_000)
+            while sim.events:
+                callback(sim.events.pop(0))
+
+            if trigger is not None and kind != KIND_MARK and trigger.due(ts / 1_000_000_000):
+                try:
+                    loop.run_until_complete(bot.requote(ts / 1_000_000_000))
+                except Exception as e:
+                    print(f'Market Maker Error!\n {e}')
+                while sim.events:
+                    callback(sim.events.pop(0))
+
+        loop.close()
+
+    if quiet:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            run()
+    else:
+        run()
+
+    return {'fills': pd.DataFrame(sim.fills), 'signals': pd.DataFrame(signals), 'position': sim.qty,
+            'realisedPnl': sim.realised, 'unrealisedPnl': sim.unrealised(),
+            'pnl': sim.realised + sim.unrealised(), 'drawdown': sim.drawdown, 'trades': len(sim.fills)}
+
+
+def parse_params(pairs):
+    params = {}
+    for pair in pairs:
+        key, value = pair.split('=', 1)
+        params[key] = float(value) if '.' in value else int(value)
+    return params
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay a recorded tape through a strategy script')
+    parser.add_argument('script', help='e.g. sample-RSIBBP.py')
+    parser.add_argument('tape', help='tape directory written by tape.py')
+    parser.add_argument('params', nargs='*', help='script parameters, e.g. RSI_SPAN=14 BB_SPAN=20')
+    parser.add_argument('--symbol', default='BTCUSDTPERP')
+    parser.add_argument('--out', help='directory to write fills.csv and signals.csv')
+    args = parser.parse_args()
+
+    result = replay(args.script, args.tape, parse_params(args.params), args.symbol)
+    print(f'Trades {result["trades"]}\n'
+          f'Position {result["position"]}\n'
+          f'Realised Pnl {result["realisedPnl"]:.4f}\n'
+          f'Unrealised Pnl {result["unrealisedPnl"]:.4f}\n'
+          f'Max Drawdown {result["drawdown"]:.4f}\n')
+
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+        result['fills'].to_csv(os.path.join(args.out, 'fills.csv'), index=False)
+        result['signals'].to_csv(os.path.join(args.out, 'signals.csv'), index=False)
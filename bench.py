@@ -0,0 +1,320 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+import platform
+import tracemalloc
+from contextlib import redirect_stdout
+from time import perf_counter_ns
+
+import numpy as np
+
+import backfill
+from backtest import SimTrade, load_strategy
+from candles import CandleBuffer
+from metrics import Histogram
+from reconcile import client_oid, ladder
+from runner import load_script
+from tape import TickReader, KIND_INDEX, KIND_TRADE
+
+
+'''
+Benchmarks for the code that runs on every tick or requote, with a stored baseline that slowdowns are checked against.
+Each case times every call into a latency histogram, then repeats a shorter run under tracemalloc for the memory
+each call allocates and keeps. Bots are built through the backtest simulators and orders go to a gateway that does nothing,
+so no network is touched and only the strategy code is measured. Ticks are a seeded random walk, or a recorded tape.
+
+    python bench.py --save                 # write bench-baseline.json
+    python bench.py                        # compare against it, exits non-zero on a regression or no baseline
+    python bench.py --tape tapes/btc --only ohlcv'''
+
+ROWS = (500, 10_000, 100_000)
+PAIRS = (5, 50, 200)
+TICKS_PER_BAR = 20
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class NullGateway:
+    # Order gateway that accepts every request and does nothing, so execute_trade and place_orders time only the bot
+    async def place(self, key=None, **order):
+        return {'orderId': 'bench'}
+
+    async def cancel(self, order_id, prefix=None):
+        return {'cancelledOrderIds': [order_id]}
+
+    async def amend(self, order_id, key=None, **order):
+        return {'orderId': 'bench'}
+
+    async def cancel_many(self, order_ids, prefix=None):
+        return [{'cancelledOrderIds': [order_id]} for order_id in order_ids]
+
+    async def cancel_all(self, symbol):
+        return {'cancelledOrderIds': []}
+
+    def submit(self, coro, label='Order'):
+        try:
+            coro.send(None)
+        except StopIteration:
+            pass
+
+    def shutdown(self):
+        pass
+
+
+def ticks(n, tape=None, kind=KIND_TRADE, seed=0):
+    # n (ts ns, price, size) ticks a bar's worth of TICKS_PER_BAR apart, from the tape's prices when there is one
+    if tape is not None:
+        reader = TickReader(tape)
+        prices = reader['price'][reader['kind'] == kind]
+        if not len(prices):
+            raise ValueError(f'Tape {tape} has no ticks of kind {kind}')
+        prices = np.resize(prices, n)
+    else:
+        prices = 10_000 * np.exp(np.cumsum(np.random.default_rng(seed).normal(0, 0.0005, n)))
+    ts = 1_600_000_000_000_000_000 + np.arange(n, dtype=np.int64) * (60_000_000_000 // TICKS_PER_BAR)
+    size = np.random.default_rng(seed + 1).integers(1, 100, n)
+    return list(zip(ts.tolist(), prices.tolist(), size.tolist()))
+
+
+def build(script, params, rows=None):
+    # A script's bot on the simulators, with its candle buffer capacity set to rows
+    module = load_script(os.path.join(_HERE, script))
+    names = [name for name in ('MAX_ROWS', '_MAX_ROWS') if hasattr(module, name) and rows is not None]
+    saved = {name: getattr(module, name) for name in names}
+    fetch = backfill.fetch
+    try:
+        for name in names:
+            setattr(module, name, rows)
+        # The simulator has no history, skip paging through it within the REST rate limit
+        backfill.fetch = lambda *args, **kwargs: backfill._columns([])
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            _, bot = load_strategy(os.path.join(_HERE, script), SimTrade('BTCUSDTPERP'), 10_000.0, params)
+    finally:
+        backfill.fetch = fetch
+        for name, value in saved.items():
+            setattr(module, name, value)
+    bot.gateway = NullGateway()
+    return bot
+
+
+def bench_ohlc(script, tf, dropna, tick, rows, stream):
+    # Fold ticks into a full candle buffer of rows bars
+    fold = load_script(os.path.join(_HERE, script)).ohlc if tick == 'ohlc' else load_script(os.path.join(_HERE, script)).ohlcv
+    buffer = CandleBuffer(tf=tf, capacity=rows, dropna=dropna)
+    start = stream[0][0] - rows * buffer.tf_ns
+    for i, (_, price, size) in enumerate(ticks(rows, seed=1)):
+        buffer.update(start + i * buffer.tf_ns, price, size)
+
+    if tick == 'ohlc':
+        args = iter([{'timestamp': ts // 1_000_000, 'price': price} for ts, price, _ in stream])
+    else:
+        args = iter([{'ts': ts, 'price': price, 'size': size} for ts, price, size in stream])
+    return lambda: fold(buffer, next(args))
+
+
+def bench_signal(script, params, rows, stream):
+    # Step the indicators and signal state over one closed candle
+    bot = build(script, params, rows)
+    bars = iter([{'ts': ts, 'open': price, 'high': price, 'low': price, 'close': price, 'size': size}
+                 for ts, price, size in stream])
+    return lambda: bot.trade_signal(next(bars))
+
+
+def bench_execute(script, params, rows, stream):
+    # Trade on a new signal each call, alternating sides so every call places an order
+    bot = build(script, params, rows)
+    bot.account.position = dict(bot.account.position, currentQty=0)
+    signals = iter([{'ts': ts, 'close': price, 'Signal': ('buy', 'sell')[i % 2]}
+                    for i, (ts, price, _) in enumerate(stream)])
+
+    def call():
+        bot.signal = next(signals)
+        bot.execute_trade()
+    return call
+
+
+def _mm(pairs):
+    # Market maker with pairs levels live on the book, quoted around a slightly different price to the one it will see
+    bot = build('sample-MM.py', {'INTERVAL': 15, 'MIN_SPREAD': 0.001, 'ORDER_PAIRS': pairs})
+    live = ladder(9_990.0, pairs, 0.001, 5)
+    bot.position = bot.account.position
+    bot.orders = [{'id': f'order-{i}', 'side': side, 'price': str(price), 'size': size,
+                   'clientOid': client_oid(bot.prefix, side, level, size, price, 0)}
+                  for i, (side, level, price, size) in enumerate(zip(live['side'], live['level'].tolist(),
+                                                                     live['price'].tolist(), live['size'].tolist()))]
+    return bot
+
+
+def bench_prepare(pairs, stream):
+    # Plan the ladder against the live orders for a new reference price
+    bot = _mm(pairs)
+    prices = iter([price for _, price, _ in stream])
+
+    def call():
+        bot.latest_tick = next(prices)
+        bot.prepare_orders()
+    return call
+
+
+def bench_place(pairs, stream):
+    # Send one requote's cancels, creates and amends
+    bot = _mm(pairs)
+    bot.latest_tick = 10_050.0
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        bot.prepare_orders()
+    loop = asyncio.new_event_loop()
+    return lambda: loop.run_until_complete(bot.place_orders())
+
+
+def cases(only=None):
+    # (name, tick kind, share of the calls, make(stream)) for every benchmark, the rows and pairs sizes are in the name
+    # The larger ladders take milliseconds a call, so they run fewer
+    rsibbp, mom = {'RSI_SPAN': 14, 'BB_SPAN': 20}, {'SLOW_SIG': 16, 'FAST_SIG': 4}
+    table = []
+    for rows in ROWS:
+        table += [
+            (f'ohlcv/rows={rows}', KIND_TRADE, 1, lambda s, r=rows: bench_ohlc('sample-RSIBBP.py', '1T', True, 'ohlcv', r, s)),
+            (f'ohlc/rows={rows}', KIND_INDEX, 1, lambda s, r=rows: bench_ohlc('sample-MOM.py', '15S', False, 'ohlc', r, s)),
+            (f'rsibbp.trade_signal/rows={rows}', KIND_TRADE, 1,
+             lambda s, r=rows: bench_signal('sample-RSIBBP.py', rsibbp, r, s)),
+            (f'mom.trade_signal/rows={rows}', KIND_INDEX, 1, lambda s, r=rows: bench_signal('sample-MOM.py', mom, r, s)),
+            (f'rsibbp.execute_trade/rows={rows}', KIND_TRADE, 1,
+             lambda s, r=rows: bench_execute('sample-RSIBBP.py', rsibbp, r, s)),
+            (f'mom.execute_trade/rows={rows}', KIND_INDEX, 1, lambda s, r=rows: bench_execute('sample-MOM.py', mom, r, s))]
+    for pairs in PAIRS:
+        share = max(0.1, 5 / pairs)
+        table += [(f'mm.prepare_orders/pairs={pairs}', KIND_INDEX, share, lambda s, p=pairs: bench_prepare(p, s)),
+                  (f'mm.place_orders/pairs={pairs}', KIND_INDEX, share, lambda s, p=pairs: bench_place(p, s))]
+    return [case for case in table if only is None or any(name in case[0] for name in only)]
+
+
+def measure(call, calls, warmup, alloc_calls):
+    # Per call latency in microseconds, and under tracemalloc the bytes kept per call and the peak above the start
+    for _ in range(warmup):
+        call()
+
+    histogram, total = Histogram(), 0
+    for _ in range(calls):
+        start = perf_counter_ns()
+        call()
+        elapsed = perf_counter_ns() - start
+        histogram.record(elapsed)
+        total += elapsed
+
+    # Kept memory is the growth over a second batch of calls, so one off allocations made by the first are not counted
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for _ in range(alloc_calls):
+        call()
+    before = tracemalloc.take_snapshot()
+    for _ in range(alloc_calls):
+        call()
+    peak = tracemalloc.get_traced_memory()[1]
+    kept = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, 'filename'))
+    tracemalloc.stop()
+
+    return {'calls': calls, 'mean_us': total / calls / 1000,
+            'p50_us': histogram.percentile(50) / 1000, 'p99_us': histogram.percentile(99) / 1000,
+            'p99.9_us': histogram.percentile(99.9) / 1000, 'max_us': histogram.max / 1000,
+            'kept_bytes_per_call': max(kept, 0) / alloc_calls, 'peak_bytes': peak - base}
+
+
+def run(only=None, tape=None, calls=2000, rounds=3, warmup=200, alloc_calls=200):
+    # Every case rounds times over, keeping each case's round with the lowest p50, so a burst of noise from elsewhere
+    # on the machine only costs a round rather than the result
+    results = {}
+    for _ in range(rounds):
+        for name, kind, share, make in cases(only):
+            n, n_warmup, n_alloc = (max(1, int(count * share)) for count in (calls, warmup, alloc_calls))
+            stream = ticks(n_warmup + n + 2 * n_alloc, tape, kind)
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                result = measure(make(stream), n, n_warmup, n_alloc)
+            if name not in results or result['p50_us'] < results[name]['p50_us']:
+                results[name] = result
+
+    for name, result in results.items():
+        print(f'{name:<36}{result["p50_us"]:>10.1f}{result["p99_us"]:>10.1f}{result["max_us"]:>10.1f}'
+              f'{result["kept_bytes_per_call"]:>12.0f}{result["peak_bytes"]:>12.0f}', file=sys.stderr)
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'processor': platform.processor(),
+            'source': tape or 'synthetic', 'calls': calls, 'rounds': rounds, 'results': results}
+
+
+def compare(report, baseline, tolerance=0.5, min_us=1.0, min_bytes=1024):
+    '''
+    Regressions against the baseline, a case regresses if its p50 latency grew by more than tolerance and min_us,
+    its p99 by more than four times that, or the memory it keeps per call by more than tolerance and min_bytes.
+    Cases missing from either side are skipped.'''
+    regressions = []
+    for name, now in report['results'].items():
+        then = baseline['results'].get(name)
+        if then is None:
+            continue
+        for key, allowed, floor in (('p50_us', tolerance, min_us), ('p99_us', tolerance * 4, min_us * 4),
+                                    ('kept_bytes_per_call', tolerance, min_bytes)):
+            if now[key] > then[key] * (1 + allowed) and now[key] - then[key] > floor:
+                regressions.append(f'{name} {key} {then[key]:.1f} -> {now[key]:.1f}')
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the per tick and per requote code paths')
+    parser.add_argument('--only', nargs='*', help='run the cases whose name contains any of these, e.g. ohlcv pairs=200')
+    parser.add_argument('--tape', help='tape directory to take tick prices from, instead of a random walk')
+    parser.add_argument('--calls', type=int, default=2000, help='timed calls per case and round')
+    parser.add_argument('--rounds', type=int, default=3, help='times each case is run, the best round is kept')
+    parser.add_argument('--out', default='bench.json', help='where to write this run\'s results')
+    parser.add_argument('--baseline', default='bench-baseline.json')
+    parser.add_argument('--save', action='store_true', help='write this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='slowdown allowed before a case fails, 0.5 is 50%%')
+    args = parser.parse_args()
+
+    print(f'{"case":<36}{"p50_us":>10}{"p99_us":>10}{"max_us":>10}{"kept_B/call":>12}{"peak_B":>12}', file=sys.stderr)
+    report = run(args.only, args.tape, args.calls, args.rounds)
+
+    regressions = []
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            # Measure the regressed cases again over more rounds before failing, keeping the better of the two runs
+            names = sorted({regression.split()[0] for regression in regressions})
+            print(f'Re-measuring {len(names)} regressed cases', file=sys.stderr)
+            for name, result in run(names, args.tape, args.calls, args.rounds * 3)['results'].items():
+                if name in names and result['p50_us'] < report['results'][name]['p50_us']:
+                    report['results'][name] = result
+            regressions = compare(report, baseline, args.tolerance)
+
+    with open(args.baseline if args.save else args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    if args.save:
+        print(f'Baseline written to {args.baseline}')
+    elif not os.path.exists(args.baseline):
+        # Nothing was compared, which must not pass as a clean run
+        print(f'No baseline at {args.baseline}, write one with --save')
+        sys.exit(1)
+    else:
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions')
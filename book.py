@@ -0,0 +1,211 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+import asyncio
+import numpy as np
+
+
+_SCAN = 256         # Slots searched per step when the best level empties
+
+
+class OrderBook:
+    '''
+    Local level 2 book kept from the /contractMarket/level2 deltas, with a REST snapshot to start from and to resync.
+    Each side is an array with one slot per tick on a fixed price grid, so a change and the depth at a price are one index.
+    The best bid and ask are tracked as slots, only a change that empties the best level searches for the next one.
+    The grid is centred on the book at each snapshot, and re-centred once the middle of the touch drifts into its outer quarters.
+    Changes that fall off the grid are far from the touch, they are dropped and counted in outside.
+    A gap in the sequence marks the book unsynced, deltas are buffered until sync_loop has applied a fresh snapshot.'''
+
+    def __init__(self, symbol, tick_size, levels=1 << 16):
+        self.symbol = symbol
+        self.topic = f'/contractMarket/level2:{symbol}'
+        self.tick = float(tick_size)
+        self.levels = levels
+
+        self.bids = np.zeros(levels)
+        self.asks = np.zeros(levels)
+        self.base = 0                   # Grid slot 0 is this many ticks
+        self.bid = -1                   # Best bid slot, -1 if there are no bids
+        self.ask = levels               # Best ask slot, levels if there are no asks
+
+        self.sequence = None
+        self.synced = False
+        self.gaps = self.outside = 0
+        self._pending = []
+        self._wake = None
+
+    # Queries
+    def best_bid(self):
+        return (self.base + self.bid) * self.tick if self.bid >= 0 else None
+
+    def best_ask(self):
+        return (self.base + self.ask) * self.tick if self.ask < self.levels else None
+
+    def depth(self, price, side):
+        # Size resting at price on side, 'buy' or 'sell'
+        slot = round(price / self.tick) - self.base
+        if not 0 <= slot < self.levels:
+            return 0.0
+        return float((self.bids if side == 'buy' else self.asks)[slot])
+
+    def microprice(self):
+        # Touch prices weighted by the size on the opposite side, None until both sides are quoted
+        if not self.synced or self.bid < 0 or self.ask >= self.levels:
+            return None
+        bid_size, ask_size = self.bids[self.bid], self.asks[self.ask]
+        return (self.best_bid() * ask_size + self.best_ask() * bid_size) / (bid_size + ask_size)
+
+    # Updates
+    def on_message(self, msg):
+        # Apply a level 2 delta, returns False if the message is not for this book
+        if msg.get('topic') != self.topic:
+            return False
+
+        data = msg['data']
+        sequence = int(data['sequence'])
+        if not self.synced:
+            self._pending.append(data)
+            self._want_snapshot()
+        elif sequence == self.sequence + 1:
+            price, side, size = data['change'].split(',')
+            self.change(float(price), side, float(size))
+            self.sequence = sequence
+        elif sequence > self.sequence:
+            self.gaps += 1
+            self.synced = False
+            self._pending = [data]
+            self._want_snapshot()
+        return True
+
+    def change(self, price, side, size):
+        slot = round(price / self.tick) - self.base
+        if not 0 <= slot < self.levels:
+            self.outside += 1
+            return
+
+        if side == 'buy':
+            self.bids[slot] = size
+            if size:
+                if slot > self.bid:
+                    self.bid = slot
+            elif slot == self.bid:
+                self.bid = self._below(self.bids, slot)
+        else:
+            self.asks[slot] = size
+            if size:
+                if slot < self.ask:
+                    self.ask = slot
+            elif slot == self.ask:
+                self.ask = self._above(self.asks, slot)
+
+        if self.bid >= 0 and self.ask < self.levels and abs(self.bid + self.ask - self.levels) > self.levels >> 1:
+            self._recentre()
+
+    def load(self, snapshot):
+        # Replace the book with a REST snapshot, {'sequence', 'bids': [[price, size], ..], 'asks': [..]}
+        bids = [(float(price), float(size)) for price, size in snapshot['bids']]
+        asks = [(float(price), float(size)) for price, size in snapshot['asks']]
+        touch = [prices[0][0] for prices in (bids, asks) if prices]
+        centre = sum(touch) / len(touch) if touch else 0.0
+
+        self.base = round(centre / self.tick) - self.levels // 2
+        self.bids[:] = 0
+        self.asks[:] = 0
+        for book, levels in ((self.bids, bids), (self.asks, asks)):
+            for price, size in levels:
+                slot = round(price / self.tick) - self.base
+                if 0 <= slot < self.levels:
+                    book[slot] = size
+                else:
+                    self.outside += 1
+
+        self.bid = self._below(self.bids, self.levels)
+        self.ask = self._above(self.asks, -1)
+        self.sequence = int(snapshot['sequence'])
+        self.synced = True
+
+    def resync(self, snapshot):
+        # Load a snapshot then apply the deltas buffered while it was fetched, keeping any that are still ahead of it
+        pending, self._pending = self._pending, []
+        self.load(snapshot)
+        for data in pending:
+            self.on_message({'topic': self.topic, 'data': data})
+
+    def invalidate(self):
+        # Deltas may have been missed, e.g. while the websocket was down, the next one asks sync_loop for a fresh snapshot
+        self.synced = False
+        self._pending = []
+
+    async def sync_loop(self, market):
+        # Fetch a snapshot off the event loop whenever the book needs one
+        loop = asyncio.get_event_loop()
+        wanted = asyncio.Event()
+        self._wake = wanted.set
+        if not self.synced:
+            wanted.set()
+
+        while True:
+            await wanted.wait()
+            wanted.clear()
+            try:
+                snapshot = await loop.run_in_executor(None, market.get_l2_order_book, self.symbol)
+                self.resync(snapshot)
+            except Exception as e:
+                print(f'Order Book Error!\n {e!r}')
+                await asyncio.sleep(1)
+                wanted.set()
+
+    def _want_snapshot(self):
+        if self._wake is not None:
+            self._wake()
+
+    def _below(self, book, slot):
+        # Highest occupied slot below slot, -1 if there is none
+        while slot > 0:
+            low = max(0, slot - _SCAN)
+            occupied = np.flatnonzero(book[low:slot])
+            if len(occupied):
+                return low + int(occupied[-1])
+            slot = low
+        return -1
+
+    def _above(self, book, slot):
+        # Lowest occupied slot above slot, levels if there is none
+        slot += 1
+        while slot < self.levels:
+            high = min(self.levels, slot + _SCAN)
+            occupied = np.flatnonzero(book[slot:high])
+            if len(occupied):
+                return slot + int(occupied[0])
+            slot = high
+        return self.levels
+
+    def _recentre(self):
+        # Shift the grid so the touch is back in the middle, levels shifted off the far edge are dropped
+        shift = (self.bid + self.ask) // 2 - self.levels // 2
+        for book in (self.bids, self.asks):
+            if shift > 0:
+                book[:-shift] = book[shift:]
+                book[-shift:] = 0
+            else:
+                book[-shift:] = book[:self.levels + shift]
+                book[:-shift] = 0
+
+        self.base += shift
+        self.bid = self._below(self.bids, self.levels)
+        self.ask = self._above(self.asks, -1)
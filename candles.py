@@ -0,0 +1,270 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+import re
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ('open', 'high', 'low', 'close', 'size')
+_TF_UNITS = {'S': 1, 'T': 60, 'MIN': 60, 'H': 3600, 'D': 86400}
+
+
+def tf_to_ns(tf):
+    # Convert a resample style timeframe, e.g. 15S, 1T, 5T, 1H, into nanoseconds
+    match = re.fullmatch(r'(\d*)([A-Za-z]+)', tf)
+    if match is None or match.group(2).upper() not in _TF_UNITS:
+        raise ValueError(f'Unsupported timeframe {tf}')
+
+    return int(match.group(1) or 1) * _TF_UNITS[match.group(2).upper()] * 1_000_000_000
+
+
+class CandleBuffer:
+    '''
+    Streaming OHLCV candles built one tick at a time, replacing a full DataFrame resample per tick.
+    Only the forming bar is touched on a tick, it is written to the buffer when a tick lands past its timeframe boundary.
+    Bars are binned the same way pandas resample bins them, set dropna=False to keep the empty bars resample leaves in gaps.
+    Closed bars are stored twice in arrays of twice the capacity, so the latest bars are always one contiguous read only slice.
+    Ticks are expected in time order, a late tick is folded into the forming bar.'''
+
+    def __init__(self, tf='1T', capacity=500, dropna=True):
+        self.tf = tf
+        self.tf_ns = tf_to_ns(tf)
+        self.capacity = capacity
+        self.dropna = dropna
+
+        self._ts = np.zeros(2 * capacity, dtype=np.int64)
+        self._bars = np.full((len(COLUMNS), 2 * capacity), np.nan)
+        self._head = 0
+        self._count = 0
+
+        # Forming bar, and the time of the last tick folded in
+        self.start = None
+        self.last_ts = None
+        self.open = self.high = self.low = self.close = np.nan
+        self.size = 0
+
+    def __len__(self):
+        return self._count
+
+    def update(self, ts, price, size=0):
+        # Add a tick, ts in nanoseconds. Returns the number of bars the tick closed, including empty gap bars
+        start = ts - ts % self.tf_ns
+        self.last_ts = ts
+
+        if self.start is None or start > self.start:
+            closed = 0
+            if self.start is not None:
+                self._push(self.start, self.open, self.high, self.low, self.close, self.size)
+                closed += 1
+                if not self.dropna:
+                    gap_start = max(self.start + self.tf_ns, start - self.capacity * self.tf_ns)
+                    for gap_ts in range(gap_start, start, self.tf_ns):
+                        self._push(gap_ts, np.nan, np.nan, np.nan, np.nan, 0)
+                        closed += 1
+
+            self.start = start
+            self.open = self.high = self.low = self.close = price
+            self.size = size
+            return closed
+
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.size += size
+        return 0
+
+    def extend(self, bars):
+        '''
+        Append bars closed elsewhere, e.g. published by feed.py, a dict of column arrays oldest first like closed().
+        Bars at or before the last one held are skipped, so ticks and published bars can fill the same buffer in turn.
+        A published bar replaces the bar forming here. Returns the number of bars appended.'''
+        last = int(self._ts[(self._head - 1) % self.capacity]) if self._count else None
+        n = 0
+        for bar in zip(bars['ts'].tolist(), *(bars[column].tolist() for column in COLUMNS)):
+            if last is None or bar[0] > last:
+                self._push(*bar)
+                last = bar[0]
+                n += 1
+
+        if n:
+            if self.start is not None and self.start <= last:
+                self.drop_forming()
+            self.last_ts = max(self.last_ts or 0, last + self.tf_ns - 1)
+        return n
+
+    def drop_forming(self):
+        # Forget the forming bar, so it can be rebuilt whole from another source such as REST klines
+        self.start = None
+        self.open = self.high = self.low = self.close = np.nan
+        self.size = 0
+
+    def _push(self, ts, *bar):
+        head = self._head
+        self._ts[head] = self._ts[head + self.capacity] = ts
+        self._bars[:, head] = self._bars[:, head + self.capacity] = bar
+
+        self._head = (head + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def snapshot(self):
+        # Copies of the arrays and the scalar state, for a warm start snapshot
+        state = {'tf': self.tf, 'capacity': self.capacity, 'dropna': self.dropna, 'head': self._head,
+                 'count': self._count, 'start': self.start, 'last_ts': self.last_ts,
+                 'bar': [self.open, self.high, self.low, self.close, self.size]}
+        return {'ts': self._ts.copy(), 'bars': self._bars.copy()}, state
+
+    def restore(self, arrays, state):
+        # Load a snapshot taken from a buffer with the same timeframe, capacity and dropna
+        if (state['tf'], state['capacity'], state['dropna']) != (self.tf, self.capacity, self.dropna):
+            raise ValueError(f'Snapshot candles are {state["tf"]} x {state["capacity"]}, dropna={state["dropna"]}, '
+                             f'expected {self.tf} x {self.capacity}, dropna={self.dropna}')
+
+        self._ts[:] = arrays['ts']
+        self._bars[:] = arrays['bars']
+        self._head, self._count = state['head'], state['count']
+        self.start, self.last_ts = state['start'], state['last_ts']
+        self.open, self.high, self.low, self.close, self.size = state['bar']
+
+    def closed(self, n=None):
+        # Read only views of the last n closed bars, oldest first, keyed by ts and column name
+        n = self._count if n is None else min(n, self._count)
+        end = self._head + self.capacity if self._head else 2 * self.capacity
+
+        view = {'ts': self._ts[end - n:end]}
+        for i, column in enumerate(COLUMNS):
+            view[column] = self._bars[i, end - n:end]
+        for arr in view.values():
+            arr.flags.writeable = False
+
+        return view
+
+    def _recent(self, n):
+        # The last n closed bars as (ts, open, high, low, close, size) tuples of plain values, oldest first
+        n = min(n, self._count)
+        end = self._head + self.capacity if self._head else 2 * self.capacity
+        return zip(self._ts[end - n:end].tolist(), *self._bars[:, end - n:end].tolist())
+
+    def to_frame(self, columns=COLUMNS, forming=True):
+        # DataFrame of the closed bars, with the forming bar as the last row to match the resample output
+        view = self.closed()
+        data = {column: view[column] for column in columns}
+        index = view['ts']
+
+        if forming and self.start is not None:
+            forming_bar = dict(zip(COLUMNS, (self.open, self.high, self.low, self.close, self.size)))
+            data = {column: np.append(data[column], forming_bar[column]) for column in columns}
+            index = np.append(index, self.start)
+
+        return pd.DataFrame(data, index=pd.DatetimeIndex(pd.to_datetime(index, unit='ns'), name='ts'))
+
+
+class RollupBuffer(CandleBuffer):
+    '''
+    Candles of a coarser timeframe folded from the finished bars of a finer one rather than from ticks.
+    The forming bar only holds finished finer bars, it closes as soon as a tick lands past its end.'''
+
+    def __init__(self, tf='5T', capacity=500, dropna=True):
+        super().__init__(tf, capacity, dropna)
+        self._last = None       # Start of the last closed bar, for the empty bars left in gaps
+
+    def roll(self, finer, n, ts):
+        # Fold the last n bars closed in finer, then close the forming bar if ts is past its end. Returns bars closed
+        closed = 0
+        for bar_ts, bar_open, high, low, close, size in finer._recent(n):
+            if bar_open != bar_open:
+                continue            # Empty gap bars carry no prices
+            start = bar_ts - bar_ts % self.tf_ns
+
+            if self.start is not None and start > self.start:
+                closed += self._close()
+            if self.start is None:
+                closed += self._gaps(start)
+                self.start = start
+                self.open, self.high, self.low, self.size = bar_open, high, low, size
+            else:
+                if high > self.high:
+                    self.high = high
+                if low < self.low:
+                    self.low = low
+                self.size += size
+            self.close = close
+            self.last_ts = bar_ts
+
+        if self.start is not None and ts >= self.start + self.tf_ns:
+            closed += self._close()
+        return closed
+
+    def _close(self):
+        self._push(self.start, self.open, self.high, self.low, self.close, self.size)
+        self._last, self.start = self.start, None
+        return 1
+
+    def _gaps(self, start):
+        if self.dropna or self._last is None:
+            return 0
+        gap_start = max(self._last + self.tf_ns, start - self.capacity * self.tf_ns)
+        for gap_ts in range(gap_start, start, self.tf_ns):
+            self._push(gap_ts, np.nan, np.nan, np.nan, np.nan, 0)
+        return len(range(gap_start, start, self.tf_ns))
+
+
+class CandleStore:
+    '''
+    Candles in several timeframes from one tick stream. Only the finest timeframe is built from ticks, each coarser one is
+    rolled up from the finished bars of the one below it, so every timeframe must be a whole number of the one before.
+    A tick that closes no bar in the finest timeframe cannot close a coarser one, so extra timeframes cost nothing until then.
+    Each timeframe keeps its own bounded history, store[tf] is its buffer. on_close(tf, callback) calls callback(buffer, n)
+    whenever n bars of tf close, finer timeframes first.'''
+
+    def __init__(self, tfs=('15S', '1T', '5T'), capacity=500, dropna=True):
+        tfs = sorted(tfs, key=tf_to_ns)
+        for finer, tf in zip(tfs, tfs[1:]):
+            if tf_to_ns(tf) % tf_to_ns(finer):
+                raise ValueError(f'{tf} is not a whole number of {finer} bars')
+
+        self.buffers = {tfs[0]: CandleBuffer(tfs[0], capacity, dropna)}
+        self.buffers.update({tf: RollupBuffer(tf, capacity, dropna) for tf in tfs[1:]})
+        self.finest = self.buffers[tfs[0]]
+        self._chain = list(zip(list(self.buffers.values()), list(self.buffers.values())[1:]))
+        self._callbacks = {buffer: [] for buffer in self.buffers.values()}
+
+    def __getitem__(self, tf):
+        return self.buffers[tf]
+
+    def on_close(self, tf, callback):
+        self._callbacks[self.buffers[tf]].append(callback)
+
+    def update(self, ts, price, size=0):
+        # Add a tick, ts in nanoseconds. Returns the number of bars it closed in the finest timeframe
+        closed = n = self.finest.update(ts, price, size)
+        if not n:
+            return 0
+
+        self._notify(self.finest, n)
+        for finer, buffer in self._chain:
+            if n or (buffer.start is not None and ts >= buffer.start + buffer.tf_ns):
+                n = buffer.roll(finer, n, ts)
+                if n:
+                    self._notify(buffer, n)
+        return closed
+
+    def _notify(self, buffer, n):
+        for callback in self._callbacks[buffer]:
+            callback(buffer, n)
@@ -0,0 +1,621 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+import threading
+from bisect import insort, bisect_left
+from collections import deque
+from contextlib import redirect_stdout
+from itertools import count
+from math import exp, inf
+from time import perf_counter, sleep, time_ns
+
+from gateway import OrderGateway
+from metrics import Metrics
+from runner import Runner, load_script
+from sweep import parse_grid
+
+
+'''
+Local stand in for the Poloniex futures REST and websocket APIs, for load testing the bots offline without keys.
+Exchange has the market and trade API methods the bots call, a price time priority matching engine per symbol,
+post only rejection, and position, wallet and liquidation bookkeeping for the one account.
+A generator thread plays the rest of the market, moving the index, refreshing resting depth and sending market orders
+through the book, at a set number of public messages per second.
+RestClient and WsClient take the place of the polofutures clients, so a runner built on them runs unchanged.
+
+    python exchange.py bots.json --rate 1000:20000:1000 --step 10
+
+raises the message rate a step at a time and reports the highest rate each config sustains before lagging.'''
+
+_OTHER = {'buy': 'sell', 'sell': 'buy'}
+
+
+class Book:
+    '''
+    Limit order book for one symbol, orders at a price fill in the order they arrived.'''
+
+    def __init__(self):
+        self.levels = {'buy': {}, 'sell': {}}
+        self.prices = {'buy': [], 'sell': []}
+
+    def best(self, side):
+        prices = self.prices[side]
+        if not prices:
+            return None
+        return prices[-1] if side == 'buy' else prices[0]
+
+    def crosses(self, side, price):
+        best = self.best(_OTHER[side])
+        return best is not None and (price >= best if side == 'buy' else price <= best)
+
+    def match(self, order):
+        # Fill an order against the resting orders it crosses, best price first, returns the (maker, price, size) fills
+        fills = []
+        other = _OTHER[order['side']]
+        while order['remaining'] and self.crosses(order['side'], order['price']):
+            price = self.best(other)
+            queue = self.levels[other][price]
+            maker = queue[0]
+            size = min(order['remaining'], maker['remaining'])
+            maker['remaining'] -= size
+            order['remaining'] -= size
+            fills.append((maker, price, size))
+            if not maker['remaining']:
+                queue.popleft()
+                if not queue:
+                    self._drop(other, price)
+        return fills
+
+    def rest(self, order):
+        side, price = order['side'], order['price']
+        queue = self.levels[side].get(price)
+        if queue is None:
+            queue = self.levels[side][price] = deque()
+            insort(self.prices[side], price)
+        queue.append(order)
+
+    def remove(self, order):
+        side, price = order['side'], order['price']
+        queue = self.levels[side][price]
+        queue.remove(order)
+        if not queue:
+            self._drop(side, price)
+
+    def size(self, side, price):
+        return sum(order['remaining'] for order in self.levels[side].get(price, ()))
+
+    def depth(self, side):
+        # [price, size] levels, best first
+        prices = self.prices[side][::-1] if side == 'buy' else self.prices[side]
+        return [[price, self.size(side, price)] for price in prices]
+
+    def _drop(self, side, price):
+        del self.levels[side][price]
+        prices = self.prices[side]
+        del prices[bisect_left(prices, price)]
+
+
+class Instrument:
+    # Book, prices, market data history and the account's position for one symbol
+    def __init__(self, symbol, price, tick_size):
+        self.symbol = symbol
+        self.tick_size = tick_size
+        self.book = Book()
+        self.index = self.mark = price
+        self.sequence = 0
+        self.trades = deque(maxlen=100)
+        self.index_points = deque(maxlen=86_400)
+        self.klines = deque(maxlen=1440)
+        self.crowd = {}
+
+        self.qty = 0
+        self.entry = 0.0
+        self.leverage = 1.0
+        self.realised = 0.0
+        self.liquidations = 0
+
+
+class Exchange:
+    '''
+    Matching engine, account and market data for a set of symbols at their starting prices.
+    Orders and positions are in lots of multiplier coins, margin is isolated per symbol at the order's leverage.
+    The gateway calls the trade API from worker threads and the generator runs in its own thread, so one lock guards all state.
+    Websocket messages are appended to messages for a WsClient to deliver.'''
+
+    def __init__(self, prices, tick_size=1.0, multiplier=0.001, maint_margin=0.005, balance=10_000.0,
+                 volatility=0.0002, depth=20, max_size=100, mix=None, seed=None):
+        self.instruments = {symbol: Instrument(symbol, price, tick_size) for symbol, price in prices.items()}
+        self.multiplier = multiplier
+        self.maint_margin = maint_margin
+        self.balance = balance
+        self.volatility = volatility
+        self.depth = depth
+        self.max_size = max_size
+        self.mix = mix or {'instrument': 1, 'level2': 2, 'execution': 1}
+
+        self.messages = deque()
+        self.orders = {}
+        self.lock = threading.RLock()
+        self.random = random.Random(seed)
+        self._ids = count(1)
+        self._trade_ids = count(1)
+        self._crowd_ids = count(1)
+
+        self.rate = 0
+        self.generated = 0
+        self.placed = self.rejected = self.cancelled = self.filled = 0
+        self._stop = threading.Event()
+
+        for instrument in self.instruments.values():
+            for _ in range(self.depth * 2):
+                self._refresh(instrument, time_ns())
+
+    # polofutures market API
+    def get_current_mark_price(self, symbol):
+        with self.lock:
+            instrument = self.instruments[symbol]
+            return {'symbol': symbol, 'granularity': 1000, 'timePoint': time_ns() // 1_000_000,
+                    'value': instrument.mark, 'indexPrice': instrument.index}
+
+    def get_contract_detail(self, symbol):
+        return {'symbol': symbol, 'tickSize': self.instruments[symbol].tick_size, 'multiplier': self.multiplier,
+                'maintainMargin': self.maint_margin}
+
+    def get_ticker(self, symbol):
+        with self.lock:
+            instrument = self.instruments[symbol]
+            trade = instrument.trades[-1] if instrument.trades else {}
+            return {'symbol': symbol, 'sequence': instrument.sequence, 'price': trade.get('price', instrument.index),
+                    'bestBidPrice': instrument.book.best('buy'), 'bestAskPrice': instrument.book.best('sell'),
+                    'ts': time_ns()}
+
+    def get_l2_order_book(self, symbol):
+        with self.lock:
+            instrument = self.instruments[symbol]
+            return {'symbol': symbol, 'sequence': instrument.sequence,
+                    'bids': instrument.book.depth('buy'), 'asks': instrument.book.depth('sell')}
+
+    def get_trade_history(self, symbol):
+        with self.lock:
+            return list(self.instruments[symbol].trades)[::-1]
+
+    def get_index_list(self, symbol, startAt=0, endAt=None, forward=True, maxCount=10, **kwargs):
+        # Index history by the second, index symbols such as .PXBTUSDT have none
+        with self.lock:
+            instrument = self.instruments.get(symbol)
+            points = [(t, value) for t, value in (instrument.index_points if instrument else ())
+                      if startAt <= t and (endAt is None or t <= endAt)]
+        points = points[:maxCount] if forward else points[-maxCount:]
+        return {'dataList': [{'symbol': symbol, 'granularity': 1000, 'timePoint': t, 'value': value}
+                             for t, value in points], 'hasMore': False}
+
+    def get_kline_data(self, symbol, granularity, begin_t=None, end_t=None):
+        # [time, open, high, low, close, volume] bars of granularity minutes, built from the trades
+        step = int(granularity) * 60_000
+        bars = {}
+        with self.lock:
+            for t, o, h, l, c, v in self.instruments[symbol].klines:
+                start = t - t % step
+                if (begin_t is None or start >= begin_t) and (end_t is None or start < end_t):
+                    bar = bars.get(start)
+                    if bar is None:
+                        bars[start] = [start, o, h, l, c, v]
+                    else:
+                        bar[2], bar[3], bar[4], bar[5] = max(bar[2], h), min(bar[3], l), c, bar[5] + v
+        return list(bars.values())
+
+    # polofutures trade API
+    def create_limit_order(self, symbol, side, leverage, size, price, postOnly=False, clientOid=None, **kwargs):
+        with self.lock:
+            instrument = self.instruments[symbol]
+            price = round(float(price) / instrument.tick_size) * instrument.tick_size
+            if postOnly and instrument.book.crosses(side, price):
+                self.rejected += 1
+                raise ValueError(f'Post only order {side} {size} at {price} would cross the book')
+
+            order = {'id': f'local-{next(self._ids)}', 'symbol': symbol, 'side': side, 'price': price,
+                     'size': int(size), 'remaining': int(size), 'leverage': float(leverage), 'clientOid': clientOid,
+                     'account': True, 'createdAt': time_ns() // 1_000_000}
+            instrument.leverage = float(leverage)
+            self.placed += 1
+            self.orders[order['id']] = order
+            self._order_event(order, 'open', time_ns())
+            self._submit(instrument, order, time_ns())
+            return {'orderId': order['id']}
+
+    def cancel_order(self, order_id):
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None:
+                raise ValueError(f'Order {order_id} not found')
+            self._cancel(order, time_ns())
+            return {'cancelledOrderIds': [order_id]}
+
+    def cancel_all_limit_orders(self, symbol):
+        with self.lock:
+            ids = [order_id for order_id, order in self.orders.items() if order['symbol'] == symbol]
+            now = time_ns()
+            for order_id in ids:
+                self._cancel(self.orders[order_id], now)
+            return {'cancelledOrderIds': ids}
+
+    def get_order_list(self, status='active', **kwargs):
+        with self.lock:
+            return {'items': [self._view(order) for order in self.orders.values()] if status == 'active' else []}
+
+    def get_position_details(self, symbol):
+        with self.lock:
+            return self._position(self.instruments[symbol])
+
+    # Matching and bookkeeping, called with the lock held
+    def _submit(self, instrument, order, ts):
+        # Match an order, then rest what is left of a limit order, market orders have an infinite price
+        book = instrument.book
+        for maker, price, size in book.match(order):
+            self._trade(instrument, order, maker, price, size, ts)
+            self._level(instrument, _OTHER[order['side']], price, ts)
+
+        if order['remaining'] and abs(order['price']) != inf:
+            book.rest(order)
+            self._level(instrument, order['side'], order['price'], ts)
+        elif order.get('account') and order['id'] in self.orders:
+            del self.orders[order['id']]
+
+    def _trade(self, instrument, taker, maker, price, size, ts):
+        trade = {'symbol': instrument.symbol, 'sequence': instrument.sequence, 'tradeId': f'{next(self._trade_ids)}',
+                 'side': taker['side'], 'size': size, 'price': price, 'ts': ts,
+                 'takerOrderId': taker.get('id', ''), 'makerOrderId': maker.get('id', '')}
+        instrument.trades.append(trade)
+        self._publish(f'/contractMarket/execution:{instrument.symbol}', 'match', trade)
+
+        minute = ts // 1_000_000 - ts // 1_000_000 % 60_000
+        bar = instrument.klines[-1] if instrument.klines else None
+        if bar is None or bar[0] != minute:
+            instrument.klines.append([minute, price, price, price, price, size])
+        else:
+            bar[2], bar[3], bar[4], bar[5] = max(bar[2], price), min(bar[3], price), price, bar[5] + size
+
+        for order in (taker, maker):
+            if order.get('account'):
+                self._fill(instrument, order, price, size, ts)
+
+    def _fill(self, instrument, order, price, size, ts):
+        signed = size if order['side'] == 'buy' else -size
+        qty = instrument.qty
+        if qty == 0 or (qty > 0) == (signed > 0):
+            instrument.entry = (instrument.entry * abs(qty) + price * size) / (abs(qty) + size)
+        else:
+            closing = min(abs(qty), size)
+            self._realise(instrument, closing * (price - instrument.entry) * self.multiplier * (1 if qty > 0 else -1))
+            if size > abs(qty):
+                instrument.entry = price
+        instrument.qty += signed
+        if instrument.qty == 0:
+            instrument.entry = 0.0
+
+        self.filled += 1
+        if not order['remaining']:
+            self.orders.pop(order['id'], None)
+        self._order_event(order, 'filled' if not order['remaining'] else 'match', ts, matchSize=size)
+        self._publish(f'/contract/position:{instrument.symbol}', 'position.change', self._position(instrument))
+
+    def _realise(self, instrument, pnl):
+        instrument.realised += pnl
+        self.balance += pnl
+        self._publish('/contractAccount/wallet', 'availableBalance.change',
+                      {'currency': 'USDT', 'availableBalance': self.balance, 'timestamp': time_ns() // 1_000_000})
+
+    def _cancel(self, order, ts):
+        instrument = self.instruments[order['symbol']]
+        instrument.book.remove(order)
+        self._level(instrument, order['side'], order['price'], ts)
+        if order.get('account'):
+            del self.orders[order['id']]
+            self.cancelled += 1
+            self._order_event(order, 'canceled', ts)
+
+    def _liquidation_price(self, instrument):
+        if not instrument.qty:
+            return 0
+        buffer = 1 / instrument.leverage - self.maint_margin
+        return instrument.entry * (1 - buffer if instrument.qty > 0 else 1 + buffer)
+
+    def _liquidate(self, instrument, ts):
+        # Mark price crossed the liquidation price, cancel the symbol's orders and close the position there
+        price = self._liquidation_price(instrument)
+        if not instrument.qty or (instrument.mark > price if instrument.qty > 0 else instrument.mark < price):
+            return
+
+        for order in [order for order in self.orders.values() if order['symbol'] == instrument.symbol]:
+            self._cancel(order, ts)
+        self._realise(instrument, instrument.qty * (price - instrument.entry) * self.multiplier)
+        instrument.qty, instrument.entry = 0, 0.0
+        instrument.liquidations += 1
+        self._publish(f'/contract/position:{instrument.symbol}', 'position.change',
+                      dict(self._position(instrument), changeReason='liquidation'))
+
+    def _position(self, instrument):
+        unrealised = instrument.qty * (instrument.mark - instrument.entry) * self.multiplier
+        margin = abs(instrument.qty) * instrument.entry * self.multiplier / instrument.leverage
+        return {'symbol': instrument.symbol, 'currentQty': instrument.qty, 'avgEntryPrice': instrument.entry,
+                'liquidationPrice': self._liquidation_price(instrument), 'markPrice': instrument.mark,
+                'realisedPnl': instrument.realised, 'unrealisedPnl': unrealised,
+                'unrealisedRoePcnt': unrealised / margin if margin else 0}
+
+    def _view(self, order):
+        return {'id': order['id'], 'symbol': order['symbol'], 'side': order['side'], 'price': str(order['price']),
+                'size': order['size'], 'filledSize': order['size'] - order['remaining'],
+                'leverage': str(order['leverage']), 'clientOid': order['clientOid'], 'createdAt': order['createdAt']}
+
+    def _order_event(self, order, kind, ts, **extra):
+        status = 'open' if kind in ('open', 'match') else 'done'
+        self._publish('/contractMarket/tradeOrders', 'orderChange',
+                      dict(self._view(order), orderId=order['id'], type=kind, status=status,
+                           remainSize=order['remaining'], ts=ts, **extra))
+
+    def _level(self, instrument, side, price, ts):
+        instrument.sequence += 1
+        self._publish(f'/contractMarket/level2:{instrument.symbol}', 'level2',
+                      {'sequence': instrument.sequence, 'change': f'{price},{side},{instrument.book.size(side, price)}',
+                       'timestamp': ts // 1_000_000})
+
+    def _publish(self, topic, subject, data):
+        self.messages.append({'topic': topic, 'type': 'message', 'subject': subject, 'data': data})
+
+    # Market generator
+    def _move(self, instrument, ts):
+        instrument.index *= exp(self.random.gauss(0, self.volatility))
+        instrument.mark = instrument.index * (1 + self.random.gauss(0, self.volatility / 4))
+        second = ts // 1_000_000_000 * 1000
+        if not instrument.index_points or instrument.index_points[-1][0] != second:
+            instrument.index_points.append((second, instrument.index))
+        self._publish(f'/contract/instrument:{instrument.symbol}', 'mark.index.price',
+                      {'granularity': 1000, 'indexPrice': instrument.index, 'markPrice': instrument.mark,
+                       'timestamp': ts // 1_000_000})
+        self._liquidate(instrument, ts)
+
+    def _refresh(self, instrument, ts):
+        # Replace the other participants' order at a random level near the index, it may trade if the index has moved
+        side = self.random.choice(('buy', 'sell'))
+        offset = self.random.randint(1, self.depth) * instrument.tick_size
+        price = round((instrument.index - offset if side == 'buy' else instrument.index + offset) / instrument.tick_size)
+        price *= instrument.tick_size
+
+        order = instrument.crowd.pop((side, price), None)
+        if order is not None and order['remaining']:
+            self._cancel(order, ts)
+        size = self.random.randint(0, self.max_size * 4)
+        if size:
+            order = {'id': f'crowd-{next(self._crowd_ids)}', 'symbol': instrument.symbol, 'side': side, 'price': price,
+                     'remaining': size}
+            instrument.crowd[(side, price)] = order
+            self._submit(instrument, order, ts)
+
+    def _take(self, instrument, ts):
+        # A market order from another participant, printed at the index when that side of the book is empty
+        side = self.random.choice(('buy', 'sell'))
+        order = {'id': f'crowd-{next(self._crowd_ids)}', 'side': side, 'price': inf if side == 'buy' else -inf,
+                 'remaining': self.random.randint(1, self.max_size)}
+        if instrument.book.best(_OTHER[side]) is None:
+            self._trade(instrument, order, {}, instrument.index, order['remaining'], ts)
+        else:
+            self._submit(instrument, order, ts)
+
+    def step(self, n):
+        # Generate n public market events across the symbols
+        events = {'instrument': self._move, 'level2': self._refresh, 'execution': self._take}
+        kinds, weights = list(self.mix), list(self.mix.values())
+        instruments = list(self.instruments.values())
+        with self.lock:
+            for kind in self.random.choices(kinds, weights, k=n):
+                events[kind](self.random.choice(instruments), time_ns())
+            self.generated += n
+
+    def generate(self, batch=500):
+        # Generator thread, keeps up with rate events per second until stopped, rate may change while it runs
+        credit, at = 0.0, perf_counter()
+        while not self._stop.is_set():
+            now = perf_counter()
+            credit = min(credit + (now - at) * self.rate, max(self.rate, batch))
+            at = now
+            if credit < 1:
+                sleep(0.0005)
+                continue
+            n = min(int(credit), batch)
+            self.step(n)
+            credit -= n
+
+    def start(self, rate):
+        self.rate = rate
+        self._stop.clear()
+        thread = threading.Thread(target=self.generate, name='exchange-generator', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+
+class RestClient:
+    # Stand in for polofutures.RestClient, both APIs are served by the exchange
+    def __init__(self, key, secret, passphrase, exchange):
+        self.exchange = exchange
+
+    def market_api(self):
+        return self.exchange
+
+    def trade_api(self):
+        return self.exchange
+
+
+class WsClient:
+    '''
+    Stand in for polofutures.WsClient, hands the exchange's messages on subscribed topics to callback on the event loop.'''
+
+    def __init__(self, callback, key, secret, passphrase, exchange):
+        self.callback = callback
+        self.exchange = exchange
+        self.topics = set()
+        self._task = None
+
+    async def connect(self):
+        self._task = asyncio.ensure_future(self._deliver())
+
+    async def subscribe(self, topic):
+        self.topics.add(topic)
+
+    async def disconnect(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _deliver(self):
+        messages = self.exchange.messages
+        while True:
+            for _ in range(len(messages)):
+                msg = messages.popleft()
+                if msg['topic'] in self.topics:
+                    self.callback(msg)
+            await asyncio.sleep(0.0005)
+
+
+def check_account(runner, exchange):
+    # Differences between the runner's account caches and the exchange, an empty list when they agree
+    problems = []
+    for symbol, account in runner.accounts.items():
+        position = exchange.get_position_details(symbol)
+        if account.position['currentQty'] != position['currentQty']:
+            problems.append(f'{symbol} position {account.position["currentQty"]} != {position["currentQty"]}')
+        orders = {order['id'] for order in exchange.get_order_list()['items'] if order['symbol'] == symbol}
+        if set(account.orders) != orders:
+            problems.append(f'{symbol} open orders {sorted(account.orders)} != {sorted(orders)}')
+    return problems
+
+
+async def ramp(runner, ws_client, exchange, rates, step=10, max_lag=0.1, warmup=2):
+    '''
+    Raise the message rate through rates, step seconds at each, until the bots lag.
+    A step lags when the p99 message age or queue wait exceeds max_lag seconds, the queue drops messages,
+    or the process cannot generate and deliver the rate at all. Returns one row of results per step.'''
+    asyncio.ensure_future(runner.stream(ws_client))
+    asyncio.ensure_future(runner.metrics.watch_loop(0.01))
+    exchange.start(0)
+    await asyncio.sleep(warmup)
+
+    results = []
+    for rate in rates:
+        exchange.rate = rate
+        runner.metrics.stages.clear()
+        generated, dropped, start = exchange.generated, runner.queue.dropped, perf_counter()
+        await asyncio.sleep(step)
+
+        stages = runner.metrics.summary()
+        p99 = {name: stages.get(name, {}).get('p99', 0) / 1000 for name in ('ws_age', 'queue_wait', 'loop_lag')}
+        row = {'rate': rate, 'achieved': round((exchange.generated - generated) / (perf_counter() - start)),
+               'ws_age_p99_ms': p99['ws_age'], 'queue_wait_p99_ms': p99['queue_wait'],
+               'loop_lag_p99_ms': p99['loop_lag'], 'backlog': len(exchange.messages) + len(runner.queue),
+               'dropped': runner.queue.dropped - dropped}
+        row['lagging'] = (max(p99['ws_age'], p99['queue_wait']) > max_lag * 1000 or row['dropped'] > 0
+                          or row['achieved'] < 0.9 * rate or row['backlog'] > rate * max_lag)
+        results.append(row)
+        print(f'{rate:>8}/s achieved {row["achieved"]:>8}/s  ws_age p99 {row["ws_age_p99_ms"]:>8.1f}ms  '
+              f'queue_wait p99 {row["queue_wait_p99_ms"]:>8.1f}ms  loop_lag p99 {row["loop_lag_p99_ms"]:>8.1f}ms  '
+              f'backlog {row["backlog"]:>7}  dropped {row["dropped"]:>6}{"  LAGGING" if row["lagging"] else ""}',
+              file=sys.stderr)
+        if row['lagging']:
+            break
+
+    # Let the last orders and fills settle before comparing the account caches with the exchange
+    exchange.stop()
+    await asyncio.sleep(1)
+    for bot in runner.bots:
+        if hasattr(bot, 'shutdown'):
+            await bot.shutdown()
+    await asyncio.sleep(1)
+    await ws_client.disconnect()
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+
+def load_test(instances, prices, rates, step=10, max_lag=0.1, quiet=True, **settings):
+    # Run (bot class, symbol, params) instances against a local exchange through a rate ramp
+    exchange = Exchange(prices, **settings)
+    rest_client = RestClient(None, None, None, exchange)
+    metrics = Metrics()
+    trade = rest_client.trade_api()
+    runner = Runner(rest_client.market_api(), trade, OrderGateway(trade, metrics=metrics), metrics)
+    for bot_class, symbol, params in instances:
+        runner.add(bot_class, symbol, **params)
+    ws_client = WsClient(runner.receive, None, None, None, exchange)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull if quiet else sys.stdout):
+            results = loop.run_until_complete(ramp(runner, ws_client, exchange, rates, step, max_lag))
+    finally:
+        runner.gateway.shutdown()
+        loop.close()
+
+    sustained = [row['rate'] for row in results if not row['lagging']]
+    return {'results': results, 'sustained': max(sustained) if sustained else 0,
+            'placed': exchange.placed, 'rejected': exchange.rejected, 'cancelled': exchange.cancelled,
+            'filled': exchange.filled, 'liquidations': sum(i.liquidations for i in exchange.instruments.values()),
+            'positions': {symbol: i.qty for symbol, i in exchange.instruments.items()},
+            'realisedPnl': sum(i.realised for i in exchange.instruments.values()),
+            'mismatches': check_account(runner, exchange)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test bots against a local exchange simulator')
+    parser.add_argument('config', help='runner config, e.g. bots.json')
+    parser.add_argument('--rate', default='1000:20000:1000', help='messages per second, start:stop:step or a,b,c')
+    parser.add_argument('--step', type=float, default=10, help='seconds at each rate')
+    parser.add_argument('--max-lag', type=float, default=0.1, help='p99 message age in seconds that counts as lagging')
+    parser.add_argument('--price', action='append', default=[], help='starting price, e.g. BTCUSDTPERP=10000')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--verbose', action='store_true', help='show the bots\' output')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    instances = []
+    for bot in config['bots']:
+        module = load_script(bot['script'])
+        params = bot.get('params', {})
+        if 'SNAPSHOT_FILE' in getattr(module, 'PARAMS', ()):
+            # Load tests start cold, and must not overwrite or pick up the live bot's snapshot
+            params = dict({'SNAPSHOT_FILE': ''}, **params)
+        instances.append((module.BOT, bot['symbol'], params))
+
+    prices = {bot['symbol']: 10_000.0 for bot in config['bots']}
+    prices.update({symbol: float(price) for symbol, price in (spec.split('=') for spec in args.price)})
+
+    result = load_test(instances, prices, parse_grid([f'RATE={args.rate}'])['RATE'], args.step, args.max_lag,
+                       quiet=not args.verbose, seed=args.seed)
+    print(json.dumps({key: value for key, value in result.items() if key != 'results'}, indent=1))
+    if result['mismatches']:
+        sys.exit(1)
@@ -0,0 +1,385 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+import os
+import sys
+import random
+import asyncio
+from time import monotonic
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from candles import CandleStore
+from tape import COLUMNS, KIND_INDEX, KIND_MARK, KIND_TRADE, parse_message, to_message
+
+
+'''
+Shared memory market data feed, so several strategy processes on one host share a single websocket connection and parse.
+One publisher process owns the public subscriptions and appends every tape row, index and mark prices and trades, to a ring
+per symbol. The ring is a header of int64 words, [sequence, capacity, live], followed by one array per tape column.
+A row is written into slot sequence % capacity before the sequence is bumped, so readers never see a row before it is whole.
+Readers attach read only, keep their own cursor, and read new rows as views straight out of the ring.
+A reader that falls more than capacity rows behind skips ahead and counts the rows it lost in overruns.
+
+The publisher also folds the trades and the index of each symbol into a CandleStore, and every closed bar of each
+timeframe in TIMEFRAMES is appended to a ring of its own, named by candle_topic(symbol, source, tf) with source 'trade'
+or 'index'. A bot that trades on closed candles reads those bars instead of every tick, so it does no per tick work.
+Tick consumers still get one rebuilt message per row, only the kinds they subscribed to are copied out of the ring.
+
+    python feed.py BTCUSDTPERP ETHUSDTPERP
+
+then run the bots with "feed": true in the runner config.'''
+
+_HEADER = 64
+_TOPICS = {'/contract/instrument:': (KIND_INDEX, KIND_MARK), '/contractMarket/execution:': (KIND_TRADE,)}
+_CANDLES = '/feed/candles:'
+
+TIMEFRAMES = ('15S', '30S', '1T', '5T', '15T', '1H')
+BAR_COLUMNS = {'ts': '<i8', 'open': '<f8', 'high': '<f8', 'low': '<f8', 'close': '<f8', 'size': '<f8'}
+# Tape kind each candle source is built from, and whether empty bars in gaps are dropped, as the bots build them
+SOURCES = {'trade': (KIND_TRADE, True), 'index': (KIND_INDEX, False)}
+
+
+def feed_name(symbol, candles=None):
+    return f'pf-feed-{symbol}' if candles is None else f'pf-feed-{symbol}-{candles[0]}-{candles[1]}'
+
+
+def candle_topic(symbol, source, tf):
+    # Topic a bot routes published candles by, e.g. /feed/candles:BTCUSDTPERP:trade:1T
+    return f'{_CANDLES}{symbol}:{source}:{tf}'
+
+
+def _layout(capacity, columns):
+    # Byte offset of each column, after the header and aligned to cache lines
+    offsets, offset = {}, _HEADER
+    for column, dtype in columns.items():
+        offsets[column] = offset
+        offset += -(-capacity * np.dtype(dtype).itemsize // 64) * 64
+    return offsets, offset
+
+
+def _views(buf, capacity, columns):
+    offsets, _ = _layout(capacity, columns)
+    return {column: np.ndarray(capacity, dtype=dtype, buffer=buf, offset=offsets[column])
+            for column, dtype in columns.items()}
+
+
+class FeedWriter:
+    '''
+    Publisher side of one symbol's tick ring, or with candles=(source, tf) of its ring of closed bars.
+    capacity must be a power of two.'''
+
+    def __init__(self, symbol, capacity=1 << 20, candles=None):
+        if capacity & (capacity - 1):
+            raise ValueError(f'Feed capacity {capacity} is not a power of two')
+        self.symbol = symbol
+        self.capacity = capacity
+        self._mask = capacity - 1
+
+        name, columns = feed_name(symbol, candles), BAR_COLUMNS if candles else COLUMNS
+        _, size = _layout(capacity, columns)
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a publisher that did not shut down cleanly, readers still on it see it go quiet
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+
+        self._header = np.ndarray(_HEADER // 8, dtype=np.int64, buffer=self.shm.buf)
+        self._columns = _views(self.shm.buf, capacity, columns)
+        self._header[:3] = (0, capacity, 1)
+        self.sequence = 0
+
+    def write(self, ts, kind, price, size=0.0, side=0):
+        slot = self.sequence & self._mask
+        columns = self._columns
+        columns['ts'][slot] = ts
+        columns['kind'][slot] = kind
+        columns['price'][slot] = price
+        columns['size'][slot] = size
+        columns['side'][slot] = side
+        self.sequence += 1
+        self._header[0] = self.sequence
+
+    def write_message(self, msg):
+        for row in parse_message(msg):
+            self.write(*row)
+
+    def write_bars(self, bars):
+        # Append closed bars, a dict of column arrays oldest first such as CandleBuffer.closed(n)
+        columns = self._columns
+        for i in range(len(bars['ts'])):
+            slot = self.sequence & self._mask
+            for column, values in columns.items():
+                values[slot] = bars[column][i]
+            self.sequence += 1
+        self._header[0] = self.sequence
+
+    def close(self):
+        # Mark the ring closed so readers reattach to the next publisher, then remove it
+        self._header[2] = 0
+        del self._header, self._columns
+        self.shm.close()
+        self.shm.unlink()
+
+
+class FeedReader:
+    '''
+    Read only view of one symbol's tick ring, or with candles=(source, tf) of its bars, from the newest row unless from_start.'''
+
+    def __init__(self, symbol, from_start=False, candles=None):
+        self.symbol = symbol
+        self.shm = shared_memory.SharedMemory(feed_name(symbol, candles))
+        # Attaching registers the segment with this process's resource tracker, which would remove it when we exit
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self._header = np.ndarray(_HEADER // 8, dtype=np.int64, buffer=self.shm.buf)
+        self.capacity = int(self._header[1])
+        self._mask = self.capacity - 1
+        self._columns = _views(self.shm.buf, self.capacity, BAR_COLUMNS if candles else COLUMNS)
+        for values in self._columns.values():
+            values.flags.writeable = False
+
+        sequence = int(self._header[0])
+        self.cursor = max(0, sequence - self.capacity) if from_start else sequence
+        self.overruns = 0
+        self._polled = self.cursor
+
+    @property
+    def live(self):
+        return bool(self._header[2])
+
+    def poll(self, max_rows=None):
+        # Views of the rows published since the last poll, oldest first, one chunk or two where the ring wraps
+        sequence = int(self._header[0])
+        cursor = self.cursor
+        if sequence - cursor > self.capacity:
+            self.overruns += sequence - cursor - self.capacity
+            cursor = sequence - self.capacity
+        if max_rows is not None:
+            sequence = min(sequence, cursor + max_rows)
+
+        self._polled = cursor
+        chunks = []
+        while cursor < sequence:
+            start = cursor & self._mask
+            end = min(self.capacity, start + sequence - cursor)
+            chunks.append({column: values[start:end] for column, values in self._columns.items()})
+            cursor += end - start
+        self.cursor = cursor
+        return chunks
+
+    def lapped(self):
+        # True if the writer has since overwritten rows handed out by the last poll, views of them are no longer valid
+        return int(self._header[0]) - self.capacity > self._polled
+
+    def close(self):
+        del self._header, self._columns
+        self.shm.close()
+
+
+class FeedClient:
+    '''
+    Stands in for the websocket on the public topics the feed carries, rebuilding each row as the message a bot expects.
+    Rows are copied out of the ring a chunk at a time and checked against the writer before any are delivered.
+    A candle topic is delivered as one message per chunk of closed bars, {'topic': topic, 'data': {column: array}}.'''
+
+    def __init__(self, callback, poll_interval=0.001, chunk=4096):
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.chunk = chunk
+        self.readers = {}
+        self.kinds = {}
+        self.bar_readers = {}
+        self.overruns = 0
+        # Index and mark prices are published about every second, the runner watches this for a silent publisher
+        self.heard = monotonic()
+
+    def carries(self, topic):
+        if topic.startswith(_CANDLES):
+            return topic in self.bar_readers or self._attach_bars(topic)
+        for prefix in _TOPICS:
+            if topic.startswith(prefix):
+                symbol = topic[len(prefix):]
+                return symbol in self.readers or self._attach(symbol)
+        return False
+
+    def _attach(self, symbol):
+        # Attach to the symbol's ring, or to a restarted publisher's new ring, keeping the old one until then
+        try:
+            reader = FeedReader(symbol)
+        except FileNotFoundError:
+            return False
+        if symbol in self.readers:
+            self.readers[symbol].close()
+        self.readers[symbol] = reader
+        return True
+
+    def _attach_bars(self, topic):
+        symbol, source, tf = topic[len(_CANDLES):].split(':')
+        try:
+            reader = FeedReader(symbol, candles=(source, tf))
+        except FileNotFoundError:
+            return False
+        if topic in self.bar_readers:
+            self.bar_readers[topic].close()
+        self.bar_readers[topic] = reader
+        # The tick ring is still read, without delivering any of it, to tell a live publisher from a silent one
+        return symbol in self.readers or self._attach(symbol)
+
+    async def subscribe(self, topic):
+        if topic.startswith(_CANDLES):
+            if topic not in self.bar_readers and not self._attach_bars(topic):
+                raise ValueError(f'No candles published for {topic}, start python feed.py with its symbol')
+            return
+        for prefix, kinds in _TOPICS.items():
+            if topic.startswith(prefix):
+                symbol = topic[len(prefix):]
+                if symbol not in self.readers and not self._attach(symbol):
+                    raise ValueError(f'No feed published for {symbol}, start python feed.py {symbol}')
+                self.kinds.setdefault(symbol, set()).update(kinds)
+
+    def poll_ticks(self, symbol, reader):
+        kinds = np.array(sorted(self.kinds.get(symbol, ())), dtype=np.int8)
+        for rows in reader.poll(self.chunk):
+            self.heard = monotonic()
+            if not len(kinds):
+                continue
+            # Only the rows of subscribed kinds are copied out and rebuilt as messages
+            wanted = np.isin(rows['kind'], kinds)
+            rows = [values[wanted].tolist() for values in rows.values()]
+            if reader.lapped():
+                self.overruns += len(rows[0])
+                continue
+            for ts, kind, price, size, side in zip(*rows):
+                self.callback(to_message(symbol, ts, kind, price, size, side))
+
+    def poll_bars(self, topic, reader):
+        for bars in reader.poll(self.chunk):
+            bars = {column: values.copy() for column, values in bars.items()}
+            if reader.lapped():
+                self.overruns += len(bars['ts'])
+                continue
+            self.callback({'topic': topic, 'data': bars})
+
+    async def run(self):
+        while True:
+            for symbol, reader in list(self.readers.items()):
+                if reader.live:
+                    self.poll_ticks(symbol, reader)
+                else:
+                    self._attach(symbol)
+            for topic, reader in list(self.bar_readers.items()):
+                if reader.live:
+                    self.poll_bars(topic, reader)
+                else:
+                    self._attach_bars(topic)
+            await asyncio.sleep(self.poll_interval)
+
+
+class Publisher:
+    '''
+    Writes one symbol's ticks to its ring, and the bars they close in each timeframe to the candle rings.'''
+
+    def __init__(self, symbol, capacity=1 << 20, timeframes=TIMEFRAMES, bar_capacity=1 << 12):
+        self.writer = FeedWriter(symbol, capacity)
+        self.bar_writers = []
+        self.stores = {}
+        for source, (kind, dropna) in SOURCES.items():
+            store = self.stores[kind] = CandleStore(timeframes, capacity=bar_capacity, dropna=dropna)
+            for tf in timeframes:
+                bar_writer = FeedWriter(symbol, bar_capacity, (source, tf))
+                store.on_close(tf, lambda buffer, n, bar_writer=bar_writer: bar_writer.write_bars(buffer.closed(n)))
+                self.bar_writers.append(bar_writer)
+
+    def write_message(self, msg):
+        for ts, kind, price, size, side in parse_message(msg):
+            self.writer.write(ts, kind, price, size, side)
+            store = self.stores.get(kind)
+            if store is not None:
+                store.update(ts, price, size)
+
+    def close(self):
+        for writer in [self.writer] + self.bar_writers:
+            writer.close()
+
+
+def publish(symbols, capacity=1 << 20, stale_after=5):
+    # Publish the public channels of each symbol until interrupted
+    # The instrument channels push about every second, after stale_after seconds of silence the websocket is reconnected
+    from polofutures import WsClient
+
+    writers = {symbol: Publisher(symbol, capacity) for symbol in symbols}
+    heard = [monotonic()]
+
+    def on_message(msg):
+        heard[0] = monotonic()
+        writer = writers.get(msg.get('topic', '').rsplit(':', 1)[-1])
+        if writer is not None:
+            writer.write_message(msg)
+
+    async def connect(backoff=0.5, max_backoff=30):
+        while True:
+            try:
+                await ws_client.connect()
+                for symbol in symbols:
+                    await ws_client.subscribe(f'/contract/instrument:{symbol}')
+                    await ws_client.subscribe(f'/contractMarket/execution:{symbol}')
+                heard[0] = monotonic()
+                return
+            except Exception as e:
+                print(f'Feed Reconnect Error!\n {e}')
+                await asyncio.sleep(backoff * random.uniform(1, 2))
+                backoff = min(backoff * 2, max_backoff)
+                try:
+                    await ws_client.disconnect()
+                except Exception:
+                    pass
+
+    async def stream():
+        await connect()
+        while True:
+            await asyncio.sleep(stale_after / 4)
+            if monotonic() - heard[0] > stale_after:
+                # Readers see the feed go quiet, and backfill the gap once rows flow again
+                print(f'Feed Websocket Silent for {monotonic() - heard[0]:.1f}s, Reconnecting')
+                try:
+                    await ws_client.disconnect()
+                except Exception as e:
+                    print(f'Feed Disconnect Error!\n {e}')
+                await connect()
+
+    ws_client = WsClient(on_message, os.environ['PF_API_KEY'], os.environ['PF_SECRET'], os.environ['PF_PASS'])
+    loop = asyncio.get_event_loop()
+
+    try:
+        loop.run_until_complete(stream())
+    except (KeyboardInterrupt, Exception) as e:
+        print(f'Stopping Feed {e}')
+    finally:
+        loop.run_until_complete(ws_client.disconnect())
+        for writer in writers.values():
+            writer.close()
+        loop.close()
+
+
+if __name__ == "__main__":
+    print(f'Starting Feed for {", ".join(sys.argv[1:])}!')
+    publish(sys.argv[1:])
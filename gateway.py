@@ -0,0 +1,275 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import perf_counter_ns
+
+from metrics import Metrics
+
+
+# Request priorities, lowest first: cancels, orders that reduce the position, then everything else
+CANCEL, REDUCE, QUOTE = 0, 1, 2
+
+# Requests per second and burst for each endpoint group, set these to your account's exchange limits
+LIMITS = {'place': (10, 30), 'cancel': (10, 30)}
+
+
+class Superseded(Exception):
+    # A queued order replaced by a newer one for the same level before it was sent
+    pass
+
+
+class TokenBucket:
+    # rate tokens per second up to burst, times are passed in by the caller
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.at = None
+
+    def wait_time(self, now):
+        if self.at is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.at) * self.rate)
+        self.at = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.wait_time(now)
+        self.tokens -= 1
+
+
+class _Request:
+    __slots__ = ('priority', 'group', 'key', 'name', 'args', 'kwargs', 'future', 'queued', 'prefix')
+
+    def __init__(self, priority, group, key, name, args, kwargs, future, prefix=None):
+        self.priority = priority
+        self.group = group
+        self.key = key
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.queued = perf_counter_ns()
+        # clientOid prefix of the bot that queued a cancel, cancels are only folded into a cancel all of its own orders
+        self.prefix = prefix
+
+
+class OrderGateway:
+    '''
+    Async wrapper around the blocking trade API, so REST round trips no longer stall websocket message intake.
+    Calls run on a bounded pool of worker threads, which keeps concurrent requests pipelined on warm connections.
+    Every call is timed, a call that exceeds the timeout raises asyncio.TimeoutError while its thread finishes in the background.
+
+    Requests wait in a priority queue and are sent within per endpoint token bucket limits, so in a fast market cancels
+    and position reducing orders go out ahead of new quotes instead of queueing behind them at the exchange.
+    A queued order placed with a key, such as the market maker's (symbol, side, level), is superseded by a newer order with
+    the same key, and a queued cancel of an order already queued for cancel shares its result.
+    Cancels that cover every open order of a symbol go out as one cancel all, when all of those orders carry the clientOid
+    prefix the cancels were queued with, so orders of other bots or placed by hand are never swept up. Position and open orders are read from
+    accounts, the runner's per symbol AccountState.'''
+
+    def __init__(self, trade, max_workers=4, timeout=5, metrics=None, limits=None):
+        self.trade = trade
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.latency = metrics if metrics is not None else Metrics()
+        self.buckets = {group: TokenBucket(rate, burst) for group, (rate, burst) in (limits or LIMITS).items()}
+        self.accounts = {}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='order-gateway')
+
+        self._queues = (deque(), deque(), deque())
+        self._keys = {}
+        self._placing = {}
+        self._in_flight = 0
+        self._wake = None
+        self.coalesced = self.batched = 0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues)
+
+    async def _call(self, name, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        start = perf_counter_ns()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self._pool, partial(getattr(self.trade, name), *args, **kwargs)), self.timeout)
+        finally:
+            self.latency.lap(f'rest_{name}', start)
+
+    def _enqueue(self, priority, group, key, name, *args, prefix=None, **kwargs):
+        if self._wake is None:
+            self._wake = asyncio.Event()
+            asyncio.ensure_future(self._dispatch())
+
+        queued = self._keys.get(key) if key is not None else None
+        if queued is not None:
+            self.coalesced += 1
+            if queued.name != 'create_limit_order':
+                return queued.future
+            self._queues[queued.priority].remove(queued)
+            queued.future.set_exception(Superseded(f'Order for {key} superseded before it was sent'))
+
+        request = _Request(priority, group, key, name, args, kwargs, asyncio.get_event_loop().create_future(), prefix)
+        self._queues[priority].append(request)
+        if key is not None:
+            self._keys[key] = request
+        self._wake.set()
+        return request.future
+
+    def _priority(self, order):
+        # An order that can only shrink the position goes ahead of new quotes
+        if order.get('reduceOnly') or order.get('closeOrder'):
+            return REDUCE
+        account = self.accounts.get(order.get('symbol'))
+        qty = account.position['currentQty'] if account is not None else 0
+        if qty and (order['side'] == 'sell') == (qty > 0) and int(order['size']) <= abs(qty):
+            return REDUCE
+        return QUOTE
+
+    async def _dispatch(self):
+        # Send the highest priority requests whose limits allow, no more than max_workers at once
+        loop = asyncio.get_event_loop()
+        while True:
+            wait = None
+            while self._in_flight < self.max_workers:
+                call, requests, wait = self._next(loop.time())
+                if call is None:
+                    break
+                self._send(call, requests)
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _next(self, now):
+        # The call for the highest priority request its bucket has a token for and the requests it answers,
+        # or None and the seconds until a token frees up
+        wait = None
+        for queue in self._queues:
+            while queue and queue[0].future.cancelled():
+                self._keys.pop(queue.popleft().key, None)
+            if not queue:
+                continue
+            bucket = self.buckets.get(queue[0].group)
+            wait_time = bucket.wait_time(now) if bucket is not None else 0
+            if wait_time:
+                wait = wait_time if wait is None else min(wait, wait_time)
+                continue
+
+            request = queue.popleft()
+            if request.key is not None:
+                self._keys.pop(request.key, None)
+            if bucket is not None:
+                bucket.take(now)
+            if request.name == 'cancel_order':
+                return self._batch(request, queue)
+            return (request.name, request.args, request.kwargs), [request], None
+
+        return None, [], wait
+
+    def _batch(self, request, queue):
+        # Fold the queued cancels into one cancel all when between them they cover every open order of the symbol,
+        # and every one of those orders belongs to the bot that queued them
+        call = (request.name, request.args, request.kwargs), [request], None
+        order_id = request.args[0]
+        symbol = next((symbol for symbol, account in self.accounts.items() if order_id in account.orders), None)
+        if symbol is None or request.prefix is None or self._placing.get(symbol):
+            return call
+
+        orders = self.accounts[symbol].orders
+        if any(not (order.get('clientOid') or '').startswith(f'{request.prefix}-') for order in orders.values()):
+            return call
+
+        open_orders = set(orders)
+        cancels = [queued for queued in queue if queued.name == 'cancel_order' and queued.args[0] in open_orders
+                   and queued.prefix == request.prefix]
+        if len(open_orders) < 2 or {order_id} | {queued.args[0] for queued in cancels} != open_orders:
+            return call
+
+        for queued in cancels:
+            queue.remove(queued)
+            self._keys.pop(queued.key, None)
+        self.batched += len(cancels) + 1
+        return ('cancel_all_limit_orders', (symbol,), {}), [request] + cancels, None
+
+    def _send(self, call, requests):
+        name, args, kwargs = call
+        for request in requests:
+            self.latency.lap(f'queue_{request.name}', request.queued)
+
+        symbol = kwargs.get('symbol') if name == 'create_limit_order' else None
+        if symbol is not None:
+            self._placing[symbol] = self._placing.get(symbol, 0) + 1
+        self._in_flight += 1
+
+        def done(task):
+            self._in_flight -= 1
+            if symbol is not None:
+                self._placing[symbol] -= 1
+            for request in requests:
+                if request.future.done():
+                    continue
+                if task.cancelled():
+                    request.future.cancel()
+                elif task.exception() is not None:
+                    request.future.set_exception(task.exception())
+                else:
+                    request.future.set_result(task.result())
+            self._wake.set()
+
+        asyncio.ensure_future(self._call(name, *args, **kwargs)).add_done_callback(done)
+
+    async def place(self, key=None, **order):
+        return await self._enqueue(self._priority(order), 'place', key and ('place', key), 'create_limit_order', **order)
+
+    async def cancel(self, order_id, prefix=None):
+        # With the clientOid prefix of the caller's orders, cancels may go out as one cancel all of them
+        return await self._enqueue(CANCEL, 'cancel', ('cancel', order_id), 'cancel_order', order_id, prefix=prefix)
+
+    async def amend(self, order_id, key=None, **order):
+        # There is no amend endpoint, the order is cancelled first so both never rest on the book together
+        await self.cancel(order_id)
+        return await self.place(key, **order)
+
+    async def cancel_many(self, order_ids, prefix=None):
+        # Cancel a batch of orders, failures are returned in place of the result
+        return await asyncio.gather(*(self.cancel(order_id, prefix) for order_id in order_ids), return_exceptions=True)
+
+    async def cancel_all(self, symbol):
+        return await self._enqueue(CANCEL, 'cancel', ('cancel_all', symbol), 'cancel_all_limit_orders', symbol)
+
+    def submit(self, coro, label='Order'):
+        # Schedule a request from synchronous code, such as a websocket callback, errors are printed when it completes
+        def done(task):
+            if not task.cancelled() and task.exception() is not None and not isinstance(task.exception(), Superseded):
+                print(f'{label} Error!\n {task.exception()!r}')
+
+        task = asyncio.ensure_future(coro)
+        task.add_done_callback(done)
+        return task
+
+    def latency_stats(self):
+        # Per request type latency and queue wait summary in microseconds
+        return {name: stats for name, stats in self.latency.summary().items() if name.startswith(('rest_', 'queue_'))}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
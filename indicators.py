@@ -0,0 +1,137 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import math
+
+
+class _Indicator:
+    # Snapshot support, an indicator's state is its own attributes as plain values
+
+    def state(self):
+        return {name: list(value) if isinstance(value, (list, tuple)) else value for name, value in vars(self).items()}
+
+    def restore(self, state):
+        # Load the state of an indicator with the same parameters, raises ValueError without changing anything otherwise
+        params = {name: value for name, value in vars(self).items() if not name.startswith('_') and name != 'value'}
+        if any(state.get(name) != value for name, value in params.items()):
+            raise ValueError(f'Snapshot {type(self).__name__} parameters differ from {params}')
+
+        for name, value in list(vars(self).items()):
+            setattr(self, name, tuple(state[name]) if isinstance(value, tuple) else state[name])
+
+
+class RSI(_Indicator):
+    '''
+    Wilder smoothed RSI updated one close at a time, matching TA-Lib RSI.
+    The first value is seeded from the mean gain and loss of the first timeperiod changes, NaN until then.'''
+
+    def __init__(self, timeperiod=14):
+        self.timeperiod = timeperiod
+        self.value = math.nan
+
+        self._prev = None
+        self._count = 0
+        self._gain = self._loss = 0.0
+
+    def update(self, close):
+        if self._prev is None:
+            self._prev = close
+            return self.value
+
+        diff = close - self._prev
+        self._prev = close
+        self._count += 1
+        gain, loss = (0.0, -diff) if diff < 0 else (diff, 0.0)
+
+        if self._count < self.timeperiod:
+            self._gain += gain
+            self._loss += loss
+            return self.value
+
+        if self._count == self.timeperiod:
+            self._gain = (self._gain + gain) / self.timeperiod
+            self._loss = (self._loss + loss) / self.timeperiod
+        else:
+            self._gain = (self._gain * (self.timeperiod - 1) + gain) / self.timeperiod
+            self._loss = (self._loss * (self.timeperiod - 1) + loss) / self.timeperiod
+
+        total = self._gain + self._loss
+        self.value = 100 * self._gain / total if total != 0 else 0.0
+        return self.value
+
+
+class BBands(_Indicator):
+    '''
+    Simple moving average Bollinger Bands from a rolling sum and sum of squares, matching TA-Lib BBANDS with matype=0.
+    Returns (upper, middle, lower), NaN until timeperiod closes are seen.'''
+
+    def __init__(self, timeperiod=20, nbdevup=2, nbdevdn=2):
+        self.timeperiod = timeperiod
+        self.nbdevup = nbdevup
+        self.nbdevdn = nbdevdn
+        self.value = (math.nan, math.nan, math.nan)
+
+        self._window = [0.0] * timeperiod
+        self._idx = 0
+        self._count = 0
+        self._sum = self._sumsq = 0.0
+
+    def update(self, close):
+        old = self._window[self._idx]
+        self._window[self._idx] = close
+        self._idx = (self._idx + 1) % self.timeperiod
+
+        self._sum += close - old
+        self._sumsq += close * close - old * old
+        self._count = min(self._count + 1, self.timeperiod)
+        if self._count < self.timeperiod:
+            return self.value
+
+        mid = self._sum / self.timeperiod
+        var = self._sumsq / self.timeperiod - mid * mid
+        std = math.sqrt(var) if var > 0 else 0.0
+        self.value = (mid + self.nbdevup * std, mid, mid - self.nbdevdn * std)
+        return self.value
+
+    def percent_b(self, close):
+        # Bollinger %B of the close against the latest bands, NaN while warming up or if the bands are flat
+        up, mid, low = self.value
+        return (close - low) / (up - low) if up != low else math.nan
+
+
+class Momentum(_Indicator):
+    '''
+    Close minus the close timeperiod bars ago, matching TA-Lib MOM. Keeps a ring of the last timeperiod closes.'''
+
+    def __init__(self, timeperiod=10):
+        self.timeperiod = timeperiod
+        self.value = math.nan
+
+        self._window = [math.nan] * timeperiod
+        self._idx = 0
+        self._count = 0
+
+    def update(self, close):
+        old = self._window[self._idx]
+        self._window[self._idx] = close
+        self._idx = (self._idx + 1) % self.timeperiod
+
+        self._count += 1
+        if self._count > self.timeperiod:
+            self.value = close - old
+        return self.value
@@ -0,0 +1,106 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+from collections import deque
+from time import perf_counter_ns
+
+
+class TickQueue:
+    '''
+    Bounded queue between the websocket callback and the bots, so a burst never blocks the socket or grows without limit.
+    Putting a message is an append. On latest wins topics, such as the index feed, a message replaces the one still
+    waiting for that topic instead of queueing behind it, so a burst coalesces into its newest update.
+    Once maxlen messages are waiting the oldest is dropped, the account reconcile loop repairs any account update lost this way.
+    received, coalesced and dropped count messages since start.'''
+
+    def __init__(self, maxlen=10_000, latest=()):
+        self.maxlen = maxlen
+        self.latest = set(latest)
+
+        self._slots = deque()
+        self._waiting = {}
+        self.received = self.coalesced = self.dropped = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def put(self, msg):
+        self.received += 1
+        topic = msg.get('topic')
+        if topic in self.latest:
+            slot = self._waiting.get(topic)
+            if slot is not None:
+                slot[0] = msg
+                self.coalesced += 1
+                return
+
+        if len(self._slots) >= self.maxlen:
+            self._forget(self._slots.popleft())
+            self.dropped += 1
+
+        # Each slot keeps the time its first message was queued, a coalesced slot waits as long as its oldest update
+        slot = [msg, perf_counter_ns()]
+        self._slots.append(slot)
+        if topic in self.latest:
+            self._waiting[topic] = slot
+
+    def drain(self, n=None):
+        # Up to n waiting (message, queued at) pairs, oldest first
+        n = len(self._slots) if n is None else min(n, len(self._slots))
+        batch = [self._slots.popleft() for _ in range(n)]
+        if self._waiting:
+            for slot in batch:
+                self._forget(slot)
+        return batch
+
+    def _forget(self, slot):
+        topic = slot[0].get('topic')
+        if self._waiting.get(topic) is slot:
+            del self._waiting[topic]
+
+
+class BarClose:
+    '''
+    Decides when a signal bot evaluates, instead of on every tick.
+    Ticks only fold into the candles, evaluation falls due once a candle has closed and at least interval seconds have
+    passed since the last one, so bars closing in a burst are evaluated together on the newest state.
+    Times are passed in by the caller, as with the market maker's requote trigger.'''
+
+    def __init__(self, interval=0):
+        self.interval = interval
+        self.pending = 0
+        self.evaluated_at = None
+
+    def closed(self, n):
+        self.pending += n
+
+    def due(self, now):
+        return self.pending > 0 and (self.evaluated_at is None or now - self.evaluated_at >= self.interval)
+
+    def wait_time(self, now):
+        # Seconds until an evaluation falls due, None while no candle is waiting
+        if not self.pending:
+            return None
+        if self.evaluated_at is None:
+            return 0
+        return max(0, self.evaluated_at + self.interval - now)
+
+    def take(self, now):
+        # Number of candles closed since the last evaluation, which starts now
+        n, self.pending = self.pending, 0
+        self.evaluated_at = now
+        return n
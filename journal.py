@@ -0,0 +1,180 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import sys
+import json
+import argparse
+import threading
+from collections import deque
+from time import time, time_ns
+
+import pandas as pd
+
+
+'''
+Structured trading journal. Bots and the runner emit events, signals, orders, quotes, fills and positions, as plain
+dicts from the event loop, which costs one deque append. A writer thread drains the queue in batches, appends each event
+as one compact JSON line to the journal file and prints a console summary at most once every summary_interval seconds,
+so no formatting or blocking I/O runs on the event loop.
+Every line carries the time it was emitted in ns, kind and symbol, read(path) replays the file in order and
+load(path, kind) tabulates it.'''
+
+
+def _plain(value):
+    # numpy scalars from the candle buffers, anything else is written as its string
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+class Journal:
+    '''
+    Append only event journal with a background writer. With path None events are only summarised on the console,
+    with enabled=False emit returns straight away and no thread is started.'''
+
+    def __init__(self, path=None, summary_interval=5, flush_interval=0.2, enabled=True, out=None):
+        self.path = path
+        self.summary_interval = summary_interval
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.out = out
+        self.written = 0
+
+        # deque appends and pops are atomic, the event loop and the writer never wait on each other
+        self._events = deque()
+        self._stop = threading.Event()
+        self._file = None
+        self._thread = None
+        self._counts = {}
+        self._latest = {}
+        self._summarised = time()
+
+        if enabled:
+            if path:
+                self._file = open(path, 'a')
+            self._thread = threading.Thread(target=self._run, name='journal-writer', daemon=True)
+            self._thread.start()
+
+    def emit(self, kind, symbol, /, **fields):
+        if self.enabled:
+            self._events.append((time_ns(), kind, symbol, fields))
+
+    def __len__(self):
+        return len(self._events)
+
+    def close(self):
+        # Stop the writer once it has written everything emitted so far
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self._drain()
+        self._drain()
+        self._summarise()
+
+    def _drain(self):
+        try:
+            events = self._events
+            lines = []
+            while events:
+                ts, kind, symbol, fields = events.popleft()
+                if self._file is not None:
+                    lines.append(json.dumps(dict(fields, time=ts, kind=kind, symbol=symbol),
+                                            separators=(',', ':'), default=_plain))
+                key = (symbol, kind)
+                self._counts[key] = self._counts.get(key, 0) + 1
+                self._latest[key] = fields
+
+            if lines:
+                self._file.write('\n'.join(lines) + '\n')
+                self._file.flush()
+                self.written += len(lines)
+            if time() - self._summarised >= self.summary_interval:
+                self._summarise()
+        except Exception as e:
+            print(f'Journal Error!\n {e}', file=sys.stderr)
+
+    def _summarise(self):
+        # One line per symbol, the events counted since the last summary and the latest position, signal and quote
+        self._summarised = time()
+        if not self._counts:
+            return
+
+        lines = [f'------ {int(self._summarised)}']
+        for symbol in sorted({symbol for symbol, _ in self._latest}):
+            counts = '  '.join(f'{kind} {n}' for (s, kind), n in sorted(self._counts.items()) if s == symbol)
+            line = f'{symbol:<14}{counts}'
+            position = self._latest.get((symbol, 'position'))
+            if position is not None:
+                line += f'  | Position {position.get("currentQty")} @ {position.get("avgEntryPrice")}' \
+                        f'  Unrealised Pnl {position.get("unrealisedRoePcnt", 0) * 100:.2f}%'
+            signal = self._latest.get((symbol, 'signal'))
+            if signal is not None:
+                line += f'  | Signal {signal.get("Signal") or "-"} close {signal.get("close")}'
+            quote = self._latest.get((symbol, 'quote'))
+            if quote is not None:
+                line += f'  | Quoting {quote.get("reference")}  Book {quote.get("bid")} / {quote.get("ask")}' \
+                        f'  Open Orders {quote.get("orders")}'
+            risk = self._latest.get((symbol, 'risk'))
+            if risk is not None and self._counts.get((symbol, 'risk')):
+                line += f'  | {risk.get("message")}'
+            lines.append(line)
+
+        self._counts.clear()
+        print('\n'.join(lines), file=self.out or sys.stdout, flush=True)
+
+
+def read(path):
+    # Replay a journal, one event dict per line in the order they were emitted
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load(path, kind, symbol=None):
+    # Events of one kind as a frame indexed by time, e.g. load('mm-journal.jsonl', 'fill') for the fills to analyse
+    events = [event for event in read(path) if event['kind'] == kind and (symbol is None or event['symbol'] == symbol)]
+    frame = pd.DataFrame(events)
+    if len(frame):
+        frame = frame.set_index(pd.to_datetime(frame.pop('time'), unit='ns'))
+    return frame
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarise a trading journal, or print its events of one kind')
+    parser.add_argument('journal', help='e.g. runner-journal.jsonl')
+    parser.add_argument('--kind', help='signal, order, quote, fill, position or risk')
+    parser.add_argument('--symbol')
+    parser.add_argument('--out', help='csv file to write the events of --kind to')
+    args = parser.parse_args()
+
+    if args.kind is None:
+        counts = pd.DataFrame([(event['symbol'], event['kind']) for event in read(args.journal)],
+                              columns=['symbol', 'kind'])
+        print(counts.groupby(['symbol', 'kind']).size().unstack(fill_value=0).to_string() if len(counts) else 'Empty journal')
+    else:
+        events = load(args.journal, args.kind, args.symbol)
+        if args.out:
+            events.to_csv(args.out)
+        else:
+            print(events.to_string())
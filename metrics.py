@@ -0,0 +1,143 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import os
+import asyncio
+from time import perf_counter_ns
+
+
+_PRECISION = 4                  # 16 sub buckets per power of two, values are kept to within about 6%
+_BUCKETS = 48 << _PRECISION
+
+
+def _lower_bound(bucket):
+    if bucket < 1 << _PRECISION:
+        return bucket
+    shift = (bucket >> _PRECISION) - 1
+    return ((bucket & ((1 << _PRECISION) - 1)) + (1 << _PRECISION)) << shift
+
+
+class Histogram:
+    '''
+    Log linear latency histogram in nanoseconds. Recording is a bucket index and one increment, no allocation.'''
+
+    def __init__(self):
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < 1 << _PRECISION:
+            bucket = max(value, 0)
+        else:
+            shift = value.bit_length() - _PRECISION - 1
+            bucket = min(((shift + 1) << _PRECISION) + (value >> shift) - (1 << _PRECISION), _BUCKETS - 1)
+
+        self.counts[bucket] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0
+        rank = self.count * pct / 100
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(_lower_bound(bucket), self.max)
+        return self.max
+
+
+class Metrics:
+    '''
+    Per stage latency histograms and gauges, with a periodic text export.
+    Time a pipeline by chaining laps, t = metrics.lap('candles', t), each lap records the time since t and returns now.
+    With enabled=False laps and observations return straight away.'''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+        self.gauges = {}
+        self.probes = {}
+
+    def stage(self, name):
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = Histogram()
+        return histogram
+
+    def lap(self, name, start):
+        if not self.enabled:
+            return start
+        now = perf_counter_ns()
+        (self.stages.get(name) or self.stage(name)).record(now - start)
+        return now
+
+    def observe(self, name, value):
+        if self.enabled:
+            self.stage(name).record(value)
+
+    def summary(self):
+        # count, p50, p99, p99.9 and max per stage, in microseconds
+        return {name: {'count': h.count, 'p50': h.percentile(50) / 1000, 'p99': h.percentile(99) / 1000,
+                       'p99.9': h.percentile(99.9) / 1000, 'max': h.max / 1000}
+                for name, h in self.stages.items()}
+
+    def export(self, path):
+        # Write the summary and gauges to a text file, replaced atomically so readers never see a partial file
+        for name, probe in self.probes.items():
+            self.gauges[name] = probe()
+
+        lines = [f'{"stage":<16}{"count":>10}{"p50_us":>12}{"p99_us":>12}{"p99.9_us":>12}{"max_us":>12}']
+        for name, s in sorted(self.summary().items()):
+            lines.append(f'{name:<16}{s["count"]:>10}{s["p50"]:>12.1f}{s["p99"]:>12.1f}{s["p99.9"]:>12.1f}{s["max"]:>12.1f}')
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f'gauge {name} {value}')
+
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+    async def watch_loop(self, interval=0.1):
+        # Event loop lag, how late a sleep of interval wakes up
+        target = int(interval * 1_000_000_000)
+        while True:
+            start = perf_counter_ns()
+            await asyncio.sleep(interval)
+            self.observe('loop_lag', perf_counter_ns() - start - target)
+
+    async def export_loop(self, path, interval=10):
+        asyncio.ensure_future(self.watch_loop())
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.export(path)
+            except OSError as e:
+                print(f'Metrics Export Error!\n {e}')
+
+
+def pending_messages(ws_client):
+    # Messages the websocket has received but not yet handed to the callback, None if the client does not expose them
+    for value in vars(ws_client).values():
+        messages = getattr(value, 'messages', None)
+        if messages is not None and hasattr(messages, '__len__'):
+            return len(messages)
+    return None
@@ -0,0 +1,97 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import numpy as np
+
+
+'''
+Market maker ladder reconciliation. Every ladder order carries its (side, level) in its clientOid, so live orders are
+matched to the ladder by key rather than by size or price, and one pass over both gives the minimal set of requests.'''
+
+
+def ladder(index_price, pairs, min_spread, step_size, touch=None):
+    # Target ladder as plain arrays, level 1 is closest to the index on each side
+    # With the book's (best bid, best ask) as touch, no order is priced at or through the far side, so post only never crosses
+    levels = np.arange(1, pairs + 1)
+    spread = min_spread * levels
+    size = (spread * step_size * 1000).astype(int)
+    sells = ((1 + spread) * index_price).astype(int)
+    buys = ((1 - spread) * index_price).astype(int)
+
+    if touch is not None:
+        best_bid, best_ask = touch
+        if best_bid is not None:
+            sells = np.maximum(sells, int(best_bid) + 1)
+        if best_ask is not None:
+            buys = np.minimum(buys, -int(-best_ask) - 1)
+
+    return {'side': ['sell'] * pairs + ['buy'] * pairs,
+            'level': np.concatenate((levels, levels)),
+            'price': np.concatenate((sells, buys)),
+            'size': np.concatenate((size, size))}
+
+
+def client_oid(prefix, side, level, size, price, ts):
+    return f'{prefix}-{side[0]}{level}-{size}at{price}ts{ts}'
+
+
+def order_key(oid, prefix):
+    # (side, level) of a ladder clientOid, None for orders placed by anything else
+    if not oid or not oid.startswith(f'{prefix}-'):
+        return None
+
+    tag = oid[len(prefix) + 1:].split('-', 1)[0]
+    side = {'s': 'sell', 'b': 'buy'}.get(tag[:1])
+    if side is None or not tag[1:].isdigit():
+        return None
+
+    return side, int(tag[1:])
+
+
+def plan(targets, orders, prefix, tolerance, frozen=()):
+    '''
+    Compare the target ladder to the live orders and return (cancels, creates, amends).
+    cancels are order ids: duplicates of a level, levels no longer in the ladder and untagged orders with our prefix.
+    creates are (side, level, price, size) for empty levels, amends are (order id, side, level, price, size) for levels
+    whose size changed or whose price moved more than tolerance. Sides in frozen are left exactly as they are.'''
+    live = {}
+    cancels = []
+    for order in orders:
+        key = order_key(order.get('clientOid'), prefix)
+        if key is None:
+            if (order.get('clientOid') or '').startswith(f'{prefix}-'):
+                cancels.append(order['id'])
+        elif key in live:
+            cancels.append(order['id'])
+        else:
+            live[key] = order
+
+    creates, amends = [], []
+    for side, level, price, size in zip(targets['side'], targets['level'].tolist(), targets['price'].tolist(),
+                                        targets['size'].tolist()):
+        order = live.pop((side, level), None)
+        if side in frozen:
+            continue
+
+        if order is None:
+            creates.append((side, level, price, size))
+        elif int(order['size']) != size or abs(price / float(order['price']) - 1) > tolerance:
+            amends.append((order['id'], side, level, price, size))
+
+    cancels.extend(order['id'] for key, order in live.items() if key[0] not in frozen)
+    return cancels, creates, amends
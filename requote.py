@@ -0,0 +1,74 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+
+class RequoteTrigger:
+    '''
+    Decides when the market maker should requote, instead of requoting on a fixed timer.
+    A requote is due once the index has moved more than threshold from the price the ladder was quoted at and debounce
+    seconds have passed since the last quote, as soon as one of our orders fills, or after max_staleness seconds regardless.
+    wake is called whenever a requote may have become due, so the quoting loop can sleep until then.
+    Times are passed in by the caller, so the same trigger runs on the event loop clock and on tape time in a replay.'''
+
+    def __init__(self, threshold, debounce, max_staleness, wake=None):
+        self.threshold = threshold
+        self.debounce = debounce
+        self.max_staleness = max_staleness
+        self.wake = wake
+
+        self.price = None
+        self.quoted_price = None
+        self.quoted_at = None
+        self.fill = False
+
+    def index(self, price):
+        self.price = price
+        if self.moved() and self.wake is not None:
+            self.wake()
+
+    def filled(self):
+        self.fill = True
+        if self.wake is not None:
+            self.wake()
+
+    def moved(self):
+        if self.quoted_price is None or self.price is None:
+            return True
+        return abs(self.price / self.quoted_price - 1) > self.threshold
+
+    def due(self, now):
+        if self.fill or self.quoted_at is None:
+            return True
+        elapsed = now - self.quoted_at
+        return elapsed >= self.max_staleness or (elapsed >= self.debounce and self.moved())
+
+    def wait_time(self, now):
+        # Seconds until a requote falls due if no further index or fill updates arrive
+        if self.due(now):
+            return 0
+        elapsed = now - self.quoted_at
+        return max(0, (self.debounce if self.moved() else self.max_staleness) - elapsed)
+
+    def requoting(self):
+        # Call as a requote starts, fills from here on arrive while its orders are sent and call for another requote
+        self.fill = False
+
+    def quoted(self, price, now):
+        # price is the reference the ladder was planned around, now the time its orders went out
+        self.quoted_price = price
+        self.quoted_at = now
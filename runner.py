@@ -0,0 +1,431 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import os
+import sys
+import json
+import random
+import asyncio
+import importlib.util
+from time import monotonic, perf_counter_ns
+
+from account import AccountState
+from gateway import OrderGateway
+from ingest import TickQueue
+from journal import Journal
+import snapshot
+from metrics import Metrics, pending_messages
+
+
+'''
+Host many (symbol, strategy) bots in one process on one websocket connection and one set of REST clients.
+Each bot keeps its own candles, indicators and trade state, and the runner routes every message by topic,
+so a tick only reaches the bots for the symbol that ticked. Bots that share a symbol share its account cache.
+The websocket callback only queues each message, a separate task delivers them in batches and then evaluates the bots
+that have work due, so a burst of messages costs one evaluation per bot rather than one per message.
+
+    python runner.py bots.json
+
+with bots.json like
+    {"metrics_file": "runner-metrics.txt",
+     "bots": [{"script": "sample-MOM.py", "symbol": "BTCUSDTPERP", "params": {"SLOW_SIG": 16, "FAST_SIG": 4}},
+              {"script": "sample-MM.py", "symbol": "ETHUSDTPERP", "params": {"INTERVAL": 15, "MIN_SPREAD": 0.001}}]}
+
+Add "feed": true to read the public channels from a running feed.py publisher instead of this process's websocket.
+A websocket that goes silent for "stale_after" seconds, 5 by default, is reconnected and the gap backfilled over REST.
+Add "journal_file": "runner-journal.jsonl" to keep a replayable journal of the signals, orders, fills and positions.'''
+
+_SCRIPTS = {}
+_FILL_FIELDS = ('orderId', 'clientOid', 'side', 'type', 'price', 'size', 'matchPrice', 'matchSize', 'filledSize',
+                'remainSize', 'ts')
+
+
+def load_script(script):
+    # Import a strategy script by path, the sample scripts are not importable by name
+    path = os.path.abspath(script)
+    if path not in _SCRIPTS:
+        if os.path.dirname(path) not in sys.path:
+            sys.path.insert(0, os.path.dirname(path))
+        name = os.path.splitext(os.path.basename(path))[0].replace('-', '_')
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _SCRIPTS[path] = module
+
+    return _SCRIPTS[path]
+
+
+def resolve_params(names, defaults, overrides):
+    # A bot's parameters, the script's module constants with any per instance overrides applied
+    unknown = set(overrides) - set(names)
+    if unknown:
+        raise ValueError(f'Unknown parameters {sorted(unknown)}, expected some of {list(names)}')
+
+    return {name: overrides.get(name, defaults[name]) for name in names}
+
+
+class Runner:
+
+    def __init__(self, market, trade, gateway, metrics=None, queue_size=10_000, journal=None):
+        self.market = market
+        self.trade = trade
+        self.gateway = gateway
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.journal = journal if journal is not None else Journal(enabled=False)
+        self.queue = TickQueue(queue_size)
+        self.wake = None
+        self.live = None
+        self.heard = None
+        self.heartbeats = set()
+        self.reconnects = 0
+
+        self.bots = []
+        self.accounts = {}
+        self.routes = {}
+        self.symbol_bots = {}
+        if hasattr(gateway, 'accounts'):
+            # The gateway schedules position reducing orders first and batches cancels from the account caches
+            gateway.accounts = self.accounts
+
+    def add(self, bot_class, symbol, **params):
+        account = self.accounts.get(symbol)
+        if account is None:
+            account = self.accounts[symbol] = AccountState(self.trade, symbol)
+            account.reconcile()
+            self.journal.emit('position', symbol, **account.position)
+
+        bot = bot_class(symbol, self.market, account, self.gateway, self.metrics, **params)
+        # Bots emit their signals, orders and quotes to the journal rather than printing from the event loop
+        bot.journal = self.journal
+        self.bots.append(bot)
+        self.symbol_bots.setdefault(symbol, []).append(bot)
+        for topic in bot.topics():
+            self.routes.setdefault(topic, []).append(bot)
+        self._coalesce()
+        return bot
+
+    def _coalesce(self):
+        # A topic coalesces in the queue only if every bot routed to it just needs its newest message
+        self.queue.latest = {topic for topic, bots in self.routes.items()
+                             if all(topic in getattr(bot, 'coalesce', ()) for bot in bots)}
+
+    def use_feed_candles(self, feed):
+        # Bots that trade on closed candles read the ones the feed publishes, instead of folding its ticks themselves
+        for bot in self.bots:
+            for tick_topic, topic in (bot.feed_candles() if hasattr(bot, 'feed_candles') else {}).items():
+                if feed.carries(topic):
+                    self.routes[tick_topic].remove(bot)
+                    if not self.routes[tick_topic]:
+                        del self.routes[tick_topic]
+                    self.routes.setdefault(topic, []).append(bot)
+        self._coalesce()
+
+    def topics(self):
+        topics = list(self.routes)
+        for account in self.accounts.values():
+            topics += [topic for topic in account.topics() if topic not in topics]
+        return topics
+
+    def receive(self, msg):
+        # Websocket callback, queue the message and hand it to the consume task
+        # Channels subscribed only as a heartbeat show the connection is alive and go no further
+        self.heard = monotonic()
+        if msg.get('topic') in self.heartbeats:
+            return
+        self.queue.put(msg)
+        if self.wake is not None:
+            self.wake.set()
+
+    def deliver(self, msg):
+        # Feed callback, like receive but the websocket's liveness is not the feed's
+        self.queue.put(msg)
+        if self.wake is not None:
+            self.wake.set()
+
+    def dispatch(self, msg):
+        # Market data goes to the bots subscribed to its topic
+        topic = msg.get('topic', '')
+        bots = self.routes.get(topic)
+        if bots is not None:
+            for bot in bots:
+                bot.on_message(msg)
+            return
+
+        # Account updates refresh the account cache of their symbol, then reach that symbol's bots
+        start = perf_counter_ns()
+        symbol = topic.rsplit(':', 1)[1] if ':' in topic else msg.get('data', {}).get('symbol')
+        if symbol is None:
+            accounts = list(self.accounts.values())
+        else:
+            accounts = [self.accounts[symbol]] if symbol in self.accounts else []
+
+        for account in accounts:
+            if account.on_message(msg):
+                self.record(account, msg)
+                for bot in self.symbol_bots[account.symbol]:
+                    bot.on_message(msg)
+        self.metrics.lap('account', start)
+
+    def record(self, account, msg):
+        # Journal the fills and position changes of an account update
+        data = msg.get('data', {})
+        if msg.get('topic') == '/contractMarket/tradeOrders':
+            if data.get('type') in ('match', 'filled'):
+                self.journal.emit('fill', account.symbol, **{key: data[key] for key in _FILL_FIELDS if key in data})
+        elif msg.get('topic', '').startswith('/contract/position:'):
+            self.journal.emit('position', account.symbol, **account.position)
+
+    def evaluate(self, now):
+        # Run the bots whose evaluation has fallen due
+        for bot in self.bots:
+            if hasattr(bot, 'evaluate') and bot.due(now):
+                bot.evaluate(now)
+
+    def wait_time(self, now):
+        # Seconds until the next bot evaluation falls due, None if none is waiting
+        waits = [bot.wait_time(now) for bot in self.bots if hasattr(bot, 'evaluate')]
+        waits = [wait for wait in waits if wait is not None]
+        return min(waits) if waits else None
+
+    async def consume(self, batch=1000):
+        # Deliver queued messages a batch at a time, evaluating after each batch, and yield to the socket in between
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.wait_time(loop.time()))
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+            while True:
+                # Messages stay queued while the bots catch up on a reconnect gap, which can start between batches
+                await self.live.wait()
+                for msg, queued in self.queue.drain(batch):
+                    self.metrics.lap('queue_wait', queued)
+                    # One bad message is dropped, it must not stop delivery to every bot in the process
+                    try:
+                        self.dispatch(msg)
+                    except Exception as e:
+                        print(f'Dispatch Error!\n {e!r}\n {msg.get("topic")}')
+                try:
+                    self.evaluate(loop.time())
+                except Exception as e:
+                    print(f'Evaluate Error!\n {e!r}')
+                if not self.queue:
+                    break
+                await asyncio.sleep(0)
+
+    @staticmethod
+    def _stopped(task):
+        # A background task should run until shutdown, report it if it ends any other way
+        if not task.cancelled() and task.exception() is not None:
+            print(f'Runner Task Error!\n {task.exception()!r}')
+
+    def save_snapshots(self):
+        # Write every bot's warm start snapshot, blocking
+        for bot in self.bots:
+            if getattr(bot, 'snapshot_file', None):
+                try:
+                    snapshot.save(bot.snapshot_file, *bot.snapshot())
+                except OSError as e:
+                    print(f'Snapshot Error!\n {e}')
+
+    async def snapshot_loop(self, interval=60):
+        # State is copied on the loop between messages, only the file writes run in the executor
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await self.live.wait()
+            for bot in self.bots:
+                if getattr(bot, 'snapshot_file', None):
+                    start = perf_counter_ns()
+                    arrays, state = bot.snapshot()
+                    self.metrics.lap('snapshot', start)
+                    try:
+                        await loop.run_in_executor(None, snapshot.save, bot.snapshot_file, arrays, state)
+                    except OSError as e:
+                        print(f'Snapshot Error!\n {e}')
+
+    async def reconnect(self, ws_client, topics, backoff=0.5, max_backoff=30):
+        '''
+        Replace a dropped or silent websocket connection without stopping the bots.
+        Connects and resubscribes with jittered exponential backoff, then holds message delivery while the account caches
+        reconcile and each bot's catch_up backfills the gap over REST, so live messages queued meanwhile land after it.'''
+        start = perf_counter_ns()
+        self.live.clear()
+        while True:
+            try:
+                await ws_client.disconnect()
+            except Exception as e:
+                print(f'Websocket Disconnect Error!\n {e}')
+            try:
+                await ws_client.connect()
+                for topic in topics:
+                    await ws_client.subscribe(topic)
+                break
+            except Exception as e:
+                print(f'Websocket Reconnect Error!\n {e}')
+                await asyncio.sleep(backoff * random.uniform(1, 2))
+                backoff = min(backoff * 2, max_backoff)
+
+        self.heard = monotonic()
+        self.reconnects += 1
+        await self.catch_up()
+        self.metrics.lap('reconnect', start)
+        print(f'Reconnected! Resubscribed to {len(topics)} topics')
+
+    async def catch_up(self):
+        # Hold message delivery while the account caches reconcile and each bot backfills a gap in its data over REST
+        loop = asyncio.get_event_loop()
+        self.live.clear()
+        try:
+            for account in self.accounts.values():
+                account.apply(*await loop.run_in_executor(None, account.fetch))
+            for bot in self.bots:
+                if hasattr(bot, 'catch_up'):
+                    await loop.run_in_executor(None, bot.catch_up)
+        except Exception as e:
+            print(f'Reconnect Backfill Error!\n {e}')
+        finally:
+            self.live.set()
+            self.wake.set()
+
+    async def watchdog(self, ws_client, topics, feed=None, stale_after=5):
+        '''
+        Reconnect the websocket once it has been silent for stale_after seconds. It always carries an instrument channel,
+        which pushes the mark and index prices about every second, so silence means the connection has dropped.
+        The feed publisher reconnects its own websocket, a feed that went silent is caught up once rows flow again.'''
+        feed_gap = False
+        while True:
+            await asyncio.sleep(stale_after / 4)
+            if monotonic() - self.heard > stale_after:
+                print(f'Websocket Silent for {monotonic() - self.heard:.1f}s, Reconnecting')
+                await self.reconnect(ws_client, topics)
+
+            if feed is not None:
+                if monotonic() - feed.heard > stale_after:
+                    if not feed_gap:
+                        print(f'Feed Silent for {monotonic() - feed.heard:.1f}s, Waiting for the Publisher')
+                    feed_gap = True
+                elif feed_gap:
+                    feed_gap = False
+                    self.reconnects += 1
+                    await self.catch_up()
+                    print('Feed Resumed! Backfilled the gap')
+
+    async def stream(self, ws_client, metrics_file=None, feed=None, stale_after=5):
+        # With a shared memory feed, the public topics it carries are read from it and only the rest from the websocket
+        self.wake = asyncio.Event()
+        self.live = asyncio.Event()
+        self.live.set()
+        asyncio.ensure_future(self.consume()).add_done_callback(self._stopped)
+        if feed is not None:
+            self.use_feed_candles(feed)
+        topics = self.topics()
+        if feed is not None:
+            for topic in [topic for topic in topics if feed.carries(topic)]:
+                await feed.subscribe(topic)
+                topics.remove(topic)
+            asyncio.ensure_future(feed.run()).add_done_callback(self._stopped)
+        # Private and trade channels can be quiet for minutes, an instrument channel keeps talking while connected
+        if stale_after and self.accounts and not any(topic.startswith('/contract/instrument:') for topic in topics):
+            heartbeat = f'/contract/instrument:{next(iter(self.accounts))}'
+            self.heartbeats.add(heartbeat)
+            topics.append(heartbeat)
+
+        await ws_client.connect()
+        for topic in topics:
+            await ws_client.subscribe(topic)
+        self.heard = monotonic()
+        if stale_after:
+            asyncio.ensure_future(self.watchdog(ws_client, topics, feed, stale_after)).add_done_callback(self._stopped)
+
+        for account in self.accounts.values():
+            asyncio.ensure_future(account.reconcile_loop()).add_done_callback(self._stopped)
+        asyncio.ensure_future(self.snapshot_loop()).add_done_callback(self._stopped)
+        if metrics_file:
+            self.metrics.probes['ws_pending'] = lambda: pending_messages(ws_client)
+            self.metrics.probes['queue_depth'] = lambda: len(self.queue)
+            self.metrics.probes['queue_coalesced'] = lambda: self.queue.coalesced
+            self.metrics.probes['queue_dropped'] = lambda: self.queue.dropped
+            self.metrics.probes['ws_reconnects'] = lambda: self.reconnects
+            self.metrics.probes['journal_queue'] = lambda: len(self.journal)
+            if hasattr(self.gateway, 'coalesced'):
+                self.metrics.probes['order_queue'] = lambda: len(self.gateway)
+                self.metrics.probes['orders_coalesced'] = lambda: self.gateway.coalesced
+                self.metrics.probes['cancels_batched'] = lambda: self.gateway.batched
+            if feed is not None:
+                self.metrics.probes['feed_overruns'] = lambda: feed.overruns + sum(
+                    reader.overruns for reader in list(feed.readers.values()) + list(feed.bar_readers.values()))
+            asyncio.ensure_future(self.metrics.export_loop(metrics_file)).add_done_callback(self._stopped)
+        for bot in self.bots:
+            if hasattr(bot, 'run'):
+                asyncio.ensure_future(bot.run()).add_done_callback(self._stopped)
+
+        while True:
+            await asyncio.sleep(3600)
+
+    def run(self, ws_client, metrics_file=None, feed=None, stale_after=5):
+        loop = asyncio.get_event_loop()
+
+        try:
+            loop.run_until_complete(self.stream(ws_client, metrics_file, feed, stale_after))
+        except (KeyboardInterrupt, Exception) as e:
+            print(f'Shutting Down {e}')
+        finally:
+            self.save_snapshots()
+            for bot in self.bots:
+                if hasattr(bot, 'shutdown'):
+                    loop.run_until_complete(bot.shutdown())
+            print('Unsubscribing and disconnecting from websocket')
+            loop.run_until_complete(ws_client.disconnect())
+            self.gateway.shutdown()
+            self.journal.close()
+            loop.close()
+
+
+def main(instances, metrics_file=None, feed=False, stale_after=5, journal_file=None):
+    # Run (bot class, symbol, params) instances live, account keys are read from the environment
+    # With feed, public market data is read from the shared memory rings published by feed.py
+    # Signals, orders, fills and positions are appended to journal_file, and summarised on the console
+    from polofutures import RestClient, WsClient
+
+    api_key, secret, api_pass = os.environ['PF_API_KEY'], os.environ['PF_SECRET'], os.environ['PF_PASS']
+    rest_client = RestClient(api_key, secret, api_pass)
+    trade = rest_client.trade_api()
+    metrics = Metrics()
+    runner = Runner(rest_client.market_api(), trade, OrderGateway(trade, metrics=metrics), metrics,
+                    journal=Journal(journal_file))
+
+    for bot_class, symbol, params in instances:
+        runner.add(bot_class, symbol, **params)
+
+    ws_client = WsClient(runner.receive, api_key, secret, api_pass)
+    if feed:
+        from feed import FeedClient
+        feed = FeedClient(runner.deliver)
+    runner.run(ws_client, metrics_file, feed or None, stale_after)
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+
+    print(f'Starting Runner with {len(config["bots"])} bots!')
+    main([(load_script(bot['script']).BOT, bot['symbol'], bot.get('params', {})) for bot in config['bots']],
+         config.get('metrics_file'), config.get('feed', False), config.get('stale_after', 5), config.get('journal_file'))
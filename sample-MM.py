@@ -15,180 +15,212 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE
 
-import os
 import asyncio
-import pandas as pd
-import numpy as np
-from time import sleep, time
+from time import time, perf_counter_ns
 
-from polofutures import RestClient, WsClient
+from book import OrderBook
+from gateway import Superseded
+from reconcile import ladder, client_oid, order_key, plan
+from requote import RequoteTrigger
+from runner import main, resolve_params
 
 _MAX_ROWS = 500
 _LAST_TRADE = 0
 
-# Account Keys
-API_KEY = os.environ['PF_API_KEY']
-SECRET = os.environ['PF_SECRET']
-API_PASS = os.environ['PF_PASS']
-
 # Trading parameters
 SYMBOL = 'BTCUSDTPERP'
 PREFIX = 'POLO_MM'
-INTERVAL = "SET INTERVAL"           # How often the MM loop runs in seconds, e.g. 15 seconds between loops
+INTERVAL = "SET INTERVAL"           # Longest time between requotes in seconds, e.g. 15 seconds between loops
+REQUOTE_THRESHOLD = 0.0005          # Reference price move from the quoted price that triggers a requote, in decimals, e.g. 0.0005 is 0.05%
+DEBOUNCE = 0.5                      # Shortest time between price triggered requotes in seconds, fills requote immediately
 LEVERAGE = '25'                     # How much leverage you require, e.g. 25x leverage
 ORDER_PAIRS = 5                     # Number of order pairs to create, e.g. 5 pairs is 10 total orders
 MIN_SPREAD = "SET MINIMUM SPREAD"   # Minimum allowable spread to capture, in decimals, e.g. 0.001 is 0.1%
 SPREAD_ADJUST = 0.002               # Sensitivity to spread change in decimals, e.g. 0.002 is 0.2% sensitivity
 STEP_SIZE = 5                       # Order step size in lots, from starting position. e.g. first order is 5, then 10,.. 15 and so on
 RISK_LIMITS = {'short': -2000, 'long': 2000} # Maximum allowable position in lots, e.g. -2000 and 2000
+PRICE_SOURCE = 'book'               # Quote around the level 2 book microprice, 'index' to quote around the index price
+METRICS_FILE = 'mm-metrics.txt'    # Per stage latency histograms, rewritten every 10 seconds
+JOURNAL_FILE = 'mm-journal.jsonl'  # Signals, orders, fills and positions, one JSON line each, replay with journal.py
 
-rest_client = RestClient(API_KEY, SECRET, API_PASS)
-
-# Fetch Rest MarketData - Last 100 ticks
-market = rest_client.market_api()
-ticker = [market.get_ticker(SYMBOL)]
-trade = rest_client.trade_api()
+# Parameters that can be set per bot, e.g. from the runner config
+PARAMS = ('PREFIX', 'INTERVAL', 'REQUOTE_THRESHOLD', 'DEBOUNCE', 'LEVERAGE', 'ORDER_PAIRS', 'MIN_SPREAD',
+          'SPREAD_ADJUST', 'STEP_SIZE', 'RISK_LIMITS', 'PRICE_SOURCE')
 
 
 class MarketMaker:
-
-    def __init__(self, lastest_tick):
-        self.latest_tick = lastest_tick
+    '''
+    Market maker for one symbol, all of its state lives on the instance so several can share a process.'''
+
+    def __init__(self, symbol, market, account, gateway, metrics, **params):
+        params = resolve_params(PARAMS, globals(), params)
+        self.symbol = symbol
+        self.account = account
+        self.gateway = gateway
+        self.metrics = metrics
+        self.prefix = params['PREFIX']
+        self.leverage = params['LEVERAGE']
+        self.order_pairs = int(params['ORDER_PAIRS'])
+        self.min_spread = float(params['MIN_SPREAD'])
+        self.spread_adjust = float(params['SPREAD_ADJUST'])
+        self.step_size = params['STEP_SIZE']
+        self.risk_limits = params['RISK_LIMITS']
+        self.trigger = RequoteTrigger(float(params['REQUOTE_THRESHOLD']), float(params['DEBOUNCE']),
+                                      float(params['INTERVAL']))
+
+        self.market = market
+        self.latest_tick = market.get_current_mark_price(symbol)['indexPrice']
+        # The book is kept whichever price is quoted around, the ladder never crosses it while it is synced
+        self.use_book = params['PRICE_SOURCE'] == 'book'
+        self.book = OrderBook(symbol, market.get_contract_detail(symbol)['tickSize'])
+        # Only the newest index matters, a burst of index updates waiting in the runner's queue coalesces into one
+        self.coalesce = {f'/contract/instrument:{symbol}'}
+
+    def topics(self):
+        return [f'/contract/instrument:{self.symbol}', self.book.topic]
+
+    def reference_price(self):
+        # Price the ladder is centred on, the index until the book is synced
+        micro = self.book.microprice() if self.use_book else None
+        return micro if micro is not None else self.latest_tick
 
     def open_orders(self):
-        # Checks open orders on the book, and the spread from real price
-        self.orders = self.orders[
-            ['symbol', 'leverage', 'price', 'value', 'size', 'side', 'id', 'clientOid', 'status']].copy()
-        self.orders.sort_values('price', ascending=False, inplace=True)
-        self.orders['spread'] = self.orders['price'].astype(float) / self.latest_tick - 1
-        self.orders.reset_index(drop=True, inplace=True)
+        # Live orders on the book, ladder orders are matched to their level by clientOid
+        self.orders = self.account.open_orders()
 
     async def mm_loop(self):
-        # This is the MM loop that runs at every set interval specified in the parameters
+        # This is the MM loop that runs whenever a requote is due
+        t = perf_counter_ns()
         self.trade_status()
+        t = self.metrics.lap('mm_status', t)
         self.prepare_orders()
-        self.place_orders()
+        t = self.metrics.lap('mm_plan', t)
+        await self.place_orders()
+        self.metrics.lap('mm_orders', t)
 
     def trade_status(self):
-        # Trade status updates
-        self.position = trade.get_position_details(SYMBOL)
-        self.orders = pd.DataFrame(trade.get_order_list(status='active')['items'])
-
-        print(f'\n------\n'
-              f'Time - {int(time())}\n'
-              f'Index Price {self.latest_tick}\n'
-              f'Position - {self.position["currentQty"]}\n'
-              f'Current Open Orders - {self.orders.shape[0]}\n'
-              f'Entry Price - {self.position["avgEntryPrice"]}\n'
-              f'liquidation Price - {self.position["liquidationPrice"]}\n'
-              f'Unrealised Pnl - {self.position["unrealisedRoePcnt"] * 100}%\n')
+        # Trade status updates, read from the websocket driven account cache
+        self.position = self.account.position
+        self.open_orders()
 
     def prepare_orders(self):
-        # Prepare orders as they should be
-        self.prep_orders = pd.DataFrame(
-            {'orderNum': range(ORDER_PAIRS * 2), 'side': ['sell'] * ORDER_PAIRS + ['buy'] * ORDER_PAIRS})
-        self.prep_orders['spread_target'] = np.where(self.prep_orders['side'] == 'sell',
-                                                    MIN_SPREAD * (ORDER_PAIRS - self.prep_orders['orderNum']),
-                                                    MIN_SPREAD * (ORDER_PAIRS - (1 + self.prep_orders['orderNum']))
-                                                    )
-        self.prep_orders['price_target'] = ((1 + self.prep_orders['spread_target']) * self.latest_tick).astype(int)
-        self.prep_orders['size'] = (abs(self.prep_orders['spread_target']) * STEP_SIZE * 1000).astype(int)
-
-
-        # Compare to orders that exist
-        # If no orders exist, place the starter orders
-        if self.orders.shape[0] == 0:
-            print('No Orders Found!\nPlacing Starting Orders...')
-            # print(self.prep_orders.to_string()) -- Use this for debugging
-
-        # Else place orders based on existing
-        else:
-            self.open_orders()
-            self.prep_orders = pd.merge(self.prep_orders, self.orders, on=['side', 'size'], how='left').fillna('No Order')
-            print(self.prep_orders.to_string())
-
-    def place_orders(self):
-
-        for index, row in self.prep_orders.iterrows():
-            if self.position["currentQty"] > RISK_LIMITS['long'] and row['side'] == 'buy':
-                print(f'Long risk limit Exceeded {RISK_LIMITS["long"]}')
-
-            elif self.position["currentQty"] < RISK_LIMITS['short'] and row['side'] == 'short':
-                print(f'Short risk limit Exceeded {RISK_LIMITS["short"]}')
-
-            else:
-                clientId = f'{PREFIX}-' \
-                           f'{row["side"][0]}' \
-                           f'{int(row["size"])}' \
-                           f'at{row["price_target"]}' \
-                           f'ts{int(time())}'
-
-                if self.orders.shape[0] < ORDER_PAIRS * 2:
-                    if 'id' not in self.prep_orders or row['id'] == 'No Order':
-                        orderid = trade.create_limit_order(symbol=SYMBOL,
-                                                 side=row['side'],
-                                                 leverage=LEVERAGE,
-                                                 size=row['size'],
-                                                 price=str(row['price_target']),
-                                                 postOnly=True,
-                                                 clientOid=clientId)
-                        print(f'Order Placed! ClientID: {clientId}\tServer ID: {orderid["orderId"]}')
-
-                if self.orders.shape[0] > 0 and row['spread'] != 'No Order':
-                    # Adjust the existing orders on the book
-                    spread_move = abs(row['price_target']/int(row['price']) - 1)
-                    if spread_move > MIN_SPREAD*(1+SPREAD_ADJUST):
-                        trade.cancel_order(row['id'])
-                        orderid = trade.create_limit_order(symbol=SYMBOL,
-                                                 side=row['side'],
-                                                 leverage=LEVERAGE,
-                                                 size=row['size'],
-                                                 price=str(row['price_target']),
-                                                 postOnly=True,
-                                                 clientOid=clientId)
-                        print(f'Order Adjusted! ClientID: {row["clientOid"]}\tServer ID: {orderid["orderId"]}')
-
-
-def get_index(msg):
-    if msg['topic'] == f'/contract/instrument:{SYMBOL}':
-        if 'indexPrice' in msg['data']:
-            global CURRENT_INDEX
-            CURRENT_INDEX = msg['data']['indexPrice']
-        else:
-            pass
-
-
-async def ws_stream():
-    async def mm_async_loop():
+        # Prepare orders as they should be, and the cancels, creates and amends that get the book there
+        touch = (self.book.best_bid(), self.book.best_ask()) if self.book.synced else None
+        self.prep_orders = ladder(self.reference_price(), self.order_pairs, self.min_spread, self.step_size, touch)
+
+        frozen = []
+        if self.position["currentQty"] > self.risk_limits['long']:
+            self.journal.emit('risk', self.symbol, message=f'Long risk limit Exceeded {self.risk_limits["long"]}')
+            frozen.append('buy')
+        elif self.position["currentQty"] < self.risk_limits['short']:
+            self.journal.emit('risk', self.symbol, message=f'Short risk limit Exceeded {self.risk_limits["short"]}')
+            frozen.append('sell')
+
+        self.cancels, self.creates, self.amends = plan(self.prep_orders, self.orders, self.prefix,
+                                                       self.min_spread * (1 + self.spread_adjust), frozen)
+        self.journal.emit('quote', self.symbol, reference=self.reference_price(), index=self.latest_tick,
+                          bid=self.book.best_bid(), ask=self.book.best_ask(), orders=len(self.orders),
+                          cancels=len(self.cancels), creates=len(self.creates), amends=len(self.amends))
+
+    async def place_orders(self):
+        # Cancels go out first as one batch, so stale quotes are off the book before new ones are placed
+        # The gateway folds them into one cancel all when every open order on the symbol is one of ours
+        cancels = self.cancels + [amend[0] for amend in self.amends]
+        results = await self.gateway.cancel_many(cancels, self.prefix)
+
+        requests = [self.create_order(side, level, price, size, 'Placed') for side, level, price, size in self.creates]
+        requests += [self.create_order(side, level, price, size, 'Adjusted') for _, side, level, price, size in self.amends]
+        results += await asyncio.gather(*requests, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, Superseded):
+                print(f'Order Error!\n {result!r}')
+
+    async def create_order(self, side, level, price, size, action):
+        clientId = client_oid(self.prefix, side, level, size, price, int(time()))
+        orderid = await self.gateway.place(symbol=self.symbol,
+                                           side=side,
+                                           leverage=self.leverage,
+                                           size=size,
+                                           price=str(price),
+                                           postOnly=True,
+                                           clientOid=clientId,
+                                           key=(self.symbol, side, level))
+        self.journal.emit('order', self.symbol, action=action, side=side, level=level, size=size, price=price,
+                          clientOid=clientId, orderId=orderid['orderId'])
+
+    def on_message(self, msg):
+        start = perf_counter_ns()
+        if msg['topic'] == '/contractMarket/tradeOrders':
+            # A fill on one of our levels requotes straight away
+            if msg['data'].get('type') in ('match', 'filled') \
+                    and order_key(msg['data'].get('clientOid'), self.prefix) is not None:
+                self.trigger.filled()
+
+        elif msg['topic'] == f'/contract/instrument:{self.symbol}':
+            if 'indexPrice' in msg['data']:
+                self.latest_tick = msg['data']['indexPrice']
+                self.trigger.index(self.reference_price())
+                self.metrics.lap('index', start)
+
+        elif self.book.on_message(msg):
+            if self.use_book and self.book.synced:
+                self.trigger.index(self.reference_price())
+            self.metrics.lap('book', start)
+
+    def catch_up(self):
+        # After a reconnect the index may be stale and the book has missed deltas, quote around a fresh index until it resyncs
+        self.latest_tick = self.market.get_current_mark_price(self.symbol)['indexPrice']
+        self.book.invalidate()
+
+    async def requote(self, now, clock=None):
+        # The ladder is planned before the first await, so the price it was quoted around is the one read here
+        self.trigger.requoting()
+        price = self.reference_price()
         try:
-            mm = MarketMaker(CURRENT_INDEX)
-            await mm.mm_loop()
-            await asyncio.sleep(INTERVAL)
-        except Exception as e:
-            print(f'Market Maker Error!\n'
-                  f'Check Parameter Inputs\n {e}')
-
-    await ws_client.connect()
-    await ws_client.subscribe(f'/contract/instrument:{SYMBOL}')
-
-    while True:
-        await mm_async_loop()
-        await asyncio.sleep(0.1)
-
-print('Starting Market Maker!')
-CURRENT_INDEX = market.get_current_mark_price(SYMBOL)['indexPrice']
-ws_client = WsClient(get_index, API_KEY, SECRET, API_PASS)
-loop = asyncio.get_event_loop()
-
-try:
-    loop.run_until_complete(ws_stream())
-except (KeyboardInterrupt, Exception) as e:
-    print(f'Stream Error\n {e}')
-finally:
-    print('Cancelling Orders and Shutting Down')
-    trade.cancel_all_limit_orders(SYMBOL)
-    print('Unsubscribing and disconnecting from websocket')
-    loop.run_until_complete(ws_client.disconnect())
-    loop.close()
-
-
+            await self.mm_loop()
+        finally:
+            self.trigger.quoted(price, clock() if clock is not None else now)
+
+    async def run(self):
+        # Sleep until the reference price moves, an order fills or the ladder goes stale
+        loop = asyncio.get_event_loop()
+        wake = asyncio.Event()
+        self.trigger.wake = wake.set
+        asyncio.ensure_future(self.book.sync_loop(self.market)).add_done_callback(self._book_stopped)
+
+        while True:
+            try:
+                await asyncio.wait_for(wake.wait(), self.trigger.wait_time(loop.time()))
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+
+            if self.trigger.due(loop.time()):
+                try:
+                    await self.requote(loop.time(), loop.time)
+                except Exception as e:
+                    print(f'Market Maker Error!\n'
+                          f'Check Parameter Inputs\n {e}')
+
+    @staticmethod
+    def _book_stopped(task):
+        # The book only resyncs while sync_loop runs, report it if it ends any other way
+        if not task.cancelled() and task.exception() is not None:
+            print(f'Order Book Task Error!\n {task.exception()!r}')
+
+    async def shutdown(self):
+        print('Cancelling Orders and Shutting Down')
+        # Only this bot's orders, those of other bots and orders placed by hand on the symbol stay on the book
+        self.open_orders()
+        ours = [order['id'] for order in self.orders if (order.get('clientOid') or '').startswith(f'{self.prefix}-')]
+        await self.gateway.cancel_many(ours, self.prefix)
+
+
+# Strategy class the runner and backtester build bots from
+BOT = MarketMaker
+
+
+if __name__ == "__main__":
+    print('Starting Market Maker!')
+    main([(MarketMaker, SYMBOL, {})], METRICS_FILE, journal_file=JOURNAL_FILE)
@@ -15,161 +15,259 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE
 
-import os
-import asyncio
-import pandas as pd
-from talib._ta_lib import MOM
+from collections import deque
+from time import perf_counter_ns, time_ns
 
-from polofutures import RestClient, WsClient
+import backfill
+from candles import CandleBuffer
+from feed import candle_topic
+from indicators import Momentum
+from ingest import BarClose
+from runner import main, resolve_params
+import snapshot
 
 
-_MAX_ROWS = 500
-_LAST_TRADE = 0
-
-# Account Keys
-API_KEY = os.environ['PF_API_KEY']
-SECRET = os.environ['PF_SECRET']
-API_PASS = os.environ['PF_PASS']
+_MAX_ROWS = 500         # Closed candles kept in memory
+METRICS_FILE = 'mom-metrics.txt'   # Per stage latency histograms, rewritten every 10 seconds
+JOURNAL_FILE = 'mom-journal.jsonl'   # Signals, orders, fills and positions, one JSON line each, replay with journal.py
 
 # Trading parameters
 SYMBOL = 'BTCUSDTPERP'
+INDEX_SYMBOL = '.PXBTUSDT'                  # Index the momentum signals are built from
 LEVERAGE = '25'
 TRADE_SIZE = 5                              # Trade size in lots
 MAX_SLIPPAGE = 0.025                        # Maximum slippage for market orders
 SLOW_SIG = "INSERT SLOW SIGNAL SPAN"        # Set slow momentum signal speed, e.g. 16
 FAST_SIG = "INSERT FAST SIGNAL SPAN"        # Set fast momentum signal speed, e.g. 4
 RISK_LIMITS = {'short' : -500, 'long' : 500}
+EVAL_INTERVAL = 0                           # Shortest time between evaluations in seconds, 0 evaluates on every candle close
+SNAPSHOT_FILE = 'mom-{symbol}.snap'         # Warm start snapshot of the candles and indicators, '' to always start cold
 
-rest_client = RestClient(API_KEY, SECRET, API_PASS)
-
-# Fetch Rest MarketData - Last 100 ticks
-market = rest_client.market_api()
-trade = rest_client.trade_api()
-
-mkt_data = market.get_index_list(".PXBTUSDT", maxCount=100)['dataList']
-
-# Cleanup historical data to match the ws stream
-for d in mkt_data:
-    del d['decomposionList']
-    d['timestamp'] = d.pop('timePoint')
-    d['price'] = d.pop('value')
+# Parameters that can be set per bot, e.g. from the runner config
+PARAMS = ('INDEX_SYMBOL', 'LEVERAGE', 'TRADE_SIZE', 'MAX_SLIPPAGE', 'SLOW_SIG', 'FAST_SIG', 'RISK_LIMITS',
+          'EVAL_INTERVAL', 'SNAPSHOT_FILE')
 
-'''
-Create some OHLC data for technical analysis, and signalling of the algo
-Set your timeframe 30S, 1M, 5M, etc. Note that longer timeframes will need a longer initialisation period
-as we are dealing with tick data, and constructing our own candlesticks. We are attempting to create a fast acting trade bot'''
 
-
-def ohlc(mkt_data, tf='15S'):
-    if len(mkt_data) > _MAX_ROWS: mkt_data.pop(0)
-    mkt_data_df = pd.DataFrame(mkt_data)
-    mkt_data_df['price'] = mkt_data_df['price'].astype(float)
-    mkt_data_df.index = pd.to_datetime(mkt_data_df['timestamp'], unit='ms')
-    _ohlc = mkt_data_df['price'].resample(tf).ohlc()
-    ohlc_df = _ohlc
-
-    return ohlc_df
+def ohlc(mkt_data, tick):
+    # Fold the tick into the forming candle, returns the number of candles it closed
+    return mkt_data.update(int(tick['timestamp']) * 1_000_000, float(tick['price']))
 
 
 class Strategy:
-    def __init__(self, ohlc_df):
-        self.ohlc_df = ohlc_df
-        self.signal = []
-        self.position = trade.get_position_details(SYMBOL)
-        self.close = self.ohlc_df['close'].values
-
-    def dual_momentum(self, slow, fast):
+    '''
+    Dual momentum trader for one symbol, all of its state lives on the instance so several can share a process.
+    Indicator and signal state is carried from bar to bar, so each closed candle is an O(1) update.
+    Only the most recent closed candle can change a decision, the forming candle is never traded on.
+    Ticks only fold into the candles, the runner calls evaluate once candles have closed.'''
+
+    def __init__(self, symbol, market, account, gateway, metrics, **params):
+        params = resolve_params(PARAMS, globals(), params)
+        self.symbol = symbol
+        self.account = account
+        self.gateway = gateway
+        self.metrics = metrics
+        self.leverage = params['LEVERAGE']
+        self.trade_size = params['TRADE_SIZE']
+        self.max_slippage = params['MAX_SLIPPAGE']
+        self.risk_limits = params['RISK_LIMITS']
+
+        self.smom = Momentum(int(params['SLOW_SIG']))
+        self.fmom = Momentum(int(params['FAST_SIG']))
+        self.bars = BarClose(float(params['EVAL_INTERVAL']))
+        self.signal = {}
+        self.signals = deque(maxlen=5)
+        self.position = {}
+        self.last_trade = 0
+        self._entry = 0
 
-        self.ohlc_df['SMOM'] = MOM(self.close, slow)
-        self.ohlc_df['FMOM'] = MOM(self.close, fast)
-
-    def trade_signal(self, slow, fast):
+        '''
+        Create some OHLC data for technical analysis, and signalling of the algo
+        Set your timeframe 30S, 1M, 5M, etc. Note that longer timeframes will need a longer initialisation period
+        as we are dealing with tick data, and constructing our own candlesticks. We are attempting to create a fast acting trade bot'''
+        self.mkt_data = CandleBuffer(tf='15S', capacity=_MAX_ROWS, dropna=False)
+
+        self.market = market
+        self.index_symbol = params['INDEX_SYMBOL']
+        self.resume = 0
+        self.candle_topic = candle_topic(symbol, 'index', self.mkt_data.tf)
+
+        self.snapshot_file = params['SNAPSHOT_FILE'].format(symbol=symbol)
+        self.restore()
+
+        # Warm the indicators up on the index since the snapshot, or enough of it for a full buffer
+        self.update(self.mkt_data.closed(self._backfill()))
+
+    def _backfill(self):
+        # Fold the index since the last tick into the candles over REST, returns the number of candles closed
+        now = time_ns()
+        # No older than a full buffer, the candles of an older snapshot would all be pushed out by the ones after it
+        oldest = now - self.mkt_data.capacity * self.mkt_data.tf_ns
+        start = max(self.mkt_data.last_ts + 1, oldest) if self.mkt_data.last_ts is not None else oldest
+        history = backfill.fetch(self.market, self.index_symbol, -(-start // 1_000_000), now // 1_000_000, 'index')
+        closed = 0
+        for ts, price in zip(history['ts'].tolist(), history['price'].tolist()):
+            closed += self.mkt_data.update(ts, price)
+
+        # Live ticks up to the last backfilled one are already in the candles
+        self.resume = self.mkt_data.last_ts or 0
+        return closed
+
+    def catch_up(self):
+        # Fill a gap in the stream after a reconnect, the candles it closed are evaluated like live ones
+        self.bars.closed(self._backfill())
+
+    def snapshot(self):
+        # Candles, indicators and trade state for the next warm start
+        arrays, candles = self.mkt_data.snapshot()
+        return arrays, {'candles': candles, 'smom': self.smom.state(), 'fmom': self.fmom.state(), 'entry': self._entry,
+                        'last_trade': self.last_trade, 'signals': list(self.signals)}
+
+    def restore(self):
+        # Pick up from the snapshot if there is one, a snapshot from other candle settings is ignored
+        if not self.snapshot_file:
+            return
+        try:
+            loaded = snapshot.load(self.snapshot_file)
+            if loaded is None:
+                return
+            arrays, state = loaded
+            self.mkt_data.restore(arrays, state['candles'])
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Snapshot Ignored!\n {e}')
+            return
+
+        self.last_trade = state['last_trade']
+        try:
+            self.smom.restore(state['smom'])
+            self.fmom.restore(state['fmom'])
+            self._entry = state['entry']
+            self.signals.extend(state['signals'])
+            self.signal = self.signals[-1] if self.signals else {}
+        except (ValueError, KeyError):
+            # Indicator spans changed since the snapshot, recompute them over the restored candles
+            self.smom, self.fmom = Momentum(self.smom.timeperiod), Momentum(self.fmom.timeperiod)
+            self.update(self.mkt_data.closed())
+        print(f'Warm Start! Restored {len(self.mkt_data)} candles from {self.snapshot_file}')
+
+    def topics(self):
+        return [f'/contract/instrument:{self.symbol}']
+
+    def feed_candles(self):
+        # With a feed, the 15 second index candles it publishes stand in for the index prices
+        return {f'/contract/instrument:{self.symbol}': self.candle_topic}
+
+    def dual_momentum(self, close):
+        return self.smom.update(close), self.fmom.update(close)
+
+    def update(self, bars):
+        # Step the indicators and signal state over a batch of closed candles, oldest first
+        for i in range(len(bars['ts'])):
+            bar = {column: bars[column][i] for column in ('ts', 'open', 'high', 'low', 'close')}
+            self.signal = self.trade_signal(bar)
+            self.signals.append(self.signal)
+
+    def trade_signal(self, bar):
         '''
         Tweak trade signal or create strategies here
         This is a dual momentum strategy, if both fast and slow mometum signals are greater than zero we buy
         if both are lower than zero we sell'''
-        self.dual_momentum(slow, fast)
+        bar['SMOM'], bar['FMOM'] = self.dual_momentum(bar['close'])
 
-        self.ohlc_df.loc[((self.ohlc_df['SMOM'] > 0) & (self.ohlc_df['FMOM'] > 0)), 'Signal'] = 'buy'
-        self.ohlc_df.loc[((self.ohlc_df['SMOM'] < 0) & (self.ohlc_df['FMOM'] < 0)), 'Signal'] = 'sell'
+        signal = 0
+        if bar['SMOM'] > 0 and bar['FMOM'] > 0:
+            signal = 'buy'
+        elif bar['SMOM'] < 0 and bar['FMOM'] < 0:
+            signal = 'sell'
 
-        self.ohlc_df['Position'] = self.ohlc_df['Signal'].copy()
-        self.ohlc_df['Position'].ffill(inplace=True)
+        # Position carries the last signal forward
+        if signal:
+            self._entry = signal
 
-        self.ohlc_df.fillna(0, inplace=True)
-        self.execute_trade()
-        self.trade_status()
+        bar['Signal'] = signal
+        bar['Position'] = self._entry
+        return bar
 
-    def execute_trade(self, MAX_SLIPPAGE=0.025):
-        global _LAST_TRADE
-        global RISK_LIMITS
-        # Use the last known candle to trade, most recent is still forming.
-        self.signal = self.ohlc_df.iloc[-2]
+    def execute_trade(self):
+        # Use the last closed candle to trade
+        self.position = self.account.position
 
         # Using limit orders to control potential slippage
-        if self.signal['Signal'] == 'sell' and _LAST_TRADE < self.signal.name.value:
-            _LAST_TRADE = self.signal.name.value
-            price = int(self.signal['close']*(1 - MAX_SLIPPAGE))
-            if self.position["currentQty"] < RISK_LIMITS['short']:
-                print(f'Short risk limit Exceeded {RISK_LIMITS["short"]}')
+        if self.signal['Signal'] == 'sell' and self.last_trade < self.signal['ts']:
+            self.last_trade = self.signal['ts']
+            price = int(self.signal['close']*(1 - self.max_slippage))
+            if self.position["currentQty"] < self.risk_limits['short']:
+                self.journal.emit('risk', self.symbol, message=f'Short risk limit Exceeded {self.risk_limits["short"]}')
             else:
-                order = trade.create_limit_order(symbol=SYMBOL, side=self.signal['Signal'], leverage=LEVERAGE, size=TRADE_SIZE,
-                                                 price=str(price))
-
-        elif self.signal['Signal'] == 'buy' and _LAST_TRADE < self.signal.name.value:
-            _LAST_TRADE = self.signal.name.value
-            price = int(self.signal['close'] * (1 + MAX_SLIPPAGE))
-            if self.position["currentQty"] > RISK_LIMITS['long']:
-                print(f'Long risk limit Exceeded {RISK_LIMITS["long"]}')
+                self.gateway.submit(self.gateway.place(symbol=self.symbol, side=self.signal['Signal'], leverage=self.leverage,
+                                                       size=self.trade_size, price=str(price)), 'Momentum Trader Order')
+                self.journal.emit('order', self.symbol, side=self.signal['Signal'], size=self.trade_size, price=price,
+                                  bar=self.signal['ts'])
+
+        elif self.signal['Signal'] == 'buy' and self.last_trade < self.signal['ts']:
+            self.last_trade = self.signal['ts']
+            price = int(self.signal['close'] * (1 + self.max_slippage))
+            if self.position["currentQty"] > self.risk_limits['long']:
+                self.journal.emit('risk', self.symbol, message=f'Long risk limit Exceeded {self.risk_limits["long"]}')
             else:
-                order = trade.create_limit_order(symbol=SYMBOL, side=self.signal['Signal'], leverage=LEVERAGE, size=TRADE_SIZE,
-                                                 price=str(price))
-
-    def trade_status(self):
-        # Trade status updates
-        print(f'Latest Signals:\n '
-              f'{self.ohlc_df.tail(5).to_string()}\n')
-        print(f'Current Position:\n'
-              f'Position {self.position["currentQty"]}\n'
-              f'Entry Price {self.position["avgEntryPrice"]}\n'
-              f'liquidation Price {self.position["liquidationPrice"]}\n'
-              f'Unrealised Pnl {self.position["unrealisedRoePcnt"]*100}%\n')
-
-
-def gen_signal(msg):
-    if msg['topic'] == f'/contract/instrument:{SYMBOL}':
-        new_ticks = msg["data"]
-        new_ticks.pop('symbol', None)
-        new_ticks['price'] = new_ticks.pop('indexPrice')
-        mkt_data.append(new_ticks)
-
-        # Setup the algo and run, ensure parameters are set
+                self.gateway.submit(self.gateway.place(symbol=self.symbol, side=self.signal['Signal'], leverage=self.leverage,
+                                                       size=self.trade_size, price=str(price)), 'Momentum Trader Order')
+                self.journal.emit('order', self.symbol, side=self.signal['Signal'], size=self.trade_size, price=price,
+                                  bar=self.signal['ts'])
+
+    def trade_status(self, closed=1):
+        # Journal the signals stepped since the last evaluation, the journal's writer thread formats and prints them
+        for bar in list(self.signals)[-closed:] if closed else ():
+            self.journal.emit('signal', self.symbol, **bar)
+
+    def on_message(self, msg):
+        if msg['topic'] == f'/contract/instrument:{self.symbol}' and 'indexPrice' in msg['data']:
+            start = perf_counter_ns()
+            # Other bots on this symbol see the same message, so it is not modified in place
+            new_ticks = dict(msg["data"], price=msg["data"]['indexPrice'])
+
+            try:
+                ts = int(new_ticks['timestamp']) * 1_000_000
+                if ts <= self.resume:
+                    return
+                self.metrics.observe('ws_age', time_ns() - ts)
+                self.bars.closed(ohlc(self.mkt_data, new_ticks))
+                self.metrics.lap('candles', start)
+            except Exception as e:
+                print(f'Momentum Trader Error!\n'
+                      f'Check Parameter Inputs\n {e}')
+
+        elif msg['topic'] == self.candle_topic:
+            start = perf_counter_ns()
+            self.bars.closed(self.mkt_data.extend(msg['data']))
+            self.metrics.lap('candles', start)
+
+    def due(self, now):
+        return self.bars.due(now)
+
+    def wait_time(self, now):
+        return self.bars.wait_time(now)
+
+    def evaluate(self, now):
+        # Step the signals over every candle closed since the last evaluation, then trade on the newest
+        start = perf_counter_ns()
         try:
-            ohlc_data = ohlc(mkt_data)
-            strat = Strategy(ohlc_data)
-            strat.trade_signal(SLOW_SIG, FAST_SIG)
+            closed = self.bars.take(now)
+            self.update(self.mkt_data.closed(closed))
+            t = self.metrics.lap('signals', start)
+            self.execute_trade()
+            t = self.metrics.lap('execute', t)
+            self.trade_status(closed)
+            self.metrics.lap('status', t)
+            self.metrics.lap('evaluate', start)
         except Exception as e:
             print(f'Momentum Trader Error!\n'
                   f'Check Parameter Inputs\n {e}')
 
 
-async def ws_stream():
-
-    await ws_client.connect()
-    await ws_client.subscribe(f'/contract/instrument:{SYMBOL}')
+# Strategy class the runner and backtester build bots from
+BOT = Strategy
 
 
 if __name__ == "__main__":
     print('Starting Momentum Trader!')
-    ws_client = WsClient(gen_signal, API_KEY, SECRET, API_PASS)
-    loop = asyncio.get_event_loop()
-
-    try:
-        loop.create_task(ws_stream())
-        loop.run_forever()
-    except (KeyboardInterrupt, Exception) as e:
-        print(f'Shutting Down {e}')
-        loop.run_until_complete(ws_client.disconnect())
-    finally:
-        loop.close()
-
+    main([(Strategy, SYMBOL, {})], METRICS_FILE, journal_file=JOURNAL_FILE)
@@ -15,20 +15,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE
 
-import os
-import asyncio
-import pandas as pd
-from talib._ta_lib import RSI, BBANDS
+from collections import deque
+from time import perf_counter_ns, time_ns
 
-from polofutures import RestClient, WsClient
+import backfill
+from candles import CandleBuffer
+from feed import candle_topic
+from indicators import RSI, BBands
+from ingest import BarClose
+from runner import main, resolve_params
+import snapshot
 
 
-MAX_ROWS = 500
-
-# Account Keys
-API_KEY = os.environ['PF_API_KEY']
-SECRET = os.environ['PF_SECRET']
-API_PASS = os.environ['PF_PASS']
+MAX_ROWS = 500      # Closed candles kept in memory
+METRICS_FILE = 'rsibbp-metrics.txt'   # Per stage latency histograms, rewritten every 10 seconds
+JOURNAL_FILE = 'rsibbp-journal.jsonl'   # Signals, orders, fills and positions, one JSON line each, replay with journal.py
 
 # Trading parameters
 SYMBOL = 'BTCUSDTPERP'
@@ -37,130 +38,253 @@ TRADE_SIZE = 50
 MAX_SLIPPAGE = 0.025
 RSI_SPAN = "SET RSI SPAN"    # RSI indicator span, e.g. 12
 BB_SPAN = "SET BBAND SPAN"      # BB indicator span, e.g. 20
+EVAL_INTERVAL = 0     # Shortest time between evaluations in seconds, 0 evaluates on every candle close
+SNAPSHOT_FILE = 'rsibbp-{symbol}.snap'   # Warm start snapshot of the candles and indicators, '' to always start cold
 
-rest_client = RestClient(API_KEY, SECRET, API_PASS)
-
-# Fetch Rest MarketData - Last 100 ticks
-market = rest_client.market_api()
-mkt_data = market.get_trade_history(SYMBOL)[::-1]
-trade = rest_client.trade_api()
-last_trade = 0
-
-'''
-Create some OHLC data for technical analysis, and signalling of the algo
-Set your timeframe 30S, 1T, 5T, etc. Note that longer timeframes will need a longer initialisation period
-as we are dealing with tick data, and constructing our own candlesticks'''
+_KLINE_NS = 60_000_000_000     # Backfill klines are 1 minute
 
-def ohlcv(mkt_data, tf='1T'):
-    if len(mkt_data) > MAX_ROWS: mkt_data.pop(0)
-    mkt_data_df = pd.DataFrame(mkt_data)
-    mkt_data_df['price'] = mkt_data_df['price'].astype(float)
+# Parameters that can be set per bot, e.g. from the runner config
+PARAMS = ('LEVERAGE', 'TRADE_SIZE', 'MAX_SLIPPAGE', 'RSI_SPAN', 'BB_SPAN', 'EVAL_INTERVAL', 'SNAPSHOT_FILE')
 
-    mkt_data_df.index = pd.to_datetime(mkt_data_df['ts'], unit='ns')
-    _ohlc = mkt_data_df['price'].resample(tf).ohlc()
-    _vol = mkt_data_df['size'].resample(tf).sum()
-    ohlcv_df = _ohlc.join(_vol).dropna()
 
-    return ohlcv_df
+def ohlcv(mkt_data, tick):
+    # Fold the tick into the forming candle, returns the number of candles it closed
+    return mkt_data.update(int(tick['ts']), float(tick['price']), int(tick['size']))
 
 
 class Strategy:
-    def __init__(self, ohlcv_df):
-        self.ohlcv_df = ohlcv_df
-        self.signal = []
-        self.position = trade.get_position_details(SYMBOL)
-        self.close = self.ohlcv_df['close'].values
-
-    def bbp(self, timeperiod, nbdevup=2, nbdevdn=2, matype=0):
-        up, mid, low = BBANDS(self.close, timeperiod, nbdevup, nbdevdn, matype)
-        self.ohlcv_df['BBP'] = (self.ohlcv_df['close'] - low) / (up - low)
-
-    def rsif(self, timeperiod):
-        self.ohlcv_df['RSI'] = RSI(self.close, timeperiod)
+    '''
+    RSI-BBand trader for one symbol, all of its state lives on the instance so several can share a process.
+    Indicator and signal state is carried from bar to bar, so each closed candle is an O(1) update.
+    Only the most recent closed candle can change a decision, the forming candle is never traded on.
+    Ticks only fold into the candles, the runner calls evaluate once candles have closed.'''
+
+    def __init__(self, symbol, market, account, gateway, metrics, **params):
+        params = resolve_params(PARAMS, globals(), params)
+        self.symbol = symbol
+        self.account = account
+        self.gateway = gateway
+        self.metrics = metrics
+        self.leverage = params['LEVERAGE']
+        self.trade_size = params['TRADE_SIZE']
+        self.max_slippage = params['MAX_SLIPPAGE']
+
+        self.rsi = RSI(int(params['RSI_SPAN']))
+        self.bb = BBands(int(params['BB_SPAN']))
+        self.bars = BarClose(float(params['EVAL_INTERVAL']))
+        self.signal = {}
+        self.signals = deque(maxlen=5)
+        self.position = {}
+        self.last_trade = 0
+        self._entry = 0
 
-    def trade_signal(self, rsi_span, bb_span):
+        '''
+        Create some OHLC data for technical analysis, and signalling of the algo
+        Set your timeframe 30S, 1T, 5T, etc. Note that longer timeframes will need a longer initialisation period
+        as we are dealing with tick data, and constructing our own candlesticks'''
+        self.mkt_data = CandleBuffer(tf='1T', capacity=MAX_ROWS)
+
+        self.market = market
+        self.resume = 0
+        self.candle_topic = candle_topic(symbol, 'trade', self.mkt_data.tf)
+
+        self.snapshot_file = params['SNAPSHOT_FILE'].format(symbol=symbol)
+        self.restore()
+
+        # Warm the indicators up on the candles closed since the snapshot, or a full buffer of them
+        self.update(self.mkt_data.closed(self._backfill()))
+
+    def _backfill(self):
+        # Fold the trades since the last tick into the candles over REST, returns the number of candles closed
+        # Whole candles come from 1 minute klines, the one still forming from the last 100 trades
+        now, tf_ns = time_ns(), self.mkt_data.tf_ns
+        # No older than a full buffer, the candles of an older snapshot would all be pushed out by the ones after it
+        oldest = now - self.mkt_data.capacity * tf_ns
+        # The klines start at the bar forming when the stream stopped, so the trades it missed after the last tick are in it
+        # Candles read from a feed leave no bar forming, the next one starts after the last closed bar
+        after = self.mkt_data.start if self.mkt_data.start is not None else \
+            self.mkt_data.last_ts + 1 if self.mkt_data.last_ts is not None else oldest
+        start = max(after, oldest)
+        history = backfill.fetch(self.market, self.symbol, start // 1_000_000, now // 1_000_000, 'kline', granularity=1)
+
+        # Klines that all end before the last tick add nothing the candles do not already hold
+        last = self.mkt_data.last_ts or 0
+        kline_end = int(history['ts'][-1]) - int(history['ts'][-1]) % _KLINE_NS + _KLINE_NS - 1 if len(history['ts']) else 0
+        closed = 0
+        if kline_end > last:
+            self.mkt_data.drop_forming()
+            last = kline_end
+            for ts, price, size in zip(history['ts'].tolist(), history['price'].tolist(), history['size'].tolist()):
+                closed += self.mkt_data.update(ts, price, size)
+
+        for tick in self.market.get_trade_history(self.symbol)[::-1]:
+            if int(tick['ts']) > last:
+                closed += self.mkt_data.update(int(tick['ts']), float(tick['price']), int(tick['size']))
+
+        # Live ticks up to the last backfilled one are already in the candles
+        self.resume = max(self.mkt_data.last_ts or 0, last)
+        return closed
+
+    def catch_up(self):
+        # Fill a gap in the stream after a reconnect, the candles it closed are evaluated like live ones
+        self.bars.closed(self._backfill())
+
+    def snapshot(self):
+        # Candles, indicators and trade state for the next warm start
+        arrays, candles = self.mkt_data.snapshot()
+        return arrays, {'candles': candles, 'rsi': self.rsi.state(), 'bb': self.bb.state(), 'entry': self._entry,
+                        'last_trade': self.last_trade, 'signals': list(self.signals)}
+
+    def restore(self):
+        # Pick up from the snapshot if there is one, a snapshot from other candle settings is ignored
+        if not self.snapshot_file:
+            return
+        try:
+            loaded = snapshot.load(self.snapshot_file)
+            if loaded is None:
+                return
+            arrays, state = loaded
+            self.mkt_data.restore(arrays, state['candles'])
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Snapshot Ignored!\n {e}')
+            return
+
+        self.last_trade = state['last_trade']
+        try:
+            self.rsi.restore(state['rsi'])
+            self.bb.restore(state['bb'])
+            self._entry = state['entry']
+            self.signals.extend(state['signals'])
+            self.signal = self.signals[-1] if self.signals else {}
+        except (ValueError, KeyError):
+            # Indicator spans changed since the snapshot, recompute them over the restored candles
+            self.rsi, self.bb = RSI(self.rsi.timeperiod), BBands(self.bb.timeperiod)
+            self.update(self.mkt_data.closed())
+        print(f'Warm Start! Restored {len(self.mkt_data)} candles from {self.snapshot_file}')
+
+    def topics(self):
+        return [f'/contractMarket/execution:{self.symbol}']
+
+    def feed_candles(self):
+        # With a feed, the 1 minute candles it publishes stand in for the trades
+        return {f'/contractMarket/execution:{self.symbol}': self.candle_topic}
+
+    def bbp(self, close):
+        self.bb.update(close)
+        return self.bb.percent_b(close)
+
+    def rsif(self, close):
+        return self.rsi.update(close)
+
+    def update(self, bars):
+        # Step the indicators and signal state over a batch of closed candles, oldest first
+        for i in range(len(bars['ts'])):
+            bar = {column: bars[column][i] for column in bars}
+            self.signal = self.trade_signal(bar)
+            self.signals.append(self.signal)
+
+    def trade_signal(self, bar):
         '''
         Tweak trade signal or create strategies here
         This is an RSI and BBand trade strategy, when both give buy signal bot will long. Reverse for short
         Trades close based on RSI cooloff - this gives more leniency towards profit taking'''
-        self.rsif(int(rsi_span))
-        self.bbp(int(bb_span))
+        bar['RSI'] = self.rsif(bar['close'])
+        bar['BBP'] = self.bbp(bar['close'])
 
-        self.ohlcv_df.loc[((self.ohlcv_df['RSI'] < 40) & (self.ohlcv_df['BBP'] < 0)), 'Signal'] = 'buy'
-        self.ohlcv_df.loc[((self.ohlcv_df['RSI'] > 60) & (self.ohlcv_df['BBP'] > 1)), 'Signal'] = 'sell'
+        signal = 0
+        if bar['RSI'] > 60 and bar['BBP'] > 1:
+            signal = 'sell'
+        elif bar['RSI'] < 40 and bar['BBP'] < 0:
+            signal = 'buy'
 
-        self.ohlcv_df['Position'] = self.ohlcv_df['Signal'].copy()
-        self.ohlcv_df['Position'].ffill(inplace=True)
+        # Position carries the last entry signal forward
+        if signal:
+            self._entry = signal
 
         # Trade close condition on RSI 'cooloff'
-        self.ohlcv_df.loc[((self.ohlcv_df['RSI'] > 60) & (self.ohlcv_df['Position'] == 'buy')), 'Signal'] = 'sell'
-        self.ohlcv_df.loc[((self.ohlcv_df['RSI'] < 40) & (self.ohlcv_df['Position'] == 'sell')), 'Signal'] = 'buy'
+        if bar['RSI'] > 60 and self._entry == 'buy':
+            signal = 'sell'
+        elif bar['RSI'] < 40 and self._entry == 'sell':
+            signal = 'buy'
 
-        self.ohlcv_df.fillna(0, inplace=True)
-        self.execute_trade()
-        self.trade_status()
+        bar['Signal'] = signal
+        bar['Position'] = self._entry
+        return bar
 
-    def execute_trade(self, MAX_SLIPPAGE=0.025):
-        global last_trade
-        # Use the last known candle to trade, most recent is still forming.
-        self.signal = self.ohlcv_df.iloc[-2]
+    def execute_trade(self):
+        # Use the last closed candle to trade
+        self.position = self.account.position
 
         # Using limit orders to control potential slippage
-        if self.signal['Signal'] == 'sell' and last_trade < self.signal.name.value:
-            last_trade = self.signal.name.value
-            price = int(self.signal['close']*(1 - MAX_SLIPPAGE))
-            order = trade.create_limit_order(symbol=SYMBOL, side=self.signal['Signal'], leverage=LEVERAGE, size=TRADE_SIZE,
-                                             price=str(price))
-
-        elif self.signal['Signal'] == 'buy' and last_trade < self.signal.name.value:
-            last_trade = self.signal.name.value
-            price = int(self.signal['close'] * (1 + MAX_SLIPPAGE))
-            order = trade.create_limit_order(symbol=SYMBOL, side=self.signal['Signal'], leverage=LEVERAGE, size=TRADE_SIZE,
-                                             price=str(price))
-
-    def trade_status(self):
-        # Trade status updates
-        print(f'Latest Signals:\n '
-              f'{self.ohlcv_df.tail(5).to_string()}\n')
-        print(f'Current Position:\n'
-              f'Position {self.position["currentQty"]}\n'
-              f'Entry Price {self.position["avgEntryPrice"]}\n'
-              f'liquidation Price {self.position["liquidationPrice"]}\n'
-              f'Unrealised Pnl {self.position["unrealisedRoePcnt"]*100}%\n')
-
-
-def gen_signal(msg):
-    if msg['topic'] == f'/contractMarket/execution:{SYMBOL}':
-        # Bot needs to wait for executions before filling trade signals
-        new_ticks = msg["data"]
-        new_ticks.pop('symbol', None)
-        mkt_data.append(new_ticks)
-
+        if self.signal['Signal'] == 'sell' and self.last_trade < self.signal['ts']:
+            self.last_trade = self.signal['ts']
+            price = int(self.signal['close']*(1 - self.max_slippage))
+            self.gateway.submit(self.gateway.place(symbol=self.symbol, side=self.signal['Signal'], leverage=self.leverage,
+                                                   size=self.trade_size, price=str(price)), 'RSI-BBand Trader Order')
+            self.journal.emit('order', self.symbol, side=self.signal['Signal'], size=self.trade_size, price=price,
+                              bar=self.signal['ts'])
+
+        elif self.signal['Signal'] == 'buy' and self.last_trade < self.signal['ts']:
+            self.last_trade = self.signal['ts']
+            price = int(self.signal['close'] * (1 + self.max_slippage))
+            self.gateway.submit(self.gateway.place(symbol=self.symbol, side=self.signal['Signal'], leverage=self.leverage,
+                                                   size=self.trade_size, price=str(price)), 'RSI-BBand Trader Order')
+            self.journal.emit('order', self.symbol, side=self.signal['Signal'], size=self.trade_size, price=price,
+                              bar=self.signal['ts'])
+
+    def trade_status(self, closed=1):
+        # Journal the signals stepped since the last evaluation, the journal's writer thread formats and prints them
+        for bar in list(self.signals)[-closed:] if closed else ():
+            self.journal.emit('signal', self.symbol, **bar)
+
+    def on_message(self, msg):
+        if msg['topic'] == f'/contractMarket/execution:{self.symbol}':
+            # Bot needs to wait for executions before filling trade signals
+            start = perf_counter_ns()
+            new_ticks = msg["data"]
+
+            try:
+                if int(new_ticks['ts']) <= self.resume:
+                    return
+                self.metrics.observe('ws_age', time_ns() - int(new_ticks['ts']))
+                self.bars.closed(ohlcv(self.mkt_data, new_ticks))
+                self.metrics.lap('candles', start)
+            except Exception as e:
+                print(f'RSI-BBand Trader Error!\n'
+                      f'Check Parameter Inputs\n {e}')
+
+        elif msg['topic'] == self.candle_topic:
+            start = perf_counter_ns()
+            self.bars.closed(self.mkt_data.extend(msg['data']))
+            self.metrics.lap('candles', start)
+
+    def due(self, now):
+        return self.bars.due(now)
+
+    def wait_time(self, now):
+        return self.bars.wait_time(now)
+
+    def evaluate(self, now):
+        # Step the signals over every candle closed since the last evaluation, then trade on the newest
+        start = perf_counter_ns()
         try:
-            ohlcv_data = ohlcv(mkt_data)
-            strat = Strategy(ohlcv_data)
-            strat.trade_signal(RSI_SPAN, BB_SPAN)
+            closed = self.bars.take(now)
+            self.update(self.mkt_data.closed(closed))
+            t = self.metrics.lap('signals', start)
+            self.execute_trade()
+            t = self.metrics.lap('execute', t)
+            self.trade_status(closed)
+            self.metrics.lap('status', t)
+            self.metrics.lap('evaluate', start)
         except Exception as e:
             print(f'RSI-BBand Trader Error!\n'
                   f'Check Parameter Inputs\n {e}')
 
 
-async def ws_stream():
-
-    await ws_client.connect()
-    await ws_client.subscribe(f'/contractMarket/execution:{SYMBOL}')
+# Strategy class the runner and backtester build bots from
+BOT = Strategy
 
 
 if __name__ == "__main__":
     print('Starting RSI-BBand Trader!')
-    ws_client = WsClient(gen_signal, API_KEY, SECRET, API_PASS)
-    loop = asyncio.get_event_loop()
-
-    try:
-        loop.create_task(ws_stream())
-        loop.run_forever()
-    except (KeyboardInterrupt, Exception) as e:
-        print(f'Shutting Down {e}')
-        loop.run_until_complete(ws_client.disconnect())
-    finally:
-        loop.close()
\ No newline at end of file
+    main([(Strategy, SYMBOL, {})], METRICS_FILE, journal_file=JOURNAL_FILE)
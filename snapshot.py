@@ -0,0 +1,76 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+import os
+import json
+import numpy as np
+
+
+'''
+Warm start snapshots of a bot's candles and indicator state, so a restart only has to backfill the ticks since the last one.
+A snapshot is one file, a JSON header holding the scalar state and the dtype, shape and offset of each array,
+followed by the raw arrays. Loading maps the file, the arrays are copied out of the map by whoever restores them.'''
+
+_MAGIC = b'PFSNAP01'
+_ALIGN = 64
+
+
+def _aligned(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def _plain(value):
+    # numpy scalars in the state, e.g. candle timestamps, are written as plain numbers
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not snapshot serializable')
+
+
+def save(path, arrays, state):
+    # Write arrays and state to path, replaced atomically so a crash mid write keeps the previous snapshot
+    specs, offset = {}, 0
+    for name, arr in arrays.items():
+        specs[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset = _aligned(offset + arr.nbytes)
+    header = json.dumps({'arrays': specs, 'state': state}, default=_plain).encode()
+    start = _aligned(len(_MAGIC) + 8 + len(header))
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_MAGIC + len(header).to_bytes(8, 'little') + header)
+        for name, arr in arrays.items():
+            f.seek(start + specs[name]['offset'])
+            f.write(np.ascontiguousarray(arr).tobytes())
+    os.replace(tmp, path)
+
+
+def load(path):
+    # (arrays, state) with the arrays as read only maps of the file, None if there is no snapshot at path
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f'{path} is not a snapshot')
+        size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(size))
+    start = _aligned(len(_MAGIC) + 8 + size)
+
+    arrays = {name: np.memmap(path, dtype=spec['dtype'], mode='r', offset=start + spec['offset'],
+                              shape=tuple(spec['shape']))
+              for name, spec in header['arrays'].items()}
+    return arrays, header['state']
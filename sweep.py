@@ -0,0 +1,280 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import os
+import random
+import argparse
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from candles import tf_to_ns
+from backtest import SimTrade, load_strategy, replay
+from tape import TickReader, KIND_INDEX, KIND_TRADE
+
+
+'''
+Parameter sweeps over a recorded tape, spread across a process pool.
+The signal bots have vectorised evaluators that compute every indicator span once on the tape's candles and step
+all parameter sets through the strategy together, one numpy array operation per bar. Orders fill at the first price after
+the signal bar closes, as they do in backtest.replay, use replay to confirm the top results exactly.
+Any other script, such as the market maker, is run through backtest.replay once per parameter set.'''
+
+_BARS = {}
+
+
+def script_settings(script, params):
+    # Settings the evaluators share with the script itself, read from a bot built against the simulator
+    _, bot = load_strategy(script, SimTrade('BTCUSDTPERP'), 0.0, params)
+    return {'tf': bot.mkt_data.tf, 'dropna': bot.mkt_data.dropna, 'trade_size': bot.trade_size,
+            'risk_limits': getattr(bot, 'risk_limits', None)}
+
+
+def load_bars(tape, kind, tf, dropna):
+    # Candles built from one kind of tape row, with the price the next order would fill at. Cached per worker process
+    key = (tape, kind, tf, dropna)
+    if key not in _BARS:
+        reader = TickReader(tape)
+        rows = reader['kind'] == kind
+        prices = pd.Series(reader['price'][rows], index=pd.to_datetime(reader['ts'][rows], unit='ns'))
+
+        bars = prices.resample(pd.Timedelta(tf_to_ns(tf), unit='ns')).ohlc()
+        if dropna:
+            bars = bars.dropna()
+        # Orders placed on a bar close fill on the next traded price, the open of the next bar with ticks
+        bars['fill'] = bars['open'].shift(-1).bfill()
+        bars['mark'] = bars['close'].ffill()
+        _BARS[key] = bars
+
+    return _BARS[key]
+
+
+def rsi_batch(close, periods):
+    # TA-Lib RSI for several periods at once, rows follow periods
+    periods = np.asarray(periods)
+    out = np.full((len(periods), len(close)), np.nan)
+    diff = np.diff(close)
+    gain, loss = np.where(diff > 0, diff, 0.0), np.where(diff < 0, -diff, 0.0)
+    if len(diff) < periods.min():
+        return out
+
+    seeded = np.minimum(periods, len(diff)) - 1
+    avg_gain = np.cumsum(gain)[seeded] / periods
+    avg_loss = np.cumsum(loss)[seeded] / periods
+
+    for t in range(periods.min(), len(close)):
+        step = t > periods
+        avg_gain = np.where(step, (avg_gain * (periods - 1) + gain[t - 1]) / periods, avg_gain)
+        avg_loss = np.where(step, (avg_loss * (periods - 1) + loss[t - 1]) / periods, avg_loss)
+        total = avg_gain + avg_loss
+        rsi = np.divide(100 * avg_gain, total, out=np.zeros_like(total), where=total != 0)
+        out[:, t] = np.where(t >= periods, rsi, np.nan)
+
+    return out
+
+
+def bbp_batch(close, periods, nbdevup=2, nbdevdn=2):
+    # Bollinger %B from SMA bands for several periods at once, rows follow periods
+    out = np.full((len(periods), len(close)), np.nan)
+    sums = np.concatenate(([0.0], np.cumsum(close)))
+    sumsqs = np.concatenate(([0.0], np.cumsum(close * close)))
+
+    for row, period in enumerate(periods):
+        if period > len(close):
+            continue
+        mid = (sums[period:] - sums[:-period]) / period
+        var = (sumsqs[period:] - sumsqs[:-period]) / period - mid * mid
+        std = np.sqrt(np.maximum(var, 0))
+        up, low = mid + nbdevup * std, mid - nbdevdn * std
+        width = up - low
+        out[row, period - 1:] = np.divide(close[period - 1:] - low, width,
+                                          out=np.full_like(width, np.nan), where=width != 0)
+
+    return out
+
+
+def mom_batch(close, periods):
+    # Momentum for several periods at once, rows follow periods
+    out = np.full((len(periods), len(close)), np.nan)
+    for row, period in enumerate(periods):
+        out[row, period:] = close[period:] - close[:-period]
+    return out
+
+
+class _Book:
+    # Position and PnL of many parameter sets, filled with the same accounting as backtest.SimTrade
+    def __init__(self, sets, multiplier):
+        self.multiplier = multiplier
+        self.qty = np.zeros(sets)
+        self.entry = np.zeros(sets)
+        self.realised = np.zeros(sets)
+        self.trades = np.zeros(sets, dtype=int)
+        self.peak = np.zeros(sets)
+        self.drawdown = np.zeros(sets)
+
+    def fill(self, mask, signed, price):
+        size = np.abs(signed)
+        adding = (self.qty == 0) | (np.sign(self.qty) == np.sign(signed))
+        closing = np.minimum(np.abs(self.qty), size)
+
+        entry = np.where(adding, (self.entry * np.abs(self.qty) + price * size) / np.maximum(np.abs(self.qty) + size, 1),
+                         np.where(size > np.abs(self.qty), price, self.entry))
+        realised = np.where(adding, 0.0, closing * (price - self.entry) * self.multiplier * np.sign(self.qty))
+        qty = self.qty + signed
+
+        self.entry = np.where(mask, np.where(qty == 0, 0.0, entry), self.entry)
+        self.realised = np.where(mask, self.realised + realised, self.realised)
+        self.qty = np.where(mask, qty, self.qty)
+        self.trades += mask
+
+    def mark(self, price):
+        equity = self.realised + self.qty * (price - self.entry) * self.multiplier
+        self.peak = np.maximum(self.peak, equity)
+        self.drawdown = np.maximum(self.drawdown, self.peak - equity)
+        return equity
+
+
+def evaluate_rsibbp(bars, param_sets, settings, multiplier):
+    close = bars['close'].to_numpy()
+    rsi_spans = sorted({int(p['RSI_SPAN']) for p in param_sets})
+    bb_spans = sorted({int(p['BB_SPAN']) for p in param_sets})
+    rsi = rsi_batch(close, rsi_spans)[[rsi_spans.index(int(p['RSI_SPAN'])) for p in param_sets]]
+    bbp = bbp_batch(close, bb_spans)[[bb_spans.index(int(p['BB_SPAN'])) for p in param_sets]]
+
+    book = _Book(len(param_sets), multiplier)
+    entry = np.zeros(len(param_sets))
+    fills, marks = bars['fill'].to_numpy(), bars['mark'].to_numpy()
+
+    for t in range(len(close)):
+        r, b = rsi[:, t], bbp[:, t]
+        signal = np.where((r > 60) & (b > 1), -1, np.where((r < 40) & (b < 0), 1, 0))
+        entry = np.where(signal != 0, signal, entry)
+        # Trade close condition on RSI 'cooloff'
+        signal = np.where((r > 60) & (entry == 1), -1, np.where((r < 40) & (entry == -1), 1, signal))
+
+        if not np.isnan(fills[t]):
+            book.fill(signal != 0, signal * settings['trade_size'], fills[t])
+        book.mark(marks[t])
+
+    return book, book.mark(marks[-1])
+
+
+def evaluate_mom(bars, param_sets, settings, multiplier):
+    close = bars['close'].to_numpy()
+    spans = sorted({int(p[key]) for p in param_sets for key in ('SLOW_SIG', 'FAST_SIG')})
+    mom = mom_batch(close, spans)
+    slow = mom[[spans.index(int(p['SLOW_SIG'])) for p in param_sets]]
+    fast = mom[[spans.index(int(p['FAST_SIG'])) for p in param_sets]]
+
+    limits = settings['risk_limits'] or {'short': -np.inf, 'long': np.inf}
+    book = _Book(len(param_sets), multiplier)
+    fills, marks = bars['fill'].to_numpy(), bars['mark'].to_numpy()
+
+    for t in range(len(close)):
+        s, f = slow[:, t], fast[:, t]
+        signal = np.where((s > 0) & (f > 0), 1, np.where((s < 0) & (f < 0), -1, 0))
+        allowed = np.where(signal > 0, book.qty <= limits['long'], book.qty >= limits['short'])
+
+        if not np.isnan(fills[t]):
+            book.fill((signal != 0) & allowed, signal * settings['trade_size'], fills[t])
+        book.mark(marks[t])
+
+    return book, book.mark(marks[-1])
+
+
+EVALUATORS = {'sample-RSIBBP.py': (evaluate_rsibbp, KIND_TRADE), 'sample-MOM.py': (evaluate_mom, KIND_INDEX)}
+
+
+def evaluate(script, tape, param_sets, symbol='BTCUSDTPERP', multiplier=0.001):
+    # Score a batch of parameter sets, one row of pnl, drawdown and trade count per set
+    evaluator = EVALUATORS.get(os.path.basename(script))
+    if evaluator is None:
+        results = [replay(script, tape, params, symbol, multiplier) for params in param_sets]
+        return [dict(params, pnl=r['pnl'], drawdown=r['drawdown'], trades=r['trades'])
+                for params, r in zip(param_sets, results)]
+
+    evaluator, kind = evaluator
+    settings = script_settings(script, param_sets[0])
+    bars = load_bars(tape, kind, settings['tf'], settings['dropna'])
+    with np.errstate(invalid='ignore'):
+        book, equity = evaluator(bars, param_sets, settings, multiplier)
+
+    return [dict(params, pnl=float(equity[i]), drawdown=float(book.drawdown[i]), trades=int(book.trades[i]))
+            for i, params in enumerate(param_sets)]
+
+
+def parameter_sets(grid, samples=None, seed=None):
+    # Every combination of the grid, or a random sample of them
+    names = list(grid)
+    combos = list(product(*(grid[name] for name in names)))
+    if samples is not None and samples < len(combos):
+        combos = random.Random(seed).sample(combos, samples)
+
+    return [dict(zip(names, combo)) for combo in combos]
+
+
+def sweep(script, tape, grid, samples=None, workers=None, chunk_size=256, seed=None, symbol='BTCUSDTPERP'):
+    '''
+    Evaluate a grid, or a random sample of it, across a process pool.
+    Returns a DataFrame of the parameter sets ranked by PnL, with max drawdown and trade count.'''
+    param_sets = parameter_sets(grid, samples, seed)
+    if os.path.basename(script) not in EVALUATORS:
+        chunk_size = 1
+    chunks = [param_sets[i:i + chunk_size] for i in range(0, len(param_sets), chunk_size)]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(evaluate, [script] * len(chunks), [tape] * len(chunks), chunks, [symbol] * len(chunks))
+        rows = [row for chunk in results for row in chunk]
+
+    return pd.DataFrame(rows).sort_values('pnl', ascending=False).reset_index(drop=True)
+
+
+def parse_grid(specs):
+    # NAME=a,b,c lists values, NAME=start:stop:step is an inclusive range
+    grid = {}
+    for spec in specs:
+        name, values = spec.split('=', 1)
+        cast = float if '.' in values else int
+        if ':' in values:
+            start, stop, step = (cast(v) for v in (values.split(':') + ['1'])[:3])
+            grid[name] = [cast(v) for v in np.arange(start, stop + step / 2, step)]
+        else:
+            grid[name] = [cast(v) for v in values.split(',')]
+
+    return grid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sweep strategy parameters over a recorded tape')
+    parser.add_argument('script', help='e.g. sample-MOM.py')
+    parser.add_argument('tape', help='tape directory written by tape.py')
+    parser.add_argument('grid', nargs='+', help='e.g. SLOW_SIG=8:32:2 FAST_SIG=2,4,6')
+    parser.add_argument('--random', type=int, help='evaluate this many random combinations of the grid')
+    parser.add_argument('--workers', type=int, help='worker processes, defaults to the number of cores')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--symbol', default='BTCUSDTPERP')
+    parser.add_argument('--out', help='csv file for the full ranked table')
+    args = parser.parse_args()
+
+    ranked = sweep(args.script, args.tape, parse_grid(args.grid), args.random, args.workers, seed=args.seed,
+                   symbol=args.symbol)
+    print(ranked.head(20).to_string())
+    if args.out:
+        ranked.to_csv(args.out, index=False)
@@ -0,0 +1,166 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import os
+import sys
+import asyncio
+import numpy as np
+
+
+'''
+Append only columnar tick files. A tape is a directory holding one raw little endian file per column,
+so each column can be appended to while recording and memory mapped without parsing when replaying.
+Index and mark prices from /contract/instrument and trades from /contractMarket/execution share one tape, told apart by kind.'''
+
+COLUMNS = {'ts': '<i8', 'kind': '<i1', 'price': '<f8', 'size': '<f8', 'side': '<i1'}
+KIND_INDEX, KIND_MARK, KIND_TRADE = 0, 1, 2
+SIDES = {'buy': 1, 'sell': -1}
+
+
+def parse_message(msg):
+    # Tape rows (ts ns, kind, price, size, side) in a websocket message, empty for topics that are not recorded
+    topic, data = msg.get('topic', ''), msg.get('data', {})
+
+    if topic.startswith('/contractMarket/execution:'):
+        return [(int(data['ts']), KIND_TRADE, float(data['price']), float(data['size']), SIDES.get(data.get('side'), 0))]
+
+    rows = []
+    if topic.startswith('/contract/instrument:'):
+        ts = int(data.get('timestamp', 0)) * 1_000_000
+        if 'indexPrice' in data:
+            rows.append((ts, KIND_INDEX, float(data['indexPrice']), 0.0, 0))
+        if 'markPrice' in data:
+            rows.append((ts, KIND_MARK, float(data['markPrice']), 0.0, 0))
+    return rows
+
+
+def to_message(symbol, ts, kind, price, size, side):
+    # Rebuild the websocket message a tape row was recorded from
+    if kind == KIND_TRADE:
+        return {'topic': f'/contractMarket/execution:{symbol}', 'subject': 'match',
+                'data': {'symbol': symbol, 'ts': ts, 'price': price, 'size': int(size),
+                         'side': 'buy' if side > 0 else 'sell'}}
+
+    key = 'indexPrice' if kind == KIND_INDEX else 'markPrice'
+    return {'topic': f'/contract/instrument:{symbol}', 'subject': 'mark.index.price',
+            'data': {'timestamp': ts // 1_000_000, key: price}}
+
+
+class TickWriter:
+    '''
+    Buffers rows and appends them to the column files of a tape directory. Call flush periodically and close on shutdown.'''
+
+    def __init__(self, path, buffer_rows=4096):
+        self.path = path
+        self.buffer_rows = buffer_rows
+        self._rows = []
+
+        os.makedirs(path, exist_ok=True)
+        self._files = {column: open(os.path.join(path, f'{column}.bin'), 'ab') for column in COLUMNS}
+
+    def write(self, ts, kind, price, size=0.0, side=0):
+        self._rows.append((ts, kind, price, size, side))
+        if len(self._rows) >= self.buffer_rows:
+            self.flush()
+
+    def write_message(self, msg):
+        for row in parse_message(msg):
+            self.write(*row)
+
+    def write_columns(self, columns):
+        # Append whole column arrays at once, e.g. a backfill, after any buffered rows
+        self.flush()
+        for column, dtype in COLUMNS.items():
+            self._files[column].write(np.asarray(columns[column], dtype=dtype).tobytes())
+            self._files[column].flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+
+        columns = zip(*self._rows)
+        for (column, dtype), values in zip(COLUMNS.items(), columns):
+            self._files[column].write(np.asarray(values, dtype=dtype).tobytes())
+            self._files[column].flush()
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        for f in self._files.values():
+            f.close()
+
+
+class TickReader:
+    '''
+    Memory mapped read only view of a tape. Columns are numpy arrays, rows past the shortest column
+    are ignored so a tape that is still being written, or was cut off mid flush, reads cleanly.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = {}
+        for column, dtype in COLUMNS.items():
+            file = os.path.join(path, f'{column}.bin')
+            size = os.path.getsize(file) if os.path.exists(file) else 0
+            self.columns[column] = np.memmap(file, dtype=dtype, mode='r') if size else np.empty(0, dtype=dtype)
+
+        self.length = min(len(values) for values in self.columns.values())
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, column):
+        return self.columns[column][:self.length]
+
+    def rows(self, chunk=65536):
+        # Iterate (ts, kind, price, size, side) tuples as plain Python values, converted a chunk at a time
+        for start in range(0, self.length, chunk):
+            end = min(start + chunk, self.length)
+            yield from zip(*(self.columns[column][start:end].tolist() for column in COLUMNS))
+
+
+def record(path, symbol):
+    # Record the public instrument and execution channels for a symbol until interrupted
+    from polofutures import WsClient
+
+    writer = TickWriter(path)
+
+    async def stream():
+        await ws_client.connect()
+        await ws_client.subscribe(f'/contract/instrument:{symbol}')
+        await ws_client.subscribe(f'/contractMarket/execution:{symbol}')
+        while True:
+            await asyncio.sleep(1)
+            writer.flush()
+
+    ws_client = WsClient(writer.write_message, os.environ['PF_API_KEY'], os.environ['PF_SECRET'], os.environ['PF_PASS'])
+    loop = asyncio.get_event_loop()
+
+    try:
+        loop.run_until_complete(stream())
+    except (KeyboardInterrupt, Exception) as e:
+        print(f'Stopping Recorder {e}')
+    finally:
+        writer.close()
+        loop.run_until_complete(ws_client.disconnect())
+        loop.close()
+
+
+if __name__ == "__main__":
+    # python tape.py <tape directory> [symbol]
+    print('Starting Tick Recorder!')
+    record(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'BTCUSDTPERP')
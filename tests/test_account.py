@@ -0,0 +1,82 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+from account import AccountState
+
+
+'''
+The account cache against a paged REST order list and the websocket order updates.'''
+
+
+class Trade:
+    # Active orders served a page at a time, like the REST API's currentPage, pageSize and totalPage
+    def __init__(self, orders, page_size=50):
+        self.orders = orders
+        self.page_size = page_size
+        self.pages = []
+
+    def get_position_details(self, symbol):
+        return {'currentQty': 0}
+
+    def get_order_list(self, status='active', currentPage=1, pageSize=50, **kwargs):
+        size = min(pageSize, self.page_size)
+        self.pages.append(currentPage)
+        items = self.orders[(currentPage - 1) * size:currentPage * size]
+        return {'currentPage': currentPage, 'pageSize': size, 'totalNum': len(self.orders),
+                'totalPage': -(-len(self.orders) // size), 'items': items}
+
+
+def orders(n, symbol='BTCUSDTPERP'):
+    return [{'id': f'{symbol}-{i}', 'symbol': symbol, 'side': 'buy', 'price': str(100 - i), 'size': 10, 'filledSize': 0,
+             'clientOid': f'mm-b{i}-10at{100 - i}ts0'} for i in range(n)]
+
+
+def test_reconcile_reads_every_page():
+    trade = Trade(orders(130) + orders(20, 'ETHUSDTPERP'))
+    account = AccountState(trade, 'BTCUSDTPERP')
+    account.reconcile()
+    assert trade.pages == [1, 2, 3]
+    assert sorted(account.orders) == sorted(order['id'] for order in orders(130))
+
+
+def test_single_page_without_total():
+    class Simple:
+        def get_position_details(self, symbol):
+            return {}
+
+        def get_order_list(self, status='active', **kwargs):
+            return {'items': orders(3)}
+
+    account = AccountState(Simple(), 'BTCUSDTPERP')
+    account.reconcile()
+    assert len(account.orders) == 3
+
+
+def test_rest_and_websocket_sizes_agree_on_partial_fills():
+    resting = orders(2)
+    resting[0]['filledSize'] = 4
+    account = AccountState(Trade(resting), 'BTCUSDTPERP')
+    account.reconcile()
+    assert [order['size'] for order in account.open_orders()] == [6, 10]
+
+    # The same partial fill reported over the websocket leaves the cached size where the REST snapshot put it
+    account.on_message({'topic': '/contractMarket/tradeOrders',
+                        'data': dict(resting[0], orderId=resting[0]['id'], type='match', status='open', remainSize=6)})
+    assert account.orders[resting[0]['id']]['size'] == 6
+    account.reconcile()
+    assert account.orders[resting[0]['id']]['size'] == 6
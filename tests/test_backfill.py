@@ -0,0 +1,126 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+import backfill
+from tape import KIND_INDEX, KIND_TRADE
+
+
+'''
+Backfill windows, paging and the disk cache against a stub REST market.'''
+
+MINUTE = 60_000
+# A clock 5 minutes past a boundary of both the index and the kline windows
+NOW = 1_600_000_000_000 - 1_600_000_000_000 % 36_000_000 + 5 * MINUTE
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # Which windows have settled, and so are cached, depends on the time of the backfill
+    monkeypatch.setattr(backfill.time, 'time', lambda: NOW / 1000)
+
+
+class Market:
+    # Index points every second and 1 minute klines up to now, served a page at a time like the REST market API
+    def __init__(self, now):
+        self.now = now
+        self.calls = []
+
+    def get_index_list(self, symbol, startAt=0, endAt=None, forward=True, maxCount=10, **kwargs):
+        self.calls.append(('index', startAt, endAt))
+        points = [t for t in range(startAt + -startAt % 1000, min(endAt + 1, self.now), 1000)][:maxCount]
+        return {'dataList': [{'timePoint': t, 'value': t / 1000} for t in points], 'hasMore': len(points) == maxCount}
+
+    def get_kline_data(self, symbol, granularity, begin_t=None, end_t=None):
+        self.calls.append(('kline', begin_t, end_t))
+        starts = range(begin_t + -begin_t % MINUTE, min(end_t, self.now), MINUTE)
+        return [[t, t, t + 2, t - 1, t + 1, 5] for t in starts][:backfill.KLINE_PAGE]
+
+
+class Limit:
+    def __init__(self):
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+
+
+def test_index_windows_are_paged_to_the_end():
+    now = NOW
+    market, limit = Market(now), Limit()
+    start, end = now - 2 * 3_600_000 - 123_456, now - 3_600_000
+    columns = backfill.fetch(market, '.PXBTUSDT', start, end, 'index', cache=None, limit=limit)
+
+    expected = np.arange(start + -start % 1000, end, 1000)
+    np.testing.assert_array_equal(columns['ts'], expected * 1_000_000)
+    np.testing.assert_array_equal(columns['price'], expected / 1000)
+    assert (columns['kind'] == KIND_INDEX).all()
+
+    # Every request stays inside one window aligned to the window size, and takes a token
+    for _, at, stop in market.calls:
+        assert at // backfill.INDEX_WINDOW == stop // backfill.INDEX_WINDOW
+    assert limit.acquired == len(market.calls)
+
+
+def test_klines_become_four_trades_per_bar():
+    now = NOW
+    market = Market(now)
+    start = now - 5 * MINUTE - 600 * MINUTE
+    columns = backfill.fetch(market, 'BTCUSDTPERP', start, start + 450 * MINUTE, 'kline', cache=None, limit=Limit())
+
+    assert len(columns['ts']) == 4 * 450
+    assert (columns['kind'] == KIND_TRADE).all()
+    bars = columns['price'].reshape(-1, 4)
+    np.testing.assert_array_equal(bars[:, 0], np.arange(start, start + 450 * MINUTE, MINUTE))
+    np.testing.assert_array_equal(bars[:, 1] - bars[:, 0], 2)
+    assert columns['size'].reshape(-1, 4)[:, 3].tolist() == [5] * 450
+    # 450 minutes from a window boundary span three 200 minute windows, each read in one page
+    assert [(at - start) // MINUTE for _, at, _ in market.calls] == [0, 200, 400]
+
+
+def test_rate_limit_spaces_requests():
+    limit = backfill.RateLimit(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        limit.acquire()
+    assert time.monotonic() - start >= 5 / 50 * 0.9
+
+
+def test_settled_windows_come_from_the_cache(tmp_path):
+    now = NOW
+    start, end = now - 40 * MINUTE, now
+    # 40 minutes back from 5 past a boundary span four 15 minute windows, the last reaching up to now
+    cache = str(tmp_path)
+
+    market = Market(now)
+    first = backfill.fetch(market, '.PXBTUSDT', start, end, 'index', cache=cache, limit=Limit())
+    windows = {at // backfill.INDEX_WINDOW for _, at, _ in market.calls}
+    cached = os.listdir(os.path.join(cache, '.PXBTUSDT', 'index'))
+    # The window reaching into the last minute is never cached
+    assert len(windows) == 4 and len(cached) == 3
+
+    market = Market(now)
+    second = backfill.fetch(market, '.PXBTUSDT', start, end, 'index', cache=cache, limit=Limit())
+    assert {at // backfill.INDEX_WINDOW for _, at, _ in market.calls} == {max(windows)}
+    for column in first:
+        np.testing.assert_array_equal(first[column], second[column])
@@ -0,0 +1,168 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import asyncio
+
+import numpy as np
+import pytest
+
+from book import OrderBook
+
+
+'''
+The numpy order book against a plain dict book fed the same level 2 deltas.'''
+
+TICK = 0.5
+SYMBOL = 'BTCUSDTPERP'
+
+
+class Reference:
+    # Level 2 book as {side: {price in ticks: size}}, with the deltas that keep it inside a band around a walking mid
+    def __init__(self, mid, band):
+        self.mid = mid
+        self.band = band
+        self.sides = {'buy': {}, 'sell': {}}
+        self.sequence = 100
+
+    def delta(self, ticks, side, size):
+        self.sequence += 1
+        if size:
+            self.sides[side][ticks] = size
+        else:
+            self.sides[side].pop(ticks, None)
+        return {'topic': f'/contractMarket/level2:{SYMBOL}',
+                'data': {'sequence': self.sequence, 'change': f'{ticks * TICK},{side},{size}'}}
+
+    def step(self, rng):
+        # Move the mid a tick at most, clear the levels it crossed or left behind, then change a level near it
+        self.mid += int(rng.integers(-1, 2))
+        for side, levels in self.sides.items():
+            for ticks in list(levels):
+                crossed = ticks >= self.mid if side == 'buy' else ticks <= self.mid
+                if crossed or abs(ticks - self.mid) > self.band:
+                    yield self.delta(ticks, side, 0)
+        side = 'buy' if rng.random() < 0.5 else 'sell'
+        offset = int(rng.integers(1, self.band + 1))
+        size = float(rng.integers(1, 50)) if rng.random() < 0.7 else 0.0
+        yield self.delta(self.mid - offset if side == 'buy' else self.mid + offset, side, size)
+
+    def snapshot(self):
+        bids, asks = self.sides['buy'], self.sides['sell']
+        return {'sequence': self.sequence,
+                'bids': [[ticks * TICK, bids[ticks]] for ticks in sorted(bids, reverse=True)],
+                'asks': [[ticks * TICK, asks[ticks]] for ticks in sorted(asks)]}
+
+    def best(self, side):
+        levels = self.sides[side]
+        if not levels:
+            return None
+        return (max(levels) if side == 'buy' else min(levels)) * TICK
+
+
+def check(book, reference):
+    assert book.best_bid() == reference.best('buy')
+    assert book.best_ask() == reference.best('sell')
+    for side, levels in reference.sides.items():
+        for ticks in range(reference.mid - reference.band - 2, reference.mid + reference.band + 3):
+            assert book.depth(ticks * TICK, side) == levels.get(ticks, 0.0), (side, ticks)
+
+
+def filled(rng, reference, steps=200):
+    return [msg for _ in range(steps) for msg in reference.step(rng)]
+
+
+def test_random_deltas_match_reference_across_recentres():
+    rng = np.random.default_rng(11)
+    reference = Reference(mid=40_000, band=24)
+    filled(rng, reference)
+    book = OrderBook(SYMBOL, TICK, levels=256)
+    book.load(reference.snapshot())
+    base = book.base
+
+    for i in range(20_000):
+        for msg in reference.step(rng):
+            assert book.on_message(msg)
+        if i % 97 == 0:
+            check(book, reference)
+    check(book, reference)
+
+    # The mid walked well off the first grid, which was re-centred without losing a level
+    assert book.base != base
+    assert book.outside == 0 and book.gaps == 0 and book.synced
+
+
+def snapshot_after(messages):
+    # REST snapshot of the book once messages have been applied
+    sides = {'buy': {}, 'sell': {}}
+    for msg in messages:
+        price, side, size = msg['data']['change'].split(',')
+        if float(size):
+            sides[side][float(price)] = float(size)
+        else:
+            sides[side].pop(float(price), None)
+    return {'sequence': messages[-1]['data']['sequence'],
+            'bids': [[price, sides['buy'][price]] for price in sorted(sides['buy'], reverse=True)],
+            'asks': [[price, sides['sell'][price]] for price in sorted(sides['sell'])]}
+
+
+@pytest.mark.parametrize('at', [21, 30])
+def test_gap_resyncs_and_replays_buffered_deltas(at):
+    rng = np.random.default_rng(12)
+    reference = Reference(mid=40_000, band=24)
+    history = filled(rng, reference)
+    book = OrderBook(SYMBOL, TICK, levels=256)
+    book.load(reference.snapshot())
+
+    messages = filled(rng, reference, 50)
+    for msg in messages[:20]:
+        book.on_message(msg)
+    # One delta is lost, the rest arrive while the book waits for a snapshot
+    for msg in messages[21:]:
+        book.on_message(msg)
+    assert book.gaps == 1 and not book.synced
+
+    # Buffered deltas after the snapshot are replayed, those already in it are skipped
+    book.resync(snapshot_after(history + messages[:at]))
+    assert book.synced and book.sequence == reference.sequence
+    check(book, reference)
+
+
+def test_sync_loop_fetches_a_snapshot_when_deltas_arrive_unsynced():
+    rng = np.random.default_rng(13)
+    reference = Reference(mid=40_000, band=24)
+    filled(rng, reference)
+
+    class Market:
+        def get_l2_order_book(self, symbol):
+            return reference.snapshot()
+
+    async def run():
+        book = OrderBook(SYMBOL, TICK, levels=256)
+        task = asyncio.ensure_future(book.sync_loop(Market()))
+        for msg in filled(rng, reference, 20):
+            book.on_message(msg)
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if book.synced:
+                break
+        task.cancel()
+        return book
+
+    book = asyncio.run(run())
+    assert book.synced
+    check(book, reference)
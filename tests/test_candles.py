@@ -0,0 +1,99 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import numpy as np
+import pytest
+
+from candles import CandleBuffer, CandleStore
+
+
+'''
+The candle store's rolled up timeframes against buffers built straight from the same ticks.'''
+
+TIMEFRAMES = ('15S', '30S', '1T', '5T', '15T', '1H')
+
+
+def ticks(n=20_000, seed=3):
+    # Ticks a few seconds apart with quiet stretches, so some bars are empty in every timeframe
+    rng = np.random.default_rng(seed)
+    gaps = rng.exponential(2.0, n) * np.where(rng.random(n) < 0.002, 2000, 1)
+    ts = 1_600_000_000_000_000_000 + np.cumsum(gaps * 1_000_000_000).astype(np.int64)
+    price = 30_000 + np.cumsum(rng.integers(-5, 6, n))
+    size = rng.integers(1, 100, n)
+    return list(zip(ts.tolist(), price.astype(float).tolist(), size.tolist()))
+
+
+def bars(buffer):
+    view = buffer.closed()
+    return np.column_stack([view['ts']] + [view[column] for column in ('open', 'high', 'low', 'close', 'size')])
+
+
+@pytest.mark.parametrize('dropna', [True, False])
+def test_rollup_matches_direct(dropna):
+    store = CandleStore(TIMEFRAMES, capacity=2000, dropna=dropna)
+    direct = {tf: CandleBuffer(tf, capacity=2000, dropna=dropna) for tf in TIMEFRAMES}
+    for ts, price, size in ticks():
+        store.update(ts, price, size)
+        for buffer in direct.values():
+            buffer.update(ts, price, size)
+
+    for tf in TIMEFRAMES:
+        np.testing.assert_array_equal(bars(store[tf]), bars(direct[tf]), err_msg=tf)
+
+
+def test_on_close_reports_each_close_once():
+    store = CandleStore(('15S', '1T', '5T'), capacity=5000)
+    direct = CandleBuffer('5T', capacity=5000)
+    closes = {'15S': [], '1T': [], '5T': []}
+    for tf, seen in closes.items():
+        store.on_close(tf, lambda buffer, n, seen=seen: seen.extend(buffer.closed(n)['ts'].tolist()))
+
+    for ts, price, size in ticks(5000):
+        closed = direct.update(ts, price, size)
+        before = len(closes['5T'])
+        store.update(ts, price, size)
+        # A coarse bar closes on the same tick as it would in a buffer of its own
+        assert len(closes['5T']) - before == closed
+
+    for tf, seen in closes.items():
+        assert seen == store[tf].closed()['ts'].tolist()
+
+
+def test_timeframes_must_nest():
+    with pytest.raises(ValueError):
+        CandleStore(('15S', '40S'))
+
+
+def test_extend_skips_held_bars_and_replaces_forming():
+    source = CandleBuffer('1T', capacity=100)
+    for ts, price, size in ticks(500):
+        source.update(ts, price, size)
+    published = source.closed()
+
+    buffer = CandleBuffer('1T', capacity=100)
+    half = len(published['ts']) // 2
+    for ts, price, size in ticks(500):
+        if ts >= published['ts'][half]:
+            break
+        buffer.update(ts, price, size)
+
+    held = len(buffer)
+    assert buffer.extend(published) == len(published['ts']) - held
+    assert buffer.start is None
+    np.testing.assert_array_equal(bars(buffer), bars(source))
+    assert buffer.extend(published) == 0
@@ -0,0 +1,106 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import os
+
+import numpy as np
+import pytest
+
+from candles import CandleBuffer
+from metrics import Metrics
+from runner import load_script
+
+
+'''
+Signal bot candles rebuilt over REST after the stream drops, against candles from the uninterrupted stream.'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MINUTE = 60_000_000_000
+T0 = 1_600_000_000 * 1_000_000_000 - 1_600_000_000 * 1_000_000_000 % MINUTE
+
+
+class Market:
+    # Trades up to the clock, served as 1 minute klines and the last 100 trades like the REST market API
+    def __init__(self, trades):
+        self.trades = trades
+        self.clock = T0
+
+    def seen(self):
+        return [trade for trade in self.trades if trade[0] <= self.clock]
+
+    def get_kline_data(self, symbol, granularity, begin_t=None, end_t=None):
+        bars = {}
+        for ts, price, size in self.seen():
+            start = ts // 1_000_000 - ts // 1_000_000 % 60_000
+            if begin_t <= start < end_t:
+                bar = bars.setdefault(start, [start, price, price, price, price, 0])
+                bar[2], bar[3], bar[4], bar[5] = max(bar[2], price), min(bar[3], price), price, bar[5] + size
+        return list(bars.values())
+
+    def get_trade_history(self, symbol):
+        return [{'ts': ts, 'price': price, 'size': size} for ts, price, size in self.seen()[-100:][::-1]]
+
+
+@pytest.fixture
+def module(monkeypatch, tmp_path):
+    # The backfill cache is written to the working directory
+    monkeypatch.chdir(tmp_path)
+    return load_script(os.path.join(ROOT, 'sample-RSIBBP.py'))
+
+
+def trades(minutes=12, seed=7):
+    # A trade every 1 to 2 seconds, well under 100 in any minute
+    rng = np.random.default_rng(seed)
+    ts = T0 + MINUTE + np.cumsum(rng.integers(1_000, 2_000, minutes * 40) * 1_000_000)
+    price = 10_000 + np.cumsum(rng.integers(-3, 4, len(ts)))
+    return [(int(t), float(p), int(s)) for t, p, s in zip(ts, price, rng.integers(1, 30, len(ts))) if t < T0 + minutes * MINUTE]
+
+
+def message(ts, price, size):
+    return {'topic': '/contractMarket/execution:BTCUSDTPERP', 'data': {'ts': ts, 'price': price, 'size': size}}
+
+
+def bars(buffer):
+    view = buffer.closed()
+    return np.column_stack([view['ts']] + [view[column] for column in ('open', 'high', 'low', 'close', 'size')])
+
+
+@pytest.mark.parametrize('drop, resume', [(4 * MINUTE + MINUTE // 3, 8 * MINUTE + MINUTE // 2),
+                                          (4 * MINUTE + MINUTE // 3, 4 * MINUTE + MINUTE // 2),
+                                          (4 * MINUTE - 1, 7 * MINUTE)])
+def test_catch_up_rebuilds_the_bar_forming_at_the_drop(module, monkeypatch, drop, resume):
+    tape = trades()
+    market = Market(tape)
+    monkeypatch.setattr(module, 'time_ns', lambda: market.clock)
+    bot = module.Strategy('BTCUSDTPERP', market, None, None, Metrics(), RSI_SPAN=14, BB_SPAN=20, SNAPSHOT_FILE='')
+
+    direct = CandleBuffer('1T', capacity=module.MAX_ROWS)
+    caught_up = False
+    for ts, price, size in tape:
+        direct.update(ts, price, size)
+        if T0 + drop < ts <= T0 + resume:
+            continue
+        if ts > T0 + resume and not caught_up:
+            # The runner catches up before the first live tick after the gap
+            market.clock = T0 + resume
+            bot.catch_up()
+            caught_up = True
+        market.clock = ts
+        bot.on_message(message(ts, price, size))
+
+    np.testing.assert_array_equal(bars(bot.mkt_data), bars(direct))
@@ -0,0 +1,92 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import os
+import numpy as np
+import pytest
+
+from candles import CandleBuffer
+from feed import FeedClient, Publisher, candle_topic
+from tape import KIND_INDEX, KIND_TRADE, to_message
+
+
+'''
+Bars and ticks read back through the shared memory feed against what the publisher was given.'''
+
+TIMEFRAMES = ('15S', '1T', '5T')
+
+
+@pytest.fixture
+def publisher():
+    # A symbol of its own per process, so a publisher left over from another run is not read
+    publisher = Publisher(f'TEST{os.getpid()}PERP', capacity=1 << 16, timeframes=TIMEFRAMES, bar_capacity=1 << 10)
+    yield publisher
+    publisher.close()
+
+
+def ticks(n=5000, seed=5):
+    rng = np.random.default_rng(seed)
+    ts = 1_600_000_000_000_000_000 + np.cumsum(rng.exponential(3.0, n) * 1_000_000_000).astype(np.int64)
+    price = 30_000 + np.cumsum(rng.integers(-5, 6, n))
+    kind = np.where(rng.random(n) < 0.3, KIND_INDEX, KIND_TRADE)
+    # The exchange stamps index prices in ms
+    ts = np.where(kind == KIND_INDEX, ts // 1_000_000 * 1_000_000, ts)
+    return list(zip(ts.tolist(), kind.tolist(), price.astype(float).tolist(), rng.integers(1, 100, n).tolist()))
+
+
+def bars(buffer):
+    view = buffer.closed()
+    return np.column_stack([view['ts']] + [view[column] for column in ('open', 'high', 'low', 'close', 'size')])
+
+
+@pytest.mark.parametrize('source, kind, dropna', [('trade', KIND_TRADE, True), ('index', KIND_INDEX, False)])
+def test_published_bars_match_direct(publisher, source, kind, dropna):
+    topic = candle_topic(publisher.writer.symbol, source, '1T')
+    received = []
+    client = FeedClient(received.append)
+    assert client.carries(topic)
+
+    direct = CandleBuffer('1T', capacity=1 << 10, dropna=dropna)
+    for ts, row_kind, price, size in ticks():
+        publisher.write_message(to_message(publisher.writer.symbol, ts, row_kind, price, size, 1))
+        if row_kind == kind:
+            direct.update(ts, price, size if kind == KIND_TRADE else 0.0)
+    client.poll_bars(topic, client.bar_readers[topic])
+
+    assert received and all(msg['topic'] == topic for msg in received)
+    buffer = CandleBuffer('1T', capacity=1 << 10, dropna=dropna)
+    for msg in received:
+        buffer.extend(msg['data'])
+    np.testing.assert_array_equal(bars(buffer), bars(direct))
+    assert client.overruns == 0
+
+
+def test_ticks_filtered_by_kind(publisher):
+    symbol = publisher.writer.symbol
+    received = []
+    client = FeedClient(received.append)
+    assert client.carries(f'/contractMarket/execution:{symbol}')
+    client.kinds[symbol] = {KIND_TRADE}
+
+    rows = ticks(1000)
+    for ts, kind, price, size in rows:
+        publisher.write_message(to_message(symbol, ts, kind, price, size, 1))
+    client.poll_ticks(symbol, client.readers[symbol])
+
+    trades = [(ts, price) for ts, kind, price, size in rows if kind == KIND_TRADE]
+    assert [(msg['data']['ts'], msg['data']['price']) for msg in received] == trades
@@ -0,0 +1,72 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import asyncio
+from types import SimpleNamespace
+
+from gateway import OrderGateway
+
+
+'''
+Queued cancels folded into one cancel all, and left alone when the symbol has orders the canceller does not own.'''
+
+
+class Trade:
+    def __init__(self):
+        self.calls = []
+
+    def cancel_order(self, order_id):
+        self.calls.append(('cancel_order', order_id))
+        return {'cancelledOrderIds': [order_id]}
+
+    def cancel_all_limit_orders(self, symbol):
+        self.calls.append(('cancel_all_limit_orders', symbol))
+        return {'cancelledOrderIds': []}
+
+
+def cancel(orders, *requests):
+    # requests are (order ids, prefix) cancel batches, queued together
+    trade = Trade()
+    gateway = OrderGateway(trade, max_workers=1)
+    gateway.accounts = {'BTCUSDTPERP': SimpleNamespace(orders={order_id: {'id': order_id, 'clientOid': oid}
+                                                               for order_id, oid in orders.items()})}
+
+    async def run():
+        await asyncio.gather(*(gateway.cancel_many(ids, prefix) for ids, prefix in requests))
+
+    try:
+        asyncio.run(run())
+    finally:
+        gateway.shutdown()
+    return trade.calls
+
+
+def test_own_orders_fold_into_cancel_all():
+    calls = cancel({'1': 'mm-b0-1at1ts0', '2': 'mm-s0-1at2ts0', '3': 'mm-b1-1at1ts0'}, (['1', '2', '3'], 'mm'))
+    assert calls == [('cancel_all_limit_orders', 'BTCUSDTPERP')]
+
+
+def test_foreign_order_keeps_cancels_individual():
+    # Between them two bots cancel every order, but neither owns them all
+    calls = cancel({'1': 'mm-b0-1at1ts0', '2': 'mm-s0-1at2ts0', '3': 'rsibbp-12'}, (['1', '2'], 'mm'), (['3'], 'rsibbp'))
+    assert sorted(calls) == [('cancel_order', '1'), ('cancel_order', '2'), ('cancel_order', '3')]
+
+
+def test_no_prefix_keeps_cancels_individual():
+    calls = cancel({'1': 'mm-b0-1at1ts0', '2': 'mm-s0-1at2ts0'}, (['1', '2'], None))
+    assert sorted(calls) == [('cancel_order', '1'), ('cancel_order', '2')]
@@ -0,0 +1,113 @@
+# Copyright 2020 Polo Digital Assets, Ltd.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE
+
+
+import math
+
+import numpy as np
+import pytest
+
+from indicators import RSI, BBands, Momentum
+from sweep import rsi_batch, bbp_batch, mom_batch
+
+talib = pytest.importorskip('talib')
+
+
+'''
+Parity of the streaming and batch indicators with TA-Lib on a seeded price series. Needs the test requirements,
+pip install -r requirements-test.txt, then run python -m pytest from the repo root.'''
+
+PERIODS = [2, 5, 14, 20, 50]
+
+
+@pytest.fixture(scope='module')
+def close():
+    # Random walk in whole ticks, with a flat run so zero ranges and zero moves are covered
+    rng = np.random.default_rng(7)
+    prices = 30_000 + np.cumsum(rng.integers(-5, 6, 2000)).astype(float)
+    prices[500:560] = prices[500]
+    return prices
+
+
+def stream(indicator, close):
+    return np.array([indicator.update(price) for price in close.tolist()])
+
+
+def assert_close(actual, expected):
+    # Same warm up, then equal to within float error
+    assert np.array_equal(np.isnan(actual), np.isnan(expected))
+    np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-6, equal_nan=True)
+
+
+@pytest.mark.parametrize('period', PERIODS)
+def test_rsi(close, period):
+    assert_close(stream(RSI(period), close), talib.RSI(close, timeperiod=period))
+
+
+@pytest.mark.parametrize('period', PERIODS)
+def test_bbands(close, period):
+    bands = BBands(period)
+    upper, middle, lower = np.array([bands.update(price) for price in close.tolist()]).T
+    expected = talib.BBANDS(close, timeperiod=period, nbdevup=2, nbdevdn=2, matype=0)
+    for actual, wanted in zip((upper, middle, lower), expected):
+        assert_close(actual, wanted)
+
+
+@pytest.mark.parametrize('period', PERIODS)
+def test_momentum(close, period):
+    assert_close(stream(Momentum(period), close), talib.MOM(close, timeperiod=period))
+
+
+def percent_b(close, period):
+    upper, _, lower = talib.BBANDS(close, timeperiod=period, nbdevup=2, nbdevdn=2, matype=0)
+    width = upper - lower
+    return np.divide(close - lower, width, out=np.full_like(width, np.nan), where=width > 1e-9)
+
+
+@pytest.mark.parametrize('period', PERIODS)
+def test_percent_b(close, period):
+    bands = BBands(period)
+    actual = np.array([(bands.update(price), bands.percent_b(price))[1] for price in close.tolist()])
+    # Flat windows have bands a float error apart in TA-Lib, %B is only defined where they have a width
+    wanted = percent_b(close, period)
+    defined = ~np.isnan(wanted)
+    np.testing.assert_allclose(actual[defined], wanted[defined], rtol=1e-6, atol=1e-6)
+
+
+def test_rsi_batch(close):
+    expected = np.array([talib.RSI(close, timeperiod=period) for period in PERIODS])
+    assert_close(rsi_batch(close, PERIODS), expected)
+
+
+def test_bbp_batch(close):
+    actual = bbp_batch(close, PERIODS)
+    for row, period in enumerate(PERIODS):
+        wanted = percent_b(close, period)
+        defined = ~np.isnan(wanted)
+        np.testing.assert_allclose(actual[row][defined], wanted[defined], rtol=1e-6, atol=1e-6)
+
+
+def test_mom_batch(close):
+    expected = np.array([talib.MOM(close, timeperiod=period) for period in PERIODS])
+    assert_close(mom_batch(close, PERIODS), expected)
+
+
+def test_short_series():
+    # Fewer closes than the period stay NaN, like TA-Lib
+    close = np.array([1.0, 2.0, 3.0])
+    assert all(math.isnan(value) for value in stream(RSI(14), close))
+    assert np.isnan(rsi_batch(close, [14])).all()